@@ -0,0 +1,190 @@
+"""Benchmarks MarkovBackend on synthetic corpora of several sizes.
+
+Word frequencies in the corpora follow Zipf's law, like real chat. Results
+are printed (or written) as JSON, so runs on different commits can be
+compared."""
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from bisect import bisect_left
+
+from main import MarkovBackend
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+WORDS_PER_LINE = 12
+# the vocabulary grows with the corpus, as it does in real chat
+VOCABULARY_PER_TRIGRAM = 0.05
+MIN_VOCABULARY = 1000
+ZIPF_EXPONENT = 1.1
+DEFAULT_REPLIES = 200
+# how many lines to learn one at a time, the way the bot learns messages
+LIVE_LEARN_LINES = 1000
+
+
+class ZipfWords(object):
+    """Draws words from a vocabulary of the given size by Zipf's law."""
+    def __init__(self, vocabulary_size, exponent=ZIPF_EXPONENT):
+        self.words = ['w%d' % rank for rank in range(vocabulary_size)]
+        self.cumulative = list(itertools.accumulate(
+            1 / rank ** exponent for rank in range(1, vocabulary_size + 1)))
+
+    def word(self):
+        r = random.random() * self.cumulative[-1]
+        return self.words[min(bisect_left(self.cumulative, r),
+                              len(self.words) - 1)]
+
+    def line(self, length=WORDS_PER_LINE):
+        return ' '.join(self.word() for _ in range(length))
+
+
+def write_corpus(path, num_trigrams, words):
+    """Writes lines of Zipf words holding about num_trigrams trigrams."""
+    num_lines = max(1, num_trigrams // (WORDS_PER_LINE - 2))
+    with open(path, 'w', encoding='utf-8') as corpus:
+        for _ in range(num_lines):
+            corpus.write(words.line() + '\n')
+    return num_lines
+
+
+def percentiles(timings):
+    """Summarizes a list of durations, in milliseconds."""
+    timings = sorted(timings)
+
+    def at(fraction):
+        return timings[min(len(timings) - 1, int(fraction * len(timings)))]
+    return {
+        'mean_ms': sum(timings) / len(timings) * 1000,
+        'p50_ms': at(0.5) * 1000,
+        'p90_ms': at(0.9) * 1000,
+        'p99_ms': at(0.99) * 1000,
+        'max_ms': timings[-1] * 1000,
+    }
+
+
+def time_calls(function, args_list):
+    """Returns how long function took for each set of arguments."""
+    timings = []
+    for args in args_list:
+        start = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_benchmark(num_trigrams, replies=DEFAULT_REPLIES, directory=None):
+    """Builds a brain of about num_trigrams trigrams and times it."""
+    directory = directory or tempfile.gettempdir()
+    words = ZipfWords(max(MIN_VOCABULARY,
+                          int(num_trigrams * VOCABULARY_PER_TRIGRAM)))
+    corpus_path = os.path.join(directory, 'corpus-%d.txt' % num_trigrams)
+    brain_path = os.path.join(directory, 'brain-%d.db' % num_trigrams)
+    num_lines = write_corpus(corpus_path, num_trigrams, words)
+
+    backend = MarkovBackend(brain_path)
+    start = time.perf_counter()
+    backend.train_file(corpus_path)
+    train_seconds = time.perf_counter() - start
+
+    live_lines = [words.line() for _ in range(min(LIVE_LEARN_LINES,
+                                                  num_lines))]
+    start = time.perf_counter()
+    for line in live_lines:
+        backend.learn(line)
+    backend.save()
+    learn_seconds = time.perf_counter() - start
+
+    brain = backend.brain
+    seeded = [(words.line(3),) for _ in range(replies)]
+    # words the brain has never seen, so replies fall back to a random seed
+    unseeded = [('unknown%d' % i,) for i in range(replies)]
+    seed_words = [(words.word(),) for _ in range(replies)]
+    result = {
+        'trigrams': num_trigrams,
+        'lines': num_lines,
+        'vocabulary': len(words.words),
+        'train_lines_per_second': num_lines / train_seconds,
+        'learn_lines_per_second': len(live_lines) / learn_seconds,
+        'reply_seeded': percentiles(time_calls(backend.reply, seeded)),
+        'reply_unseeded': percentiles(time_calls(backend.reply, unseeded)),
+        'pairs_containing_word': percentiles(time_calls(
+            lambda word: list(
+                brain.get_pairs_containing_word_ignoring_case(word)),
+            seed_words)),
+        'three_random_words': percentiles(time_calls(
+            brain.get_three_random_words, [()] * replies)),
+        'three_random_words_weighted': percentiles(time_calls(
+            brain.get_three_random_words, [(True,)] * replies)),
+        'brain_bytes': os.path.getsize(brain_path),
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
+    backend.journal.close()
+    for path in corpus_path, brain_path, brain_path + '.journal':
+        if os.path.exists(path):
+            os.remove(path)
+    return result
+
+
+def git_commit():
+    """Returns the commit being benchmarked, if this is a git checkout."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description="Benchmarks the markov backend on synthetic corpora")
+    argparser.add_argument("--sizes", metavar="N", type=int, nargs='+',
+                           default=DEFAULT_SIZES,
+                           help="Corpus sizes to benchmark, in trigrams")
+    argparser.add_argument("--replies", type=int, default=DEFAULT_REPLIES,
+                           help="How many replies and lookups to time")
+    argparser.add_argument("--seed", type=int, default=0,
+                           help="Random seed for the corpora")
+    argparser.add_argument("--output", metavar="results.json", type=str,
+                           help="Write results here instead of stdout")
+    args = vars(argparser.parse_args())
+
+    random.seed(args['seed'])
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'seed': args['seed'],
+        'results': [],
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args['sizes']:
+            print("Benchmarking %d trigrams..." % size, file=sys.stderr)
+            report['results'].append(
+                run_benchmark(size, args['replies'], directory))
+
+    output = json.dumps(report, indent=2)
+    if args['output']:
+        with open(args['output'], 'w') as results:
+            results.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+"""Shares one brain between several bot processes.
+
+A brain server owns the brain and answers bots over a Unix socket, one line
+of JSON per request and per response. Bots using the 'remote' backend walk
+the chain themselves, asking the server only for the followers of word
+pairs they haven't cached, so replies are made on as many cores as there
+are bots. All brain work on the server happens in one thread; requests
+waiting together are handled as a batch, with the lines learned in it
+learned in bulk."""
+import argparse
+import json
+import logging
+import os
+import queue
+import signal
+import socket
+import socketserver
+import threading
+import time
+
+# most requests handled as one batch
+MAX_BATCH = 1000
+# how often the server saves its brain, in seconds
+SAVE_INTERVAL = 60 * 10
+
+
+class BrainServerError(Exception):
+    """The brain server couldn't answer a request."""
+    pass
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+            except ValueError:
+                logging.warning("ignoring malformed brain request")
+                continue
+            self.server.brain_server.requests.put((self.wfile, request))
+
+
+class BrainServer(object):
+    """Serves a chat backend to other processes over the socket at path.
+
+    Requests are a method name, its arguments, and an id if they want a
+    response; responses carry the id of their request, and either a result
+    or an error. Each connection's requests are answered in order."""
+    def __init__(self, backend, path, config=None):
+        self.backend = backend
+        self.path = path
+        self.config = config
+        self.requests = queue.Queue()
+        self.server = None
+        self.stopping = False
+
+    def bind(self):
+        """Starts accepting connections, from a daemon thread."""
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except OSError:
+                # left behind by a server that died
+                os.remove(self.path)
+            else:
+                raise BrainServerError(
+                    "a brain server is already running at " + self.path)
+            finally:
+                probe.close()
+        self.server = socketserver.ThreadingUnixStreamServer(
+            self.path, _Handler)
+        self.server.daemon_threads = True
+        self.server.brain_server = self
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def can_serve_followers(self):
+        return hasattr(getattr(self.backend, 'brain', None), 'get_followers')
+
+    def call(self, method, args):
+        """Returns the result of a request, other than learn."""
+        if method == 'info':
+            return {'followers': self.can_serve_followers()}
+        if method == 'reply':
+            return self.backend.reply(args['message'],
+                                      room_id=args.get('room_id'))
+        if method == 'seed':
+            if self.backend.brain.is_empty():
+                return None
+            return self.backend.choose_seed(args['message'])
+        if method == 'followers':
+            return self.backend.brain.get_followers(
+                (args['word1'], args['word2']))
+        if method == 'save':
+            self.backend.save()
+            return None
+        raise BrainServerError("unknown method: %s" % method)
+
+    def handle_batch(self, batch):
+        """Handles (connection, request) pairs in order.
+
+        Runs of learn requests are learned with one learn_many per room."""
+        learned = {}
+        for connection, request in batch:
+            method = request.get('method')
+            args = request.get('args', {})
+            if method == 'learn':
+                learned.setdefault(args.get('room_id'), []).extend(
+                    args['lines'])
+                continue
+            self.learn(learned)
+            learned = {}
+            try:
+                response = {'result': self.call(method, args)}
+            except Exception as e:
+                logging.exception("error handling brain request %r" % method)
+                response = {'error': '%s: %s' % (type(e).__name__, e)}
+            if 'id' in request:
+                response['id'] = request['id']
+                try:
+                    connection.write(
+                        (json.dumps(response) + '\n').encode('utf-8'))
+                except OSError:
+                    # the bot went away
+                    pass
+        self.learn(learned)
+
+    def learn(self, learned):
+        for room_id, lines in learned.items():
+            try:
+                self.backend.learn_many(lines, room_id=room_id)
+            except Exception:
+                logging.exception("error learning %d lines" % len(lines))
+
+    def serve_forever(self):
+        """Handles requests until stop() is called, then saves the brain."""
+        if self.server is None:
+            self.bind()
+        last_save = time.time()
+        last_maintenance = time.time()
+        try:
+            while not self.stopping:
+                try:
+                    batch = [self.requests.get(timeout=1)]
+                except queue.Empty:
+                    self.backend.idle()
+                    batch = []
+                while batch and len(batch) < MAX_BATCH:
+                    try:
+                        batch.append(self.requests.get_nowait())
+                    except queue.Empty:
+                        break
+                if batch:
+                    self.handle_batch(batch)
+
+                if time.time() - last_save > SAVE_INTERVAL:
+                    self.backend.save()
+                    last_save = time.time()
+                if self.config and self.config.maintenance_interval and \
+                        time.time() - last_maintenance > \
+                        self.config.maintenance_interval:
+                    self.backend.maintain(
+                        min_count=self.config.prune_below,
+                        decay=self.config.decay_factor,
+                        max_followers=self.config.max_followers)
+                    last_maintenance = time.time()
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+            os.remove(self.path)
+            self.backend.save()
+
+    def stop(self):
+        self.stopping = True
+
+
+class BrainClient(object):
+    """A connection to a brain server, for one thread at a time."""
+    def __init__(self, path):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.reader = self.socket.makefile('r', encoding='utf-8')
+        self.next_id = 0
+
+    def _send(self, request):
+        self.socket.sendall((json.dumps(request) + '\n').encode('utf-8'))
+
+    def notify(self, method, **args):
+        """Sends a request without waiting for it to be handled."""
+        self._send({'method': method, 'args': args})
+
+    def call(self, method, **args):
+        """Sends a request and returns its result."""
+        self.next_id += 1
+        self._send({'method': method, 'args': args, 'id': self.next_id})
+        line = self.reader.readline()
+        if not line:
+            raise BrainServerError("the brain server closed the connection")
+        response = json.loads(line)
+        if 'error' in response:
+            raise BrainServerError(response['error'])
+        return response['result']
+
+    def close(self):
+        self.reader.close()
+        self.socket.close()
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description="Serves a chatbot brain to bots using the 'remote' "
+        "backend")
+    argparser.add_argument("--config", metavar="config.cfg", type=str,
+                           default='config.cfg',
+                           help="Config to take the backend's settings from")
+    argparser.add_argument("--brain", metavar="brain.db", type=str,
+                           default='brain.db', help="The brain to serve")
+    argparser.add_argument("--socket", metavar="brain.db.sock", type=str,
+                           help="Where to listen (default: next to the "
+                           "brain)")
+    args = vars(argparser.parse_args())
+
+    # the bot's backends and config live in main
+    import main as bot
+    logging.basicConfig(level=logging.INFO)
+    signal.signal(signal.SIGTERM, bot.sigterm_handler)
+    cfgparser = bot.ConfigParser()
+    if not cfgparser.read(args['config']):
+        cfgparser = bot.get_default_configparser()
+    config = bot.Config(cfgparser)
+    if config.backend == 'remote':
+        raise ValueError("the brain server can't use the remote backend")
+    backend = bot.make_backend(config, args['brain'])
+    server = BrainServer(backend, args['socket'] or args['brain'] + '.sock',
+                         config)
+    server.bind()
+    logging.info("serving %s on %s" % (args['brain'], server.path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        backend.close()
+
+
+if __name__ == '__main__':
+    main()
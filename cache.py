@@ -0,0 +1,253 @@
+"""In-process caches sitting in front of the brain."""
+from array import array
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+import random
+import time
+
+
+class FollowerCache(object):
+    """Bounded LRU cache of the words that follow each word pair.
+
+    Followers are stored as a list of words and a parallel array of
+    cumulative counts, so picking a weighted follower is a single bisect.
+    Pairs with no followers are cached too, as empty entries."""
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, word_pair, load):
+        """Returns (followers, cumulative counts) for word_pair.
+
+        On a miss, load(word_pair) is called for a {follower: count} dict."""
+        entry = self.entries.get(word_pair)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(word_pair)
+            return entry
+
+        self.misses += 1
+        return self.put(word_pair, load(word_pair))
+
+    def put(self, word_pair, followers):
+        """Caches a {follower: count} dict for word_pair, returning its entry.
+        """
+        counts = followers
+        followers = []
+        cumulative = array('Q')
+        total = 0
+        for follower, count in counts.items():
+            total += count
+            followers.append(follower)
+            cumulative.append(total)
+        entry = (followers, cumulative)
+        if self.size > 0:
+            self.entries[word_pair] = entry
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return entry
+
+    def choose(self, word_pair, load):
+        """Returns a random follower of word_pair weighted by count.
+
+        Returns None if nothing follows word_pair."""
+        followers, cumulative = self.get(word_pair, load)
+        if not followers:
+            return None
+        num = random.randint(1, cumulative[-1])
+        return followers[bisect_left(cumulative, num)]
+
+    def increment(self, word_pair, follower, count=1):
+        """Records that follower was learned after word_pair, if cached."""
+        entry = self.entries.get(word_pair)
+        if entry is None:
+            return
+        followers, cumulative = entry
+        try:
+            i = followers.index(follower)
+        except ValueError:
+            followers.append(follower)
+            cumulative.append((cumulative[-1] if cumulative else 0) + count)
+        else:
+            for j in range(i, len(cumulative)):
+                cumulative[j] += count
+
+    def discard(self, word_pairs):
+        """Forgets the given pairs, if they are cached."""
+        for word_pair in word_pairs:
+            self.entries.pop(word_pair, None)
+
+    def clear(self):
+        """Forgets every cached pair."""
+        self.entries.clear()
+
+
+class PooledReply(object):
+    __slots__ = ('words', 'pairs', 'created', 'touches')
+
+    def __init__(self, words):
+        self.words = words
+        self.pairs = set(zip(words, words[1:])) if words else set()
+        self.created = time.time()
+        # how many learned trigrams have started with a pair this reply used
+        self.touches = 0
+
+
+class ReplyPool(object):
+    """Replies generated ahead of time, ready to be sent instantly.
+
+    One reply is kept for each of the size most often seen words, plus a
+    few replies not seeded from any word, for messages the brain can't seed
+    a reply from. Each reply is used once. Replies are thrown away once
+    they are ttl seconds old, or once max_touches learned trigrams have
+    started with word pairs they use, since the brain would likely say
+    something else by then."""
+    def __init__(self, size, ttl, max_touches, fallback_size):
+        self.size = size
+        self.ttl = ttl
+        self.max_touches = max_touches
+        self.fallback_size = fallback_size
+        # seed word -> PooledReply, least recently made first
+        self.replies = OrderedDict()
+        self.fallbacks = []
+        # word pair -> the pooled replies using it
+        self.by_pair = {}
+        self.seen = Counter()
+        self.hits = 0
+        self.misses = 0
+
+    def see(self, words):
+        """Counts words seen in messages, to know which to pre-generate for.
+        """
+        self.seen.update(word.lower() for word in words)
+        if len(self.seen) > self.size * 10:
+            # forget the long tail of rare words
+            self.seen = Counter(dict(self.seen.most_common(self.size * 5)))
+
+    def touch(self, word_pairs):
+        """Records that trigrams starting with word_pairs were learned."""
+        for word_pair in word_pairs:
+            for reply in self.by_pair.get(word_pair, ()):
+                reply.touches += 1
+
+    def _is_stale(self, reply):
+        return time.time() - reply.created > self.ttl or \
+            reply.touches >= self.max_touches
+
+    def _forget(self, reply):
+        for word_pair in reply.pairs:
+            replies = self.by_pair.get(word_pair)
+            if replies is not None:
+                replies.discard(reply)
+                if not replies:
+                    del self.by_pair[word_pair]
+
+    def _add(self, words):
+        reply = PooledReply(words)
+        for word_pair in reply.pairs:
+            self.by_pair.setdefault(word_pair, set()).add(reply)
+        return reply
+
+    def _take(self, reply):
+        if reply is None:
+            return None
+        self._forget(reply)
+        if self._is_stale(reply):
+            return None
+        return reply.words
+
+    def take(self, words):
+        """Returns the words of a pooled reply seeded from one of words, in
+        random order, or None. The reply won't be given out again."""
+        words = list(words)
+        random.shuffle(words)
+        for word in words:
+            reply = self._take(self.replies.pop(word.lower(), None))
+            if reply:
+                self.hits += 1
+                return reply
+        self.misses += 1
+        return None
+
+    def take_fallback(self):
+        """Returns the words of a pooled unseeded reply, or None."""
+        while self.fallbacks:
+            reply = self._take(self.fallbacks.pop())
+            if reply:
+                return reply
+        return None
+
+    def refill(self, generate, budget):
+        """Pre-generates at most budget replies, most wanted first.
+
+        generate(word) returns the words of a reply seeded from word, or of
+        an unseeded reply if word is None; or None if it can't."""
+        for word, reply in list(self.replies.items()):
+            if self._is_stale(reply):
+                self._forget(reply)
+                del self.replies[word]
+        for reply in self.fallbacks:
+            if self._is_stale(reply):
+                self._forget(reply)
+        self.fallbacks = [reply for reply in self.fallbacks
+                          if not self._is_stale(reply)]
+
+        made = 0
+        for word, _ in self.seen.most_common(self.size):
+            if made >= budget:
+                return
+            if word not in self.replies:
+                # a word that can't seed a reply is pooled too, with no
+                # words, so it isn't retried until its entry goes stale
+                self.replies[word] = self._add(generate(word))
+                made += 1
+                if len(self.replies) > self.size:
+                    self._forget(self.replies.popitem(last=False)[1])
+        while made < budget and len(self.fallbacks) < self.fallback_size:
+            self.fallbacks.append(self._add(generate(None)))
+            made += 1
+
+    def clear(self):
+        """Throws away every pooled reply."""
+        self.replies.clear()
+        self.fallbacks = []
+        self.by_pair.clear()
+
+
+class BrainPool(object):
+    """Keeps only the size most recently used of many brains open.
+
+    open(name) is called to open a brain that isn't open. Brains are saved
+    and closed as they are evicted."""
+    def __init__(self, size, open):
+        self.size = size
+        self.open = open
+        self.brains = OrderedDict()
+        self.opened = 0
+        self.evicted = 0
+
+    def get(self, name):
+        brain = self.brains.get(name)
+        if brain is not None:
+            self.brains.move_to_end(name)
+            return brain
+        brain = self.brains[name] = self.open(name)
+        self.opened += 1
+        while len(self.brains) > max(self.size, 1):
+            _, evicted = self.brains.popitem(last=False)
+            evicted.save()
+            evicted.close()
+            self.evicted += 1
+        return brain
+
+    def save(self):
+        for brain in self.brains.values():
+            brain.save()
+
+    def close(self):
+        for brain in self.brains.values():
+            brain.save()
+            brain.close()
+        self.brains.clear()
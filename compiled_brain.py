@@ -0,0 +1,303 @@
+"""Compiles a SQLite brain into a read-only binary file that is used in place
+through mmap.
+
+The file is a header followed by flat arrays:
+
+- the vocabulary, sorted, as an offset table into one blob of UTF-8 text
+- word ids ordered by their lowercase form, for case-insensitive seeding
+- the distinct word pairs, sorted, as parallel first/second word id arrays,
+  plus where each pair's followers start
+- pair indexes ordered by second word, for seeding on the second word
+- follower word ids, with a running total of counts over the whole file
+
+Lookups are binary searches over these arrays, so opening a compiled brain
+is instant and processes using the same file share its pages.
+"""
+import argparse
+import mmap
+import os
+import random
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+
+MAGIC = b'MKVBRAIN'
+VERSION = 1
+# magic, version, byte order, word count, pair count, trigram count,
+# vocabulary blob length
+HEADER = struct.Struct('<8sII4Q')
+BYTE_ORDERS = {'little': 0, 'big': 1}
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def _sections(num_words, num_pairs, num_trigrams, blob_length):
+    """Returns the (name, typecode, length) of each section, in file order."""
+    return [
+        ('word_offsets', 'Q', num_words + 1),
+        ('word_blob', 'B', blob_length),
+        ('lower_order', 'I', num_words),
+        ('pair_w1', 'I', num_pairs),
+        ('pair_w2', 'I', num_pairs),
+        ('pair_start', 'Q', num_pairs + 1),
+        ('by_w2', 'I', num_pairs),
+        ('follower_ids', 'I', num_trigrams),
+        ('cumulative', 'Q', num_trigrams),
+    ]
+
+
+def compile_brain(brain, path):
+    """Writes the contents of a brain to path, compiled.
+
+    brain can be a MarkovDatabaseBrain or a database.ReadOnlyBrain."""
+    words = sorted(brain.iter_words())
+    ids = {word: i for i, word in enumerate(words)}
+
+    word_offsets = array('Q', [0])
+    blob = bytearray()
+    for word in words:
+        blob += word.encode('utf-8')
+        word_offsets.append(len(blob))
+    lower_order = array('I', sorted(
+        range(len(words)), key=lambda i: (words[i].lower(), i)))
+
+    pair_w1 = array('I')
+    pair_w2 = array('I')
+    pair_start = array('Q')
+    follower_ids = array('I')
+    cumulative = array('Q')
+    total = 0
+    pair = None
+    for word1, word2, follower, count in brain.iter_trigrams(ordered=True):
+        if (word1, word2) != pair:
+            pair = (word1, word2)
+            pair_w1.append(ids[word1])
+            pair_w2.append(ids[word2])
+            pair_start.append(len(follower_ids))
+        total += count
+        follower_ids.append(ids[follower])
+        cumulative.append(total)
+    pair_start.append(len(follower_ids))
+    by_w2 = array('I', sorted(
+        range(len(pair_w1)), key=lambda p: (pair_w2[p], pair_w1[p])))
+
+    arrays = {
+        'word_offsets': word_offsets, 'word_blob': blob,
+        'lower_order': lower_order, 'pair_w1': pair_w1, 'pair_w2': pair_w2,
+        'pair_start': pair_start, 'by_w2': by_w2,
+        'follower_ids': follower_ids, 'cumulative': cumulative,
+    }
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as out:
+        out.write(HEADER.pack(
+            MAGIC, VERSION, BYTE_ORDERS[sys.byteorder], len(words),
+            len(pair_w1), len(follower_ids), len(blob)))
+        for name, _, _ in _sections(
+                len(words), len(pair_w1), len(follower_ids), len(blob)):
+            out.write(b'\0' * (_align(out.tell()) - out.tell()))
+            out.write(bytes(arrays[name]))
+    os.replace(temp_path, path)
+
+
+class CompiledBrain(object):
+    """A read-only markov brain backed by a memory-mapped compiled file.
+
+    Offers the same lookups as MarkovDatabaseBrain, plus id-based ones that
+    let a reply be generated without creating a string per step."""
+    def __init__(self, path):
+        with open(path, 'rb') as brain_file:
+            self.mmap = mmap.mmap(
+                brain_file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, byte_order, self.num_words, self.num_pairs,
+         self.num_trigrams, blob_length) = HEADER.unpack_from(self.mmap)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a compiled brain" % path)
+        if byte_order != BYTE_ORDERS[sys.byteorder]:
+            raise ValueError("%s was compiled on a machine with a different "
+                             "byte order" % path)
+
+        self.view = memoryview(self.mmap)
+        self.sections = []
+        offset = HEADER.size
+        for name, typecode, length in _sections(
+                self.num_words, self.num_pairs, self.num_trigrams,
+                blob_length):
+            offset = _align(offset)
+            size = length * array(typecode).itemsize
+            setattr(self, name,
+                    self.view[offset:offset + size].cast(typecode))
+            self.sections.append(name)
+            offset += size
+
+    def _bisect(self, lo, hi, key, target):
+        """Returns the first index in [lo, hi) where key(index) >= target."""
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def word(self, word_id):
+        """Returns the text of the word with the given id."""
+        return str(self.word_blob[self.word_offsets[word_id]:
+                                  self.word_offsets[word_id + 1]], 'utf-8')
+
+    def word_id(self, word):
+        """Returns the id of word, or None if the brain doesn't know it."""
+        i = self._bisect(0, self.num_words, self.word, word)
+        if i < self.num_words and self.word(i) == word:
+            return i
+        return None
+
+    def word_ids_ignoring_case(self, word):
+        """Returns the ids of every word that lowercases to word.lower()."""
+        word = word.lower()
+
+        def lower_word(i):
+            return self.word(self.lower_order[i]).lower()
+        lo = self._bisect(0, self.num_words, lower_word, word)
+        ids = []
+        while lo < self.num_words and lower_word(lo) == word:
+            ids.append(self.lower_order[lo])
+            lo += 1
+        return ids
+
+    def pair_index(self, word1_id, word2_id):
+        """Returns the index of the given pair of word ids, or None."""
+        lo = bisect_left(self.pair_w1, word1_id)
+        hi = bisect_right(self.pair_w1, word1_id, lo)
+        i = bisect_left(self.pair_w2, word2_id, lo, hi)
+        if i < hi and self.pair_w2[i] == word2_id:
+            return i
+        return None
+
+    def choose_follower(self, pair):
+        """Returns the id of a follower of pair, weighted by count."""
+        start = self.pair_start[pair]
+        end = self.pair_start[pair + 1]
+        before = self.cumulative[start - 1] if start else 0
+        num = random.randint(before + 1, self.cumulative[end - 1])
+        return self.follower_ids[bisect_left(self.cumulative, num, start, end)]
+
+    def _pair_words(self, pair):
+        return (self.word(self.pair_w1[pair]), self.word(self.pair_w2[pair]))
+
+    def _pair_ranges_containing(self, word):
+        """Returns the spans of pairs containing word in any case.
+
+        Each span is (lo, hi, by_w2): a range of pair indexes, or of
+        positions in by_w2 if by_w2 is true."""
+        def second_word(i):
+            return self.pair_w2[self.by_w2[i]]
+
+        ranges = []
+        for word_id in self.word_ids_ignoring_case(word):
+            lo = bisect_left(self.pair_w1, word_id)
+            hi = bisect_right(self.pair_w1, word_id, lo)
+            ranges.append((lo, hi, False))
+            lo = self._bisect(0, self.num_pairs, second_word, word_id)
+            hi = self._bisect(lo, self.num_pairs, second_word, word_id + 1)
+            ranges.append((lo, hi, True))
+        return ranges
+
+    def _pair_at(self, i, by_w2):
+        return self.by_w2[i] if by_w2 else i
+
+    def get_followers(self, word_pair):
+        word1, word2 = word_pair
+        word1_id = self.word_id(word1)
+        word2_id = self.word_id(word2)
+        pair = None
+        if word1_id is not None and word2_id is not None:
+            pair = self.pair_index(word1_id, word2_id)
+        if pair is None:
+            return {}
+        followers = {}
+        before = self.cumulative[self.pair_start[pair] - 1] \
+            if self.pair_start[pair] else 0
+        for i in range(self.pair_start[pair], self.pair_start[pair + 1]):
+            followers[self.word(self.follower_ids[i])] = \
+                self.cumulative[i] - before
+            before = self.cumulative[i]
+        return followers
+
+    def contains_pair(self, word_pair):
+        return bool(self.get_followers(word_pair))
+
+    def get_pairs_containing_word_ignoring_case(self, word):
+        pairs = set()
+        for lo, hi, by_w2 in self._pair_ranges_containing(word):
+            pairs.update(self._pair_at(i, by_w2) for i in range(lo, hi))
+        return (self._pair_words(pair) for pair in sorted(pairs))
+
+    def get_random_pairs_containing_word_ignoring_case(self, word, k=1):
+        ranges = self._pair_ranges_containing(word)
+        matches = sum(hi - lo for lo, hi, _ in ranges)
+        pairs = set()
+        for n in random.sample(range(matches), min(k, matches)):
+            for lo, hi, by_w2 in ranges:
+                if n < hi - lo:
+                    pairs.add(self._pair_at(lo + n, by_w2))
+                    break
+                n -= hi - lo
+        return [self._pair_words(pair) for pair in pairs]
+
+    def get_three_random_words(self, weighted=False):
+        assert not self.is_empty()
+
+        if weighted:
+            num = random.randint(1, self.cumulative[self.num_trigrams - 1])
+            trigram = bisect_left(self.cumulative, num)
+        else:
+            trigram = random.randrange(self.num_trigrams)
+        pair = bisect_right(self.pair_start, trigram) - 1
+        return self._pair_words(pair) + \
+            (self.word(self.follower_ids[trigram]),)
+
+    def iter_trigrams(self, ordered=False):
+        before = 0
+        for pair in range(self.num_pairs):
+            word1, word2 = self._pair_words(pair)
+            for i in range(self.pair_start[pair], self.pair_start[pair + 1]):
+                yield (word1, word2, self.word(self.follower_ids[i]),
+                       self.cumulative[i] - before)
+                before = self.cumulative[i]
+
+    def is_empty(self):
+        return self.num_trigrams == 0
+
+    def close(self):
+        """Unmaps the file. The brain must not be used afterwards."""
+        for name in self.sections:
+            getattr(self, name).release()
+        self.view.release()
+        self.mmap.close()
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description="Compiles a chatbot SQLite brain into a read-only file "
+        "for the 'compiled' backend")
+    argparser.add_argument("sqlite_brain", type=str,
+                           help="The SQLite brain to compile")
+    argparser.add_argument("compiled_brain", type=str,
+                           help="Where to put the compiled brain")
+    args = vars(argparser.parse_args())
+
+    assert os.path.exists(args['sqlite_brain'])
+    # SQLAlchemy is slow to import, and only needed to compile
+    import database
+    dbbrain = database.ReadOnlyBrain(args['sqlite_brain'])
+    try:
+        compile_brain(dbbrain, args['compiled_brain'])
+    finally:
+        dbbrain.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,57 @@
 from sqlalchemy import Column, Integer, String, Index
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import create_engine, func
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from collections import Counter
+from concurrent.futures import Future
+import logging
+import os
+import queue
 import random
+import sqlite3
+import threading
+import urllib.request
+
+import metrics
+from reservoir import Reservoir, SAMPLE_SIZE
 
 
 Base = declarative_base()
 
+# how many random row ids to try before settling for the next one along
+RANDOM_PROBES = 8
+# most pairs read from each index range when picking seeds for a word
+SEED_CANDIDATES = 32
+
+# concurrent brains read through this many read-only connections
+READER_POOL_SIZE = 4
+# at most this many writes wait for a concurrent brain's writer thread
+WRITE_QUEUE_SIZE = 1000
+# how long a connection waits for another process's write, in seconds
+BUSY_TIMEOUT = 30
+# rows fetched at a time when reading a brain read-only
+STREAM_BATCH_SIZE = 10000
+
+# WAL lets readers carry on while a write commits, and only needs to sync at
+# checkpoints; the caches keep hot pages of big brains in memory
+WRITER_PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -65536",
+    "PRAGMA mmap_size = 268435456",
+]
+READER_PRAGMAS = [
+    "PRAGMA cache_size = -16384",
+    "PRAGMA mmap_size = 268435456",
+]
+
+# the original layout: one row of text columns per trigram
+LEGACY_SCHEMA = 1
+# words are stored once in a vocabulary and trigrams refer to them by id
+VOCABULARY_SCHEMA = 2
+
 
 class MarkovEntry(Base):
     __tablename__ = 'markov'
@@ -16,19 +61,602 @@ class MarkovEntry(Base):
     follower = Column(String(255))
     count = Column(Integer, nullable=False)
     word_pair = Index("word_pair", "word1", "word2")
+    trigram = Index("trigram", "word1", "word2", "follower", unique=True)
 
 
-class MarkovDatabaseBrain(object):
-    """Stores all data for the chatbot's markov chain in a sqlite database."""
+# brains created before the trigram index existed only get it on open
+CREATE_TRIGRAM_INDEX = text(
+    "CREATE UNIQUE INDEX IF NOT EXISTS trigram "
+    "ON markov (word1, word2, follower)")
+
+# expression indexes so case-insensitive seed lookups avoid table scans
+LEGACY_SEED_INDEXES = [
+    text("CREATE INDEX IF NOT EXISTS markov_lower_word1 "
+         "ON markov (lower(word1))"),
+    text("CREATE INDEX IF NOT EXISTS markov_lower_word2 "
+         "ON markov (lower(word2))"),
+]
+
+VOCABULARY_TABLES = [
+    # only takes effect while the database is still empty; lets maintenance
+    # hand free pages back to the OS a few at a time
+    text("PRAGMA auto_vacuum = INCREMENTAL"),
+    text("CREATE TABLE IF NOT EXISTS words ("
+         "id INTEGER PRIMARY KEY, "
+         "text TEXT NOT NULL UNIQUE, "
+         "lower_text TEXT NOT NULL)"),
+    text("CREATE INDEX IF NOT EXISTS words_lower ON words (lower_text)"),
+    text("CREATE TABLE IF NOT EXISTS trigrams ("
+         "w1_id INTEGER NOT NULL, "
+         "w2_id INTEGER NOT NULL, "
+         "follower_id INTEGER NOT NULL, "
+         "count INTEGER NOT NULL, "
+         "PRIMARY KEY (w1_id, w2_id, follower_id)) WITHOUT ROWID"),
+    # the primary key covers lookups by first word; this covers the second
+    text("CREATE INDEX IF NOT EXISTS trigrams_w2 ON trigrams (w2_id, w1_id)"),
+    text("PRAGMA user_version = %d" % VOCABULARY_SCHEMA),
+]
+
+# fixed-size reservoirs of trigrams for random seeds, each in a pair of
+# tables: a reservoir of trigram occurrences, shared by both schemas, and
+# one of distinct trigrams, which the vocabulary schema needs because its
+# trigrams have no row ids to probe
+WEIGHTED = 'seed'
+UNIFORM = 'uniform'
+SAMPLE_TABLES = [
+    "CREATE TABLE IF NOT EXISTS {0}_samples ("
+    "slot INTEGER PRIMARY KEY, "
+    "word1 TEXT NOT NULL, "
+    "word2 TEXT NOT NULL, "
+    "follower TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS {0}_sampler ("
+    "id INTEGER PRIMARY KEY CHECK (id = 0), "
+    "seen INTEGER NOT NULL, "
+    "weight REAL, "
+    "next_index INTEGER)",
+]
+SAMPLE_QUERIES = {
+    'sampler_state':
+        "SELECT seen, weight, next_index FROM {0}_sampler WHERE id = 0",
+    'store_sampler_state':
+        "INSERT OR REPLACE INTO {0}_sampler (id, seen, weight, next_index) "
+        "VALUES (0, :seen, :weight, :next_index)",
+    'store_samples':
+        "INSERT OR REPLACE INTO {0}_samples (slot, word1, word2, follower) "
+        "VALUES (:slot, :word1, :word2, :follower)",
+    'sample_at':
+        "SELECT word1, word2, follower FROM {0}_samples WHERE slot = :slot",
+    # picks a slot and reads it in one statement, so both see the same
+    # committed state
+    'random_sample':
+        "SELECT word1, word2, follower FROM {0}_samples WHERE slot = ("
+        "SELECT abs(random()) % min(seen, :size) FROM {0}_sampler "
+        "WHERE id = 0)",
+    # the pairs seen most in a reservoir, which for the weighted one are
+    # about the most frequent pairs in the brain
+    'frequent_pairs':
+        "SELECT word1, word2 FROM {0}_samples GROUP BY word1, word2 "
+        "ORDER BY count(*) DESC LIMIT :limit",
+    'clear_samples': "DELETE FROM {0}_samples",
+    'clear_sampler': "DELETE FROM {0}_sampler",
+}
+
+# upserts a batch of (word1, word2, follower, count) rows into the
+# vocabulary schema, given the number of rows; qmark style, for the DB-API.
+# Each row comes back with its new count, which only equals the count added
+# if the trigram is new. The WHERE keeps the upsert from parsing as a join.
+UPSERT_RETURNING = (
+    "WITH b (word1, word2, follower, count) AS (VALUES {}) "
+    "INSERT INTO trigrams (w1_id, w2_id, follower_id, count) "
+    "SELECT w1.id, w2.id, f.id, b.count FROM b "
+    "JOIN words w1 ON w1.text = b.word1 "
+    "JOIN words w2 ON w2.text = b.word2 "
+    "JOIN words f ON f.text = b.follower WHERE true "
+    "ON CONFLICT (w1_id, w2_id, follower_id) "
+    "DO UPDATE SET count = count + excluded.count "
+    "RETURNING (SELECT text FROM words WHERE id = w1_id), "
+    "(SELECT text FROM words WHERE id = w2_id), "
+    "(SELECT text FROM words WHERE id = follower_id), count").format
+# rows per UPSERT_RETURNING statement, keeping under the 999 parameters
+# older SQLite versions allow
+UPSERT_BATCH_SIZE = 240
+
+# finds the id of a word in the vocabulary schema
+WORD_ID = "(SELECT id FROM words WHERE text = :{})".format
+
+# distinct pairs with the lowercased :word in either position, each half of
+# the union served by its own index
+LEGACY_PAIRS_CONTAINING = (
+    "SELECT word1, word2 FROM markov WHERE lower(word1) = :word "
+    "UNION "
+    "SELECT word1, word2 FROM markov WHERE lower(word2) = :word")
+VOCABULARY_PAIRS_CONTAINING = (
+    "SELECT w1_id, w2_id FROM trigrams WHERE w1_id IN "
+    "(SELECT id FROM words WHERE lower_text = :word) "
+    "UNION "
+    "SELECT w1_id, w2_id FROM trigrams WHERE w2_id IN "
+    "(SELECT id FROM words WHERE lower_text = :word)")
+
+# walks the chain from a seed pair entirely inside SQLite. Each step carries
+# a random number that picks the follower whose running count first exceeds
+# it modulo the pair's total count, i.e. a pick weighted by count. A step
+# with no followers yields NULL and ends the walk.
+CHAIN = (
+    "WITH RECURSIVE chain(n, word1, word2, r) AS ("
+    "SELECT :n, {seed1}, {seed2}, random() & 9223372036854775807 "
+    "UNION ALL "
+    "SELECT n + 1, word2, ("
+    "SELECT follower FROM ("
+    "SELECT {follower} AS follower, "
+    "sum(count) OVER (ORDER BY {follower}) AS running, "
+    "sum(count) OVER () AS total "
+    "FROM {table} WHERE {word1} = chain.word1 AND {word2} = chain.word2) "
+    "WHERE running > r % total ORDER BY running LIMIT 1), "
+    "random() & 9223372036854775807 "
+    "FROM chain WHERE n < :max_words AND word2 IS NOT NULL) "
+    "SELECT {text} FROM chain {join}"
+    "WHERE n > :n AND word2 IS NOT NULL ORDER BY n").format
+
+# the first and last key of the next :n trigrams in key order, and how many
+# there were; fewer than :n means the chunk reaches the end of the brain
+CHUNK = (
+    "SELECT min(k), max(k), count(*) FROM ("
+    "SELECT {key} AS k FROM {table} {where} ORDER BY {key} LIMIT :n)").format
+
+# a random number in [0, 1), so that adding it before rounding down rounds
+# up with a probability equal to the fraction, keeping expected counts
+RANDOM_FRACTION = "(random() & 4294967295) / 4294967296.0"
+
+# where background maintenance carries on from, which is the first word of
+# the last trigram it went through or NULL at the start of a pass
+MAINTENANCE_TABLE = text(
+    "CREATE TABLE IF NOT EXISTS maintenance ("
+    "id INTEGER PRIMARY KEY CHECK (id = 0), "
+    "after)")
+MAINTENANCE_QUERIES = {
+    'maintenance_after': "SELECT after FROM maintenance WHERE id = 0",
+    'store_maintenance_after':
+        "INSERT OR REPLACE INTO maintenance (id, after) VALUES (0, :after)",
+}
+
+QUERIES = {
+    LEGACY_SCHEMA: {
+        'upsert': [
+            "INSERT INTO markov (word1, word2, follower, count) "
+            "VALUES (:word1, :word2, :follower, :count) "
+            "ON CONFLICT (word1, word2, follower) "
+            "DO UPDATE SET count = count + excluded.count",
+        ],
+        'followers':
+            "SELECT follower, count FROM markov "
+            "WHERE word1 = :word1 AND word2 = :word2",
+        'contains_pair':
+            "SELECT 1 FROM markov "
+            "WHERE word1 = :word1 AND word2 = :word2 LIMIT 1",
+        'pairs_containing': LEGACY_PAIRS_CONTAINING,
+        # the lower() indexes end in the row id, so each word's entries can
+        # be entered at any row id
+        'first_word_bounds':
+            "SELECT (SELECT min(id) FROM markov WHERE lower(word1) = :key), "
+            "(SELECT max(id) FROM markov WHERE lower(word1) = :key)",
+        'first_word_pairs':
+            "SELECT DISTINCT word1, word2 FROM markov "
+            "WHERE lower(word1) = :key AND id >= :start ORDER BY id LIMIT :n",
+        'second_word_bounds':
+            "SELECT (SELECT min(id) FROM markov WHERE lower(word2) = :key), "
+            "(SELECT max(id) FROM markov WHERE lower(word2) = :key)",
+        'second_word_pairs':
+            "SELECT DISTINCT word1, word2 FROM markov "
+            "WHERE lower(word2) = :key AND id >= :start ORDER BY id LIMIT :n",
+        'max_id': "SELECT max(id) FROM markov",
+        'trigram_with_id':
+            "SELECT word1, word2, follower FROM markov WHERE id = :id",
+        'trigram_after':
+            "SELECT word1, word2, follower FROM markov "
+            "WHERE id >= :id ORDER BY id LIMIT 1",
+        'any': "SELECT 1 FROM markov LIMIT 1",
+        'all': "SELECT word1, word2, follower, count FROM markov",
+        'all_ordered':
+            "SELECT word1, word2, follower, count FROM markov "
+            "ORDER BY word1, word2, follower",
+        'words':
+            "SELECT word1 FROM markov UNION SELECT word2 FROM markov "
+            "UNION SELECT follower FROM markov ORDER BY 1",
+        'chain': CHAIN(
+            seed1=':word1', seed2=':word2', table='markov',
+            word1='word1', word2='word2', follower='follower',
+            text='word2', join=''),
+        'seed_index': [
+            "SELECT count(*) FROM markov INDEXED BY markov_lower_word1",
+            "SELECT count(*) FROM markov INDEXED BY markov_lower_word2",
+        ],
+        # maintenance works on the trigrams whose first word is between
+        # :first and :last, in index order
+        'key_bounds': "SELECT min(word1), max(word1) FROM markov",
+        'first_chunk': CHUNK(key='word1', table='markov', where=''),
+        'next_chunk':
+            CHUNK(key='word1', table='markov', where='WHERE word1 > :after'),
+        'prune':
+            "DELETE FROM markov WHERE id IN (SELECT id FROM markov "
+            "WHERE word1 BETWEEN :first AND :last AND count < :min_count "
+            "LIMIT :limit)",
+        'decay':
+            "UPDATE markov SET count = CAST(count * :factor + {} AS INTEGER) "
+            "WHERE word1 BETWEEN :first AND :last".format(RANDOM_FRACTION),
+        'cap_followers':
+            "DELETE FROM markov WHERE id IN (SELECT id FROM ("
+            "SELECT id, row_number() OVER (PARTITION BY word1, word2 "
+            "ORDER BY count DESC, id) AS rank FROM markov "
+            "WHERE word1 BETWEEN :first AND :last) "
+            "WHERE rank > :max_followers)",
+    },
+    VOCABULARY_SCHEMA: {
+        'upsert': [
+            "INSERT OR IGNORE INTO words (text, lower_text) "
+            "VALUES (:word, :lower_text)",
+            "INSERT INTO trigrams (w1_id, w2_id, follower_id, count) "
+            "VALUES ({}, {}, {}, :count) "
+            "ON CONFLICT (w1_id, w2_id, follower_id) "
+            "DO UPDATE SET count = count + excluded.count".format(
+                WORD_ID('word1'), WORD_ID('word2'), WORD_ID('follower')),
+        ],
+        'followers':
+            "SELECT f.text, t.count FROM trigrams t "
+            "JOIN words f ON f.id = t.follower_id "
+            "WHERE t.w1_id = {} AND t.w2_id = {}".format(
+                WORD_ID('word1'), WORD_ID('word2')),
+        'contains_pair':
+            "SELECT 1 FROM trigrams "
+            "WHERE w1_id = {} AND w2_id = {} LIMIT 1".format(
+                WORD_ID('word1'), WORD_ID('word2')),
+        'pairs_containing':
+            "SELECT w1.text, w2.text FROM ({}) p "
+            "JOIN words w1 ON w1.id = p.w1_id "
+            "JOIN words w2 ON w2.id = p.w2_id".format(
+                VOCABULARY_PAIRS_CONTAINING),
+        'word_ids': "SELECT id FROM words WHERE lower_text = :word",
+        # the primary key covers pairs by their first word, trigrams_w2 by
+        # their second
+        'first_word_bounds':
+            "SELECT (SELECT min(w2_id) FROM trigrams WHERE w1_id = :key), "
+            "(SELECT max(w2_id) FROM trigrams WHERE w1_id = :key)",
+        'first_word_pairs':
+            "SELECT w1.text, w2.text FROM "
+            "(SELECT DISTINCT w1_id, w2_id FROM trigrams "
+            "WHERE w1_id = :key AND w2_id >= :start "
+            "ORDER BY w2_id LIMIT :n) p "
+            "JOIN words w1 ON w1.id = p.w1_id "
+            "JOIN words w2 ON w2.id = p.w2_id",
+        'second_word_bounds':
+            "SELECT (SELECT min(w1_id) FROM trigrams WHERE w2_id = :key), "
+            "(SELECT max(w1_id) FROM trigrams WHERE w2_id = :key)",
+        'second_word_pairs':
+            "SELECT w1.text, w2.text FROM "
+            "(SELECT DISTINCT w1_id, w2_id FROM trigrams "
+            "WHERE w2_id = :key AND w1_id >= :start "
+            "ORDER BY w1_id LIMIT :n) p "
+            "JOIN words w1 ON w1.id = p.w1_id "
+            "JOIN words w2 ON w2.id = p.w2_id",
+        'any': "SELECT 1 FROM trigrams LIMIT 1",
+        'all':
+            "SELECT w1.text, w2.text, f.text, t.count FROM trigrams t "
+            "JOIN words w1 ON w1.id = t.w1_id "
+            "JOIN words w2 ON w2.id = t.w2_id "
+            "JOIN words f ON f.id = t.follower_id",
+        'all_ordered':
+            "SELECT w1.text, w2.text, f.text, t.count FROM trigrams t "
+            "JOIN words w1 ON w1.id = t.w1_id "
+            "JOIN words w2 ON w2.id = t.w2_id "
+            "JOIN words f ON f.id = t.follower_id "
+            "ORDER BY w1.text, w2.text, f.text",
+        'words': "SELECT text FROM words ORDER BY text",
+        'chain': CHAIN(
+            seed1=WORD_ID('word1'), seed2=WORD_ID('word2'), table='trigrams',
+            word1='w1_id', word2='w2_id', follower='follower_id',
+            text='w.text', join='JOIN words w ON w.id = chain.word2 '),
+        'seed_index': [
+            "SELECT count(*) FROM words INDEXED BY words_lower",
+            "SELECT count(*) FROM trigrams INDEXED BY trigrams_w2",
+        ],
+        'key_bounds': "SELECT min(w1_id), max(w1_id) FROM trigrams",
+        'first_chunk': CHUNK(key='w1_id', table='trigrams', where=''),
+        'next_chunk': CHUNK(key='w1_id', table='trigrams',
+                            where='WHERE w1_id > :after'),
+        'prune':
+            "DELETE FROM trigrams WHERE (w1_id, w2_id, follower_id) IN ("
+            "SELECT w1_id, w2_id, follower_id FROM trigrams "
+            "WHERE w1_id BETWEEN :first AND :last AND count < :min_count "
+            "LIMIT :limit)",
+        'decay':
+            "UPDATE trigrams SET count = "
+            "CAST(count * :factor + {} AS INTEGER) "
+            "WHERE w1_id BETWEEN :first AND :last".format(RANDOM_FRACTION),
+        'cap_followers':
+            "DELETE FROM trigrams WHERE (w1_id, w2_id, follower_id) IN ("
+            "SELECT w1_id, w2_id, follower_id FROM ("
+            "SELECT w1_id, w2_id, follower_id, row_number() OVER ("
+            "PARTITION BY w1_id, w2_id ORDER BY count DESC, follower_id) "
+            "AS rank FROM trigrams WHERE w1_id BETWEEN :first AND :last) "
+            "WHERE rank > :max_followers)",
+        'orphan_words':
+            "DELETE FROM words WHERE id NOT IN ("
+            "SELECT w1_id FROM trigrams UNION SELECT w2_id FROM trigrams "
+            "UNION SELECT follower_id FROM trigrams)",
+    },
+}
+
+
+class BrainWriter(object):
+    """Runs every write to a brain on one background thread, in order."""
+    def __init__(self):
+        self.queue = queue.Queue(WRITE_QUEUE_SIZE)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, function, *args):
+        """Queues function(*args), returning a Future for its result.
+
+        Blocks while the queue is full, so writers can't outrun the disk."""
+        future = Future()
+        self.queue.put((future, function, args))
+        return future
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            future, function, args = item
+            try:
+                future.set_result(function(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+    def stop(self):
+        """Stops the thread once every queued write is done."""
+        self.queue.put(None)
+        self.thread.join()
+
+
+def _log_failed_write(future):
+    if future.exception() is not None:
+        logging.error("brain write failed", exc_info=future.exception())
+
+
+def _set_pragmas(connection, pragmas):
+    cursor = connection.cursor()
+    for pragma in pragmas:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+def _schema_of(tables):
+    if 'markov' in tables:
+        return LEGACY_SCHEMA
+    if 'trigrams' in tables:
+        return VOCABULARY_SCHEMA
+    return None
+
+
+def get_schema_version(session):
+    """Returns the schema version of an existing brain, or None if new."""
+    return _schema_of({row[0] for row in session.execute(
+        text("SELECT name FROM sqlite_master WHERE type = 'table'"))})
+
+
+class ReadOnlyBrain(object):
+    """Reads an existing brain through a plain read-only sqlite3 connection.
+
+    Opening a MarkovDatabaseBrain adds indexes and sampler tables to the
+    file; this never writes to it, so it suits tools that only copy a brain
+    out. Rows are fetched STREAM_BATCH_SIZE at a time."""
     def __init__(self, database_path):
-        engine = create_engine('sqlite:///' + database_path)
-        # create any missing tables
-        Base.metadata.create_all(engine)
+        uri = 'file:%s?mode=ro' % urllib.request.pathname2url(
+            os.path.abspath(database_path))
+        self.connection = sqlite3.connect(uri, uri=True)
+        self.schema_version = _schema_of({name for name, in self.connection
+            .execute("SELECT name FROM sqlite_master WHERE type = 'table'")})
+        if self.schema_version is None:
+            self.connection.close()
+            raise ValueError(database_path + " is not a brain")
+        self.queries = QUERIES[self.schema_version]
+
+    def _stream(self, name):
+        cursor = self.connection.execute(self.queries[name])
+        while True:
+            rows = cursor.fetchmany(STREAM_BATCH_SIZE)
+            if not rows:
+                break
+            yield from rows
+
+    def iter_trigrams(self, ordered=False):
+        """Yields every (word1, word2, follower, count), like
+        MarkovDatabaseBrain.iter_trigrams."""
+        return self._stream('all_ordered' if ordered else 'all')
+
+    def iter_words(self):
+        """Yields every word in the brain, in sorted order."""
+        for word, in self._stream('words'):
+            yield word
+
+    def close(self):
+        self.connection.close()
+
+
+class MarkovDatabaseBrain(object):
+    """Stores all data for the chatbot's markov chain in a sqlite database.
+
+    Existing brains are opened in whichever schema they were created with;
+    new brains use schema_version.
+
+    A concurrent brain is switched to WAL mode. Its lookups go through a pool
+    of read-only connections, while adds and saves are handed to a single
+    writer thread, so replies never wait on a commit and other processes
+    (like offline training) can write to the brain while it's in use. Its
+    lookups only see what has been saved."""
+    def __init__(self, database_path, schema_version=VOCABULARY_SCHEMA,
+                 concurrent=False):
+        # the asyncio bot uses the brain from a worker thread, one thread at
+        # a time
+        engine = create_engine(
+            'sqlite:///' + database_path,
+            connect_args={'check_same_thread': False,
+                          'timeout': BUSY_TIMEOUT})
+        if concurrent:
+            event.listen(engine, 'connect', lambda connection, record:
+                         _set_pragmas(connection, WRITER_PRAGMAS))
         Session = sessionmaker(bind=engine)
+        self.engine = engine
         self.session = Session()
+        self.schema_version = get_schema_version(self.session) \
+            or schema_version
+        # create any missing tables
+        if self.schema_version == LEGACY_SCHEMA:
+            Base.metadata.create_all(engine)
+            self.can_upsert = self._ensure_trigram_index()
+            for statement in LEGACY_SEED_INDEXES:
+                self.session.execute(statement)
+            self.session.commit()
+        else:
+            for statement in VOCABULARY_TABLES:
+                self.session.execute(statement)
+            self.session.commit()
+            self.can_upsert = True
+        self.queries = {
+            name: [text(q) for q in query] if isinstance(query, list)
+            else text(query)
+            for name, query in QUERIES[self.schema_version].items()}
+        # the kinds of reservoir this brain keeps
+        self.sample_kinds = [WEIGHTED] if \
+            self.schema_version == LEGACY_SCHEMA else [WEIGHTED, UNIFORM]
+        for kind in self.sample_kinds:
+            for statement in SAMPLE_TABLES:
+                self.session.execute(text(statement.format(kind)))
+            for name, query in SAMPLE_QUERIES.items():
+                self.queries[kind + '_' + name] = text(query.format(kind))
+        self.session.execute(MAINTENANCE_TABLE)
+        for name, query in MAINTENANCE_QUERIES.items():
+            self.queries[name] = text(query)
+        self.session.commit()
+        self.empty = self._execute('any').first() is None
+        self.samplers = {kind: self._load_sampler(kind)
+                         for kind in self.sample_kinds}
+        # set when maintenance has removed trigrams from under the
+        # reservoirs, and when a maintenance chunk reaches the end of a pass
+        self.samples_stale = False
+        self.pass_ending = False
+        self.readers = None
+        self.writer = None
+        self.uri = 'file:%s?mode=ro' % urllib.request.pathname2url(
+            os.path.abspath(database_path))
+        if concurrent:
+            self.session.commit()
+
+            def connect_reader():
+                connection = sqlite3.connect(
+                    self.uri, uri=True, check_same_thread=False,
+                    timeout=BUSY_TIMEOUT)
+                _set_pragmas(connection, READER_PRAGMAS)
+                return connection
+            self.readers = create_engine(
+                'sqlite://', creator=connect_reader, poolclass=QueuePool,
+                pool_size=READER_POOL_SIZE)
+            self.writer = BrainWriter()
+
+    def _load_sampler(self, kind):
+        """Returns the given kind of reservoir, or None if it must be built.
+
+        Brains from before the reservoir existed get theirs filled from the
+        whole brain the first time a random seed needs it."""
+        state = self._execute(kind + '_sampler_state').first()
+        if state is not None:
+            return Reservoir(SAMPLE_SIZE, *state)
+        if self.empty:
+            return Reservoir(SAMPLE_SIZE)
+        return None
+
+    def _sample(self, counts, kind):
+        """Feeds ((word1, word2, follower), count) pairs to the given kind of
+        reservoir, if it has been built."""
+        sampler = self.samplers[kind]
+        if sampler is None:
+            return
+        samples = {}
+        for trigram, count in counts:
+            for slot in sampler.offer(count):
+                samples[slot] = trigram
+        self._store_samples(kind, samples)
+
+    def _store_samples(self, kind, samples):
+        """Stores a {slot: (word1, word2, follower)} mapping."""
+        if samples:
+            self.session.execute(self.queries[kind + '_store_samples'], [
+                {'slot': slot, 'word1': word1, 'word2': word2,
+                 'follower': follower}
+                for slot, (word1, word2, follower) in samples.items()])
+
+    def _ensure_trigram_index(self):
+        """Makes sure the unique trigram index exists.
+
+        Returns whether it does; brains with duplicate trigrams can't have it
+        and are limited to the per-row path."""
+        try:
+            self.session.execute(CREATE_TRIGRAM_INDEX)
+            self.session.commit()
+            return True
+        except IntegrityError:
+            self.session.rollback()
+            logging.warning("brain contains duplicate trigrams; "
+                            "falling back to per-row updates")
+            return False
+
+    def _execute(self, name, **params):
+        # raw statements don't autoflush like ORM queries do
+        self.session.flush()
+        return self.session.execute(self.queries[name], params)
+
+    def _read(self, name, **params):
+        """Runs a lookup, returning all of its rows."""
+        with metrics.timer('chatbot_brain_query_seconds', query=name):
+            if self.readers is None:
+                return self._execute(name, **params).fetchall()
+            with self.readers.connect() as connection:
+                return connection.execute(
+                    self.queries[name], params).fetchall()
+
+    def _stream(self, name):
+        """Runs a lookup, yielding its rows as they are read."""
+        if self.readers is None:
+            for row in self._execute(name):
+                yield row
+            return
+        with self.readers.connect() as connection:
+            for row in connection.execute(self.queries[name]):
+                yield row
+
+    def _write(self, function, *args, wait=False):
+        """Calls function(*args), on the writer thread if there is one.
+
+        Unless wait is set, a concurrent brain returns before the write is
+        done and only logs it if it fails."""
+        if self.writer is None:
+            return function(*args)
+        future = self.writer.submit(function, *args)
+        if wait:
+            return future.result()
+        future.add_done_callback(_log_failed_write)
 
     def add(self, word_pair, follower, count=1, check_existing=True):
+        self._write(self._add, word_pair, follower, count, check_existing)
+
+    def _add(self, word_pair, follower, count, check_existing):
         word1, word2 = word_pair
+        if self.schema_version != LEGACY_SCHEMA:
+            # there is no ORM model for the vocabulary schema
+            self._upsert({(word1, word2, follower): count})
+            return
+        self._mark_not_empty()
+        self._sample([((word1, word2, follower), count)], WEIGHTED)
         entry = check_existing and self.session.query(MarkovEntry) \
             .filter_by(word1=word1, word2=word2, follower=follower) \
             .one_or_none()
@@ -39,37 +667,415 @@ class MarkovDatabaseBrain(object):
                 word1=word1, word2=word2, follower=follower, count=count)
             self.session.add(new_entry)
 
+    def add_many(self, entries, upsert=True):
+        """Adds many (word1, word2, follower, count) entries at once.
+
+        Counts for repeated trigrams are summed in memory first, then applied
+        with a single set-based upsert. Passing upsert=False uses the per-row
+        `add` path instead, which is much slower."""
+        counts = Counter()
+        for word1, word2, follower, count in entries:
+            counts[(word1, word2, follower)] += count
+        if not counts:
+            return
+
+        if not (upsert and self.can_upsert):
+            for (word1, word2, follower), count in counts.items():
+                self.add((word1, word2), follower, count=count)
+            return
+
+        self._write(self._upsert, counts)
+
+    def _upsert(self, counts):
+        """Applies a {(word1, word2, follower): count} mapping."""
+        # the upsert bypasses the ORM, so push out any pending entries first
+        # and make sure no stale counts stay in the identity map afterwards
+        self.session.flush()
+        rows = [{'word1': word1, 'word2': word2, 'follower': follower,
+                 'count': count}
+                for (word1, word2, follower), count in counts.items()]
+        if self.schema_version == VOCABULARY_SCHEMA:
+            words = set()
+            for word1, word2, follower in counts:
+                words.update((word1, word2, follower))
+            add_words, add_trigrams = self.queries['upsert']
+            self.session.execute(add_words, [
+                {'word': word, 'lower_text': word.lower()} for word in words])
+            if self.samplers[UNIFORM] is None:
+                self.session.execute(add_trigrams, rows)
+            else:
+                # the uniform reservoir needs to know which trigrams are new
+                new = self._upsert_returning_new(counts)
+                self._sample(((trigram, 1) for trigram in new), UNIFORM)
+        else:
+            self.session.execute(self.queries['upsert'][0], rows)
+        self.session.expire_all()
+        self._mark_not_empty()
+        self._sample(counts.items(), WEIGHTED)
+
+    def _upsert_returning_new(self, counts):
+        """Applies a {(word1, word2, follower): count} mapping to the
+        vocabulary schema, whose words must already be stored, returning
+        the trigrams that weren't in the brain before."""
+        # straight through the DB-API, as the statement depends on the size
+        # of each batch
+        cursor = self.session.connection().connection.cursor()
+        items = list(counts.items())
+        new = []
+        for i in range(0, len(items), UPSERT_BATCH_SIZE):
+            batch = items[i:i + UPSERT_BATCH_SIZE]
+            cursor.execute(
+                UPSERT_RETURNING(', '.join(['(?, ?, ?, ?)'] * len(batch))),
+                [value for trigram, count in batch
+                 for value in trigram + (count,)])
+            new.extend((word1, word2, follower)
+                       for word1, word2, follower, count in cursor.fetchall()
+                       if count == counts[(word1, word2, follower)])
+        cursor.close()
+        return new
+
+    def _mark_not_empty(self):
+        # readers of a concurrent brain can't see this until it's saved;
+        # is_empty checks for them
+        if self.readers is None:
+            self.empty = False
+
     def get_followers(self, word_pair):
         word1, word2 = word_pair
-        entries = self.session.query(MarkovEntry) \
-            .filter_by(word1=word1, word2=word2)
-        return {entry.follower: entry.count for entry in entries}
+        entries = self._read('followers', word1=word1, word2=word2)
+        return {follower: count for follower, count in entries}
 
     def contains_pair(self, word_pair):
         word1, word2 = word_pair
-        return bool(self.session.query(MarkovEntry)
-                    .filter_by(word1=word1, word2=word2)
-                    .first())
+        return bool(self._read('contains_pair', word1=word1, word2=word2))
 
     def get_pairs_containing_word_ignoring_case(self, word):
+        """Returns the distinct word pairs containing word in any case."""
+        entries = self._read('pairs_containing', word=word.lower())
+        return ((word1, word2) for word1, word2 in entries)
+
+    def get_random_pairs_containing_word_ignoring_case(self, word, k=1):
+        """Returns up to k random distinct pairs containing word in any case.
+
+        Rather than sorting every match, each index range holding word is
+        entered at a random key and read for at most SEED_CANDIDATES pairs,
+        wrapping around at its end, so a lookup costs a few index seeks
+        however common word is. Words with fewer matches than that are
+        sampled exactly uniformly."""
         word = word.lower()
-        entries = self.session.query(MarkovEntry)\
-            .filter((func.lower(MarkovEntry.word1) == word) |
-                    (func.lower(MarkovEntry.word2) == word))\
-            .distinct(MarkovEntry.word_pair)
-        return ((entry.word1, entry.word2) for entry in entries)
+        if self.schema_version == LEGACY_SCHEMA:
+            keys = [word]
+        else:
+            keys = [key for key, in self._read('word_ids', word=word)]
+        candidates = set()
+        for key in keys:
+            for position in ('first', 'second'):
+                candidates.update(self._probe_pairs(position, key))
+        return random.sample(list(candidates), min(k, len(candidates)))
+
+    def _probe_pairs(self, position, key):
+        """Returns up to SEED_CANDIDATES pairs with key as their first or
+        second word, starting from a random point in their index range."""
+        low, high = self._read(position + '_word_bounds', key=key)[0]
+        if low is None:
+            return []
+        pairs = self._read(position + '_word_pairs', key=key,
+                           start=random.randint(low, high),
+                           n=SEED_CANDIDATES)
+        if len(pairs) < SEED_CANDIDATES:
+            # wrap around to the start of the range
+            pairs += self._read(position + '_word_pairs', key=key,
+                                start=low, n=SEED_CANDIDATES - len(pairs))
+        return [(word1, word2) for word1, word2 in pairs]
 
-    def get_three_random_words(self):
+    def get_three_random_words(self, weighted=False):
+        """Returns a random trigram.
+
+        By default every stored trigram is equally likely; with weighted=True
+        trigrams are picked in proportion to their counts. Either way this
+        costs a few index lookups, not a table scan. Legacy brains probe
+        random row ids; otherwise the trigram comes from a reservoir sample.
+        """
         assert not self.is_empty()
 
-        query = self.session.query(MarkovEntry)
-        count = int(query.count())
-        entry = query.offset(int(count * random.random())).first()
-        return (entry.word1, entry.word2, entry.follower)
+        if weighted:
+            return self._get_sampled_trigram(WEIGHTED)
+        if self.schema_version != LEGACY_SCHEMA:
+            return self._get_sampled_trigram(UNIFORM)
+
+        max_id = self._read('max_id')[0][0]
+        # row ids have gaps where trigrams were removed; retry on a miss
+        for _ in range(RANDOM_PROBES):
+            entries = self._read(
+                'trigram_with_id', id=random.randint(1, max_id))
+            if entries:
+                return tuple(entries[0])
+        entries = self._read('trigram_after', id=random.randint(1, max_id))
+        if not entries:
+            # the probe landed past the last trigram; wrap around
+            entries = self._read('trigram_after', id=0)
+        return tuple(entries[0])
+
+    def _get_sampled_trigram(self, kind):
+        if self.samplers[kind] is None:
+            self._write(self._fill_samplers, wait=True)
+        if self.readers is None:
+            sampler = self.samplers[kind]
+            slot = random.randrange(min(sampler.seen, sampler.size))
+            entries = self._read(kind + '_sample_at', slot=slot)
+        else:
+            # the reservoir in memory runs ahead of what readers can see
+            entries = self._read(kind + '_random_sample', size=SAMPLE_SIZE)
+            if not entries:
+                # the reservoir hasn't been saved yet
+                self._write(self._fill_samplers, wait=True)
+                entries = self._read(kind + '_random_sample',
+                                     size=SAMPLE_SIZE)
+        word1, word2, follower = entries[0]
+        return (word1, word2, follower)
+
+    def _fill_samplers(self):
+        """Builds every kind of reservoir from a scan of the whole brain."""
+        samplers = {kind: Reservoir(SAMPLE_SIZE)
+                    for kind in self.sample_kinds}
+        samples = {kind: {} for kind in self.sample_kinds}
+        for word1, word2, follower, count in self._execute('all'):
+            for kind, sampler in samplers.items():
+                # the uniform reservoir counts each trigram once
+                for slot in sampler.offer(count if kind == WEIGHTED else 1):
+                    samples[kind][slot] = (word1, word2, follower)
+        for kind in self.sample_kinds:
+            self._execute(kind + '_clear_samples')
+            self._store_samples(kind, samples[kind])
+        self.samplers = samplers
+        if self.readers is not None:
+            self._save()
+
+    def generate_chain(self, seed, max_words):
+        """Extends the seed words into a chain of up to max_words words.
+
+        This is the same walk MarkovBackend.reply does a word at a time, done
+        as one recursive query."""
+        words = list(seed)
+        entries = self._read(
+            'chain', word1=words[-2], word2=words[-1], n=len(words),
+            max_words=max_words)
+        words.extend(word for word, in entries)
+        return words
+
+    def warm_up(self, num_pairs):
+        """Reads the followers of up to num_pairs of the most frequent word
+        pairs, going by the seed reservoir, and the seed indexes, so they
+        are in the OS page cache before the first replies need them.
+
+        Returns those followers, as {pair: {follower: count}}. Only what has
+        been saved is seen. This uses a read-only connection of its own, so
+        it can run in another thread while the brain is in use. Every read
+        is short, except for the seed index scans, which are only done in
+        WAL mode, where they can't hold up saves."""
+        queries = QUERIES[self.schema_version]
+        connection = sqlite3.connect(self.uri, uri=True, timeout=BUSY_TIMEOUT)
+        try:
+            pairs = connection.execute(
+                SAMPLE_QUERIES['frequent_pairs'].format(WEIGHTED),
+                {'limit': num_pairs}).fetchall()
+            followers = {(word1, word2): dict(connection.execute(
+                queries['followers'], {'word1': word1, 'word2': word2}))
+                for word1, word2 in pairs}
+            wal = connection.execute(
+                "PRAGMA journal_mode").fetchone()[0] == 'wal'
+            if wal:
+                for statement in queries['seed_index']:
+                    connection.execute(statement).fetchall()
+            return followers
+        finally:
+            connection.close()
+
+    def iter_trigrams(self, ordered=False):
+        """Yields every (word1, word2, follower, count) in the brain.
+
+        Rows are streamed from the database rather than loaded at once. With
+        ordered=True they come sorted by their words, compared as UTF-8
+        bytes (which is also the order Python sorts strings in)."""
+        entries = self._stream('all_ordered' if ordered else 'all')
+        for word1, word2, follower, count in entries:
+            yield (word1, word2, follower, count)
+
+    def iter_words(self):
+        """Yields every word in the brain, in sorted order."""
+        for word, in self._stream('words'):
+            yield word
 
     def is_empty(self):
-        query = self.session.query(MarkovEntry)
-        return query.first() is None
+        if self.empty and self.readers is not None:
+            self.empty = not self._read('any')
+        return self.empty
 
     def save(self):
+        self._write(self._save, wait=True)
+
+    def _save(self):
+        for kind, sampler in self.samplers.items():
+            if sampler is not None:
+                self._execute(kind + '_store_sampler_state',
+                              seen=sampler.seen, weight=sampler.weight,
+                              next_index=sampler.next_index)
+        with metrics.timer('chatbot_brain_commit_seconds'):
+            self.session.commit()
+
+    def prune(self, min_count, limit=None, key_range=None):
+        """Removes up to limit trigrams seen fewer than min_count times.
+
+        key_range limits this to the chunk given by next_key_range. Returns
+        how many were removed."""
+        return self._write(self._maintain, [
+            ('prune', {'min_count': min_count,
+                       'limit': -1 if limit is None else limit})],
+            key_range, wait=True)
+
+    def decay(self, factor, key_range=None):
+        """Multiplies every count by factor, rounding up or down at random
+        in proportion to the fraction, so counts keep their expected value.
+
+        Trigrams whose counts reach zero are removed; returns how many."""
+        return self._write(self._maintain, [
+            ('decay', {'factor': factor}),
+            ('prune', {'min_count': 1, 'limit': -1})], key_range, wait=True)
+
+    def cap_followers(self, max_followers, key_range=None):
+        """Keeps only the max_followers most common followers of each pair.
+
+        Returns how many trigrams were removed."""
+        return self._write(self._maintain, [
+            ('cap_followers', {'max_followers': max_followers})],
+            key_range, wait=True)
+
+    def next_key_range(self, size):
+        """Returns the (first, last) keys of the next chunk of about size
+        trigrams for maintenance to work on, or None if the brain is empty.
+
+        Chunks hold whole word pairs and follow on from the last one, across
+        restarts, wrapping around at the end of the brain. Call end_chunk
+        once the chunk is done."""
+        return self._write(self._next_key_range, size, wait=True)
+
+    def _next_key_range(self, size):
+        after = self._execute('maintenance_after').scalar()
+        if after is None:
+            first, last, count = self._execute('first_chunk', n=size).first()
+        else:
+            first, last, count = self._execute(
+                'next_chunk', after=after, n=size).first()
+            if first is None:
+                # the rest of the brain was removed since the last chunk
+                first, last, count = self._execute(
+                    'first_chunk', n=size).first()
+        # a short chunk reaches the end of the brain, ending the pass
+        self.pass_ending = count < size
+        self._execute('store_maintenance_after',
+                      after=None if self.pass_ending else last)
         self.session.commit()
+        return None if first is None else (first, last)
+
+    def end_chunk(self):
+        """Finishes the chunk next_key_range returned. At the end of a pass
+        this removes words no longer used and rebuilds the seed reservoirs
+        if trigrams were removed, so both cost one scan per pass."""
+        if self.pass_ending:
+            self._write(self._resample, wait=True)
+
+    def _maintain(self, statements, key_range):
+        """Runs maintenance statements over the trigrams in key_range, or
+        all of them, and commits, returning how many rows the last one
+        removed.
+
+        Removing trigrams makes the seed reservoirs stale; they are rebuilt
+        by resample, or by end_chunk at the end of a pass. Decay alone
+        leaves them be, as it scales every count alike."""
+        whole = key_range is None
+        if whole:
+            key_range = self._execute('key_bounds').first()
+            if key_range[0] is None:
+                return 0
+        first, last = key_range
+        for name, params in statements:
+            removed = self._execute(
+                name, first=first, last=last, **params).rowcount
+        if removed:
+            self.samples_stale = True
+            if whole and self.schema_version == VOCABULARY_SCHEMA:
+                self._execute('orphan_words')
+        self.session.commit()
+        self.empty = self._execute('any').first() is None
+        return removed
+
+    def resample(self):
+        """Rebuilds the seed reservoirs if maintenance made them stale."""
+        if self.samples_stale:
+            self._write(self._resample, wait=True)
+
+    def _resample(self):
+        if self.pass_ending and self.schema_version == VOCABULARY_SCHEMA:
+            self._execute('orphan_words')
+        if self.samples_stale:
+            self._fill_samplers()
+            self.samples_stale = False
+        self.pass_ending = False
+        self.session.commit()
+
+    def size(self):
+        """Returns (bytes used by the database file, bytes of it unused)."""
+        page_size = self.session.execute(text("PRAGMA page_size")).scalar()
+        pages = self.session.execute(text("PRAGMA page_count")).scalar()
+        free = self.session.execute(text("PRAGMA freelist_count")).scalar()
+        return pages * page_size, free * page_size
+
+    def vacuum(self, pages=None, full=False):
+        """Gives up to pages unused pages (or all of them) back to the OS.
+
+        Brains created before incremental vacuuming can only be shrunk by
+        a full vacuum, which rewrites the whole file and converts it; that
+        only happens if full is set. Returns the bytes reclaimed."""
+        return self._write(self._vacuum, pages, full, wait=True)
+
+    def _vacuum(self, pages, full):
+        self.session.commit()
+        before, _ = self.size()
+        self.session.commit()
+        # VACUUM can't run inside a transaction, so use a bare connection
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            incremental = cursor.execute(
+                "PRAGMA auto_vacuum").fetchone()[0] == 2
+            if full:
+                cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                cursor.execute("VACUUM")
+            elif incremental:
+                # Python's sqlite3 steps statements without results only
+                # once, and each step frees one page
+                free = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+                cursor.execute("BEGIN")
+                for _ in range(min(pages or free, free)):
+                    cursor.execute("PRAGMA incremental_vacuum(1)")
+                cursor.execute("COMMIT")
+            else:
+                logging.info("brain needs a full vacuum to be shrunk")
+            cursor.close()
+        finally:
+            connection.close()
+        after, _ = self.size()
+        self.session.commit()
+        return before - after
+
+    def close(self):
+        """Finishes any queued writes and closes the database.
+
+        Anything that wasn't saved is lost."""
+        if self.writer is not None:
+            self.writer.stop()
+            self.writer = None
+        self.session.close()
+        self.engine.dispose()
+        if self.readers is not None:
+            self.readers.dispose()
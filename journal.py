@@ -0,0 +1,49 @@
+"""Append-only journal of learned messages that haven't been committed yet."""
+import json
+import logging
+import os
+
+
+class Journal(object):
+    """Keeps a copy of every message learned since the brain's last commit.
+
+    Each message is written as one line of JSON and flushed to the OS right
+    away, so it survives the bot being killed. After the brain commits, the
+    journal is truncated; on startup, whatever is left in it was never
+    committed and is learned again.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def extend(self, lines):
+        """Records that each of lines was learned."""
+        if self.file is None:
+            self.file = open(self.path, 'a', encoding='utf-8')
+        self.file.writelines(json.dumps(line) + '\n' for line in lines)
+        self.file.flush()
+
+    def replay(self):
+        """Yields each line recorded since the journal was last truncated."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding='utf-8') as journal_file:
+            for entry in journal_file:
+                try:
+                    yield json.loads(entry)
+                except ValueError:
+                    # the bot died partway through writing this entry
+                    logging.warning("ignoring torn journal entry")
+                    return
+
+    def truncate(self):
+        """Forgets every recorded line, once they are safely committed."""
+        if self.file is not None:
+            self.file.truncate(0)
+        elif os.path.exists(self.path):
+            open(self.path, 'w').close()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,550 @@
+"""Load-tests the bot end to end against a fake homeserver.
+
+The fake homeserver answers the requests the bot makes (login, sync, sends,
+read receipts, joins and its display name) from memory, while synthetic
+traffic is posted to its rooms at a fixed rate. The bot runs as its own
+process, as it would in production. The report, printed (or written) as
+JSON, gives how many events per second the bot kept up with, how long
+mentions waited for replies, how many requests of each kind the bot made,
+and its memory use over time."""
+import argparse
+import http.server
+import json
+import os
+import platform
+import random
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from collections import Counter, deque
+
+from benchmark import ZipfWords, git_commit, percentiles, write_corpus
+
+USER_ID = '@loadbot:localhost'
+DISPLAY_NAME = 'LoadBot'
+DEFAULT_RATE = 100
+DEFAULT_DURATION = 30
+DEFAULT_ROOMS = 10
+DEFAULT_MENTION_RATIO = 0.05
+DEFAULT_SENDERS = 50
+# trigrams in the brain the bot is trained with before the run
+DEFAULT_BRAIN_TRIGRAMS = 100000
+VOCABULARY = 5000
+# longest a sync waits for events, in seconds, whatever the bot asks for
+MAX_SYNC_WAIT = 30
+# read receipts are how the harness sees which events the bot has handled,
+# so the bot sends them more often than it would by default
+RECEIPT_INTERVAL = 0.2
+# how often the bot's memory use is sampled, in seconds
+RSS_INTERVAL = 1
+# longest to wait for the bot to start, join its rooms, and catch up
+STARTUP_TIMEOUT = 120
+DRAIN_TIMEOUT = 60
+
+
+class FakeHomeserver(object):
+    """Just enough of a Matrix homeserver to run the bot against.
+
+    Everything that happens is appended to one stream, and a sync token is a
+    position in it. Events in rooms the bot hasn't joined aren't sent to it.
+    Replies, receipts and a count of every request are recorded for the
+    report."""
+    def __init__(self, user_id=USER_ID):
+        self.user_id = user_id
+        self.display_name = None
+        self.condition = threading.Condition()
+        # ('invite', room_id) or ('event', room_id, event)
+        self.stream = []
+        self.invited = set()
+        self.joined = set()
+        self.requests = Counter()
+        # (time, room_id, body) of each message the bot sent
+        self.sent = []
+        # room id -> index in its room of the last event the bot has read
+        self.read = {}
+        # event id -> (room_id, index in its room)
+        self.positions = {}
+        self.room_sizes = Counter()
+        self.last_read = None
+        self.send_listeners = []
+        self.server = None
+        self.stopping = False
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def start(self):
+        """Starts serving on a free local port, from a daemon thread."""
+        self.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), _Handler)
+        self.server.daemon_threads = True
+        self.server.homeserver = self
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def release_syncs(self):
+        """Answers waiting syncs, and any after them, right away."""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+
+    def stop(self):
+        self.release_syncs()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def invite(self, room_id):
+        with self.condition:
+            self.invited.add(room_id)
+            self.stream.append(('invite', room_id))
+            self.condition.notify_all()
+
+    def post(self, room_id, sender, body):
+        """Posts a text message to a room, returning its event id."""
+        with self.condition:
+            event_id = '$%d:localhost' % len(self.stream)
+            self._append(room_id, {
+                'type': 'm.room.message',
+                'event_id': event_id,
+                'sender': sender,
+                'origin_server_ts': int(time.time() * 1000),
+                'content': {'msgtype': 'm.text', 'body': body},
+            })
+            return event_id
+
+    def _append(self, room_id, event):
+        """Appends an event; must be called with the condition held."""
+        self.room_sizes[room_id] += 1
+        self.positions[event['event_id']] = (room_id,
+                                             self.room_sizes[room_id])
+        self.stream.append(('event', room_id, event))
+        self.condition.notify_all()
+
+    def messages_read(self):
+        """Returns how many events the bot has sent read receipts up to."""
+        with self.condition:
+            return sum(self.read.values())
+
+    def join(self, room_id):
+        with self.condition:
+            if room_id not in self.invited:
+                return False
+            self.joined.add(room_id)
+            self._append(room_id, {
+                'type': 'm.room.member',
+                'event_id': '$%d:localhost' % len(self.stream),
+                'sender': self.user_id,
+                'state_key': self.user_id,
+                'origin_server_ts': int(time.time() * 1000),
+                'content': {'membership': 'join',
+                            'displayname': self.display_name},
+            })
+            return True
+
+    def sync(self, since, timeout):
+        """Returns a sync response with everything after since."""
+        with self.condition:
+            if since is None:
+                # an initial sync: the rooms, but none of their history
+                return self._sync_response(len(self.stream), [
+                    entry for entry in self.stream
+                    if entry[0] == 'invite' and entry[1] not in self.joined])
+            start = int(since)
+            self.condition.wait_for(
+                lambda: len(self.stream) > start or self.stopping, timeout)
+            return self._sync_response(len(self.stream), self.stream[start:])
+
+    def _sync_response(self, next_batch, entries):
+        invites = {}
+        joined = {room_id: [] for room_id in self.joined}
+        for entry in entries:
+            if entry[0] == 'invite':
+                if entry[1] not in self.joined:
+                    invites[entry[1]] = {'invite_state': {'events': []}}
+            elif entry[1] in joined:
+                joined[entry[1]].append(dict(entry[2]))
+        return {
+            'next_batch': str(next_batch),
+            'rooms': {
+                'invite': invites,
+                'join': {room_id: {
+                    'timeline': {'events': events,
+                                 'prev_batch': str(next_batch)},
+                    'state': {'events': []},
+                } for room_id, events in joined.items()},
+                'leave': {},
+            },
+        }
+
+    def record_send(self, room_id, body):
+        now = time.time()
+        with self.condition:
+            self.sent.append((now, room_id, body))
+        for listener in self.send_listeners:
+            listener(now, room_id, body)
+
+    def record_receipt(self, room_id, event_id):
+        with self.condition:
+            position = self.positions.get(event_id)
+            if position is not None and position[0] == room_id and \
+                    position[1] > self.read.get(room_id, 0):
+                self.read[room_id] = position[1]
+                self.last_read = time.time()
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # (method, pattern, endpoint name) of every request the bot makes
+    routes = [
+        ('POST', re.compile(r'/login$'), 'login'),
+        ('POST', re.compile(r'/user/([^/]+)/filter$'), 'filter'),
+        ('GET', re.compile(r'/sync$'), 'sync'),
+        ('PUT', re.compile(r'/rooms/([^/]+)/send/m\.room\.message/([^/]+)$'),
+         'send'),
+        ('POST', re.compile(r'/rooms/([^/]+)/receipt/m\.read/([^/]+)$'),
+         'receipt'),
+        ('POST', re.compile(r'/join/([^/]+)$'), 'join'),
+        ('GET', re.compile(r'/profile/([^/]+)/displayname$'),
+         'get_display_name'),
+        ('PUT', re.compile(r'/profile/([^/]+)/displayname$'),
+         'set_display_name'),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def do_PUT(self):
+        self.route('PUT')
+
+    def respond(self, status, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except OSError:
+            # the bot went away
+            pass
+
+    def route(self, method):
+        homeserver = self.server.homeserver
+        length = int(self.headers.get('Content-Length') or 0)
+        content = json.loads(self.rfile.read(length) or b'{}')
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        path = url.path[len('/_matrix/client/r0'):]
+        for route_method, pattern, endpoint in self.routes:
+            match = pattern.match(path)
+            if route_method == method and match:
+                break
+        else:
+            self.respond(404, {'errcode': 'M_UNRECOGNIZED'})
+            return
+        args = [urllib.parse.unquote(arg) for arg in match.groups()]
+        with homeserver.condition:
+            homeserver.requests[endpoint] += 1
+        if endpoint == 'login':
+            self.respond(200, {'user_id': homeserver.user_id,
+                               'access_token': 'token',
+                               'home_server': 'localhost',
+                               'device_id': 'LOADTEST'})
+        elif endpoint == 'filter':
+            self.respond(200, {'filter_id': '1'})
+        elif endpoint == 'sync':
+            timeout = min(int(query.get('timeout', 0)) / 1000, MAX_SYNC_WAIT)
+            self.respond(200, homeserver.sync(query.get('since'), timeout))
+        elif endpoint == 'send':
+            homeserver.record_send(args[0], content.get('body'))
+            self.respond(200, {'event_id': '$sent-%s' % args[1]})
+        elif endpoint == 'receipt':
+            homeserver.record_receipt(*args)
+            self.respond(200, {})
+        elif endpoint == 'join':
+            if homeserver.join(args[0]):
+                self.respond(200, {'room_id': args[0]})
+            else:
+                self.respond(403, {'errcode': 'M_FORBIDDEN'})
+        elif endpoint == 'get_display_name':
+            self.respond(200, {'displayname': homeserver.display_name})
+        else:
+            homeserver.display_name = content.get('displayname')
+            self.respond(200, {})
+
+
+class MentionTracker(object):
+    """Matches the bot's replies to the mentions they answer.
+
+    With the bot's response rate at 0, it only replies to mentions, in order
+    within each room, so each reply answers the oldest unanswered mention in
+    its room."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiting = {}
+        self.latencies = []
+        self.unexpected_replies = 0
+
+    def mentioned(self, room_id, when):
+        with self.lock:
+            self.waiting.setdefault(room_id, deque()).append(when)
+
+    def replied(self, when, room_id, body):
+        with self.lock:
+            waiting = self.waiting.get(room_id)
+            if waiting:
+                self.latencies.append(when - waiting.popleft())
+            else:
+                self.unexpected_replies += 1
+
+    def unanswered(self):
+        with self.lock:
+            return sum(len(waiting) for waiting in self.waiting.values())
+
+
+def rss_bytes(pid):
+    """Returns the resident memory of a process, where /proc has it."""
+    try:
+        with open('/proc/%d/status' % pid) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def write_config(path, server, options=()):
+    """Writes a config for the bot under test.
+
+    options are (key, value) pairs overriding keys under [General]."""
+    import main
+    cfgparser = main.get_default_configparser()
+    cfgparser.set('General', 'display name', DISPLAY_NAME)
+    cfgparser.set('General', 'default response rate', '0')
+    cfgparser.set('General', 'read receipt interval',
+                  str(RECEIPT_INTERVAL))
+    for key, value in options:
+        cfgparser.set('General', key, value)
+    cfgparser.set('Login', 'username', 'loadbot')
+    cfgparser.set('Login', 'password', 'password')
+    cfgparser.set('Login', 'server', server)
+    with open(path, 'w') as config_file:
+        cfgparser.write(config_file)
+
+
+def wait_for(condition, timeout, process):
+    """Waits until condition() is true, unless process exits first."""
+    deadline = time.time() + timeout
+    while not condition():
+        if process.poll() is not None:
+            raise RuntimeError("the bot exited with status %d"
+                               % process.returncode)
+        if time.time() > deadline:
+            raise RuntimeError("timed out waiting for the bot")
+        time.sleep(0.05)
+
+
+def run_load_test(rate=DEFAULT_RATE, duration=DEFAULT_DURATION,
+                  rooms=DEFAULT_ROOMS, mention_ratio=DEFAULT_MENTION_RATIO,
+                  senders=DEFAULT_SENDERS,
+                  brain_trigrams=DEFAULT_BRAIN_TRIGRAMS, corpus_path=None,
+                  use_asyncio=False, options=(), directory=None):
+    """Runs the bot against a fake homeserver and returns its report.
+
+    rate messages per second are posted for duration seconds, spread
+    randomly over rooms rooms, with mention_ratio of them mentioning the
+    bot. Messages are lines of the corpus at corpus_path, in order, or
+    synthetic Zipf lines."""
+    directory = directory or tempfile.mkdtemp()
+    words = ZipfWords(VOCABULARY)
+    if corpus_path:
+        with open(corpus_path, encoding='utf-8') as corpus:
+            lines = [line.strip() for line in corpus if line.strip()]
+    else:
+        lines = None
+    brain_path = os.path.join(directory, 'brain.db')
+    config_path = os.path.join(directory, 'config.cfg')
+    log_path = os.path.join(directory, 'bot.log')
+    bot_main = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'main.py')
+
+    homeserver = FakeHomeserver()
+    mentions = MentionTracker()
+    homeserver.send_listeners.append(mentions.replied)
+    homeserver.start()
+    write_config(config_path, homeserver.url, options)
+    if brain_trigrams:
+        train_path = os.path.join(directory, 'train.txt')
+        write_corpus(train_path, brain_trigrams, words)
+        subprocess.check_call(
+            [sys.executable, bot_main, '--config', config_path,
+             '--brain', brain_path, '--train', train_path], cwd=directory,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    room_ids = ['!room%d:localhost' % i for i in range(rooms)]
+    for room_id in room_ids:
+        homeserver.invite(room_id)
+    command = [sys.executable, bot_main, '--config', config_path,
+               '--brain', brain_path]
+    if use_asyncio:
+        command.append('--asyncio')
+    with open(log_path, 'w') as log:
+        # in the scratch directory, as the bot saves its config to the
+        # working directory
+        process = subprocess.Popen(command, cwd=directory, stdout=log,
+                                   stderr=subprocess.STDOUT)
+    start = time.time()
+    rss = []
+    stopping = threading.Event()
+
+    def sample_rss():
+        while not stopping.wait(RSS_INTERVAL):
+            rss.append([round(time.time() - start, 1),
+                        rss_bytes(process.pid)])
+    rss_thread = threading.Thread(target=sample_rss, daemon=True)
+    rss_thread.start()
+
+    try:
+        wait_for(lambda: homeserver.joined >= set(room_ids),
+                 STARTUP_TIMEOUT, process)
+        # the join events are read once the bot is listening to its rooms
+        wait_for(lambda: homeserver.messages_read() >= len(room_ids),
+                 STARTUP_TIMEOUT, process)
+        startup_seconds = time.time() - start
+        read_before = homeserver.messages_read()
+        requests_before = Counter(homeserver.requests)
+
+        posted = 0
+        traffic_start = time.time()
+        while posted < rate * duration:
+            delay = traffic_start + posted / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            if process.poll() is not None:
+                break
+            room_id = random.choice(room_ids)
+            line = lines[posted % len(lines)] if lines else words.line()
+            if random.random() < mention_ratio:
+                line = DISPLAY_NAME + ': ' + line
+                mentions.mentioned(room_id, time.time())
+            homeserver.post(room_id, '@user%d:localhost'
+                            % random.randrange(senders), line)
+            posted += 1
+        traffic_seconds = time.time() - traffic_start
+
+        wait_for(lambda: homeserver.messages_read() - read_before >= posted
+                 and not mentions.unanswered(), DRAIN_TIMEOUT, process)
+        handled = homeserver.messages_read() - read_before
+        handled_seconds = max(homeserver.last_read - traffic_start,
+                              traffic_seconds)
+    finally:
+        stopping.set()
+        rss_thread.join()
+        if process.poll() is None:
+            # so the bot isn't left waiting on a sync as it shuts down
+            homeserver.release_syncs()
+            process.send_signal(signal.SIGTERM)
+            try:
+                process.wait(timeout=DRAIN_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        homeserver.stop()
+
+    requests = Counter(homeserver.requests)
+    requests.subtract(requests_before)
+    return {
+        'rate': rate,
+        'duration': duration,
+        'rooms': rooms,
+        'mention_ratio': mention_ratio,
+        'asyncio': use_asyncio,
+        'startup_seconds': startup_seconds,
+        'events_posted': posted,
+        'offered_events_per_second': posted / traffic_seconds,
+        'events_handled': handled,
+        'handled_events_per_second': handled / handled_seconds,
+        'mentions': len(mentions.latencies) + mentions.unanswered(),
+        'mention_reply_latency': percentiles(mentions.latencies)
+        if mentions.latencies else None,
+        'unexpected_replies': mentions.unexpected_replies,
+        'requests': dict(+requests),
+        'requests_per_event': sum(requests.values()) / max(1, handled),
+        'rss_bytes': rss,
+    }
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description="Load-tests the bot against a fake homeserver")
+    argparser.add_argument("--rate", type=float, default=DEFAULT_RATE,
+                           help="Messages posted per second")
+    argparser.add_argument("--duration", type=float,
+                           default=DEFAULT_DURATION,
+                           help="Seconds to post messages for")
+    argparser.add_argument("--rooms", type=int, default=DEFAULT_ROOMS,
+                           help="Rooms to spread the messages over")
+    argparser.add_argument("--mention-ratio", type=float,
+                           default=DEFAULT_MENTION_RATIO,
+                           help="Fraction of messages mentioning the bot")
+    argparser.add_argument("--senders", type=int, default=DEFAULT_SENDERS,
+                           help="Users posting the messages")
+    argparser.add_argument("--brain-trigrams", type=int,
+                           default=DEFAULT_BRAIN_TRIGRAMS,
+                           help="Size of the brain trained before the run")
+    argparser.add_argument("--corpus", metavar="chat.txt", type=str,
+                           help="Replay these lines instead of synthetic "
+                           "ones")
+    argparser.add_argument("--asyncio", action="store_true",
+                           help="Run the bot with --asyncio")
+    argparser.add_argument("--set", metavar="KEY=VALUE", action="append",
+                           default=[],
+                           help="Set a [General] config key for the bot, "
+                           "e.g. --set 'reply pool=on'")
+    argparser.add_argument("--seed", type=int, default=0,
+                           help="Random seed for the traffic")
+    argparser.add_argument("--output", metavar="results.json", type=str,
+                           help="Write results here instead of stdout")
+    args = vars(argparser.parse_args())
+
+    options = [option.split('=', 1) for option in args['set']]
+    if any(len(option) != 2 for option in options):
+        argparser.error("--set takes KEY=VALUE")
+    random.seed(args['seed'])
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'seed': args['seed'],
+        'options': dict(options),
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        report['results'] = run_load_test(
+            rate=args['rate'], duration=args['duration'],
+            rooms=args['rooms'], mention_ratio=args['mention_ratio'],
+            senders=args['senders'], brain_trigrams=args['brain_trigrams'],
+            corpus_path=args['corpus'], use_asyncio=args['asyncio'],
+            options=options, directory=directory)
+
+    output = json.dumps(report, indent=2)
+    if args['output']:
+        with open(args['output'], 'w') as results:
+            results.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,100 @@
 #!/usr/bin/env python3
+import asyncio
 import time
-from matrix_client.client import MatrixClient
-from matrix_client.api import MatrixRequestError
-from requests.exceptions import ConnectionError, Timeout
 import argparse
 import random
 from configparser import ConfigParser
 import re
 import traceback
-import urllib.parse
 import logging
 import os
 import sys
 import signal
-import queue
 import codecs
-from database import MarkovDatabaseBrain
+import contextlib
+import json
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from cache import BrainPool, FollowerCache, ReplyPool
+from journal import Journal
+import maintenance
+import training
+import metrics
+import scheduler
+# the Matrix client, requests and SQLAlchemy take a while to import, so
+# they're imported where they're used, and only by the modes that use them
 
 COMMANDS = [
     '!rate'
 ]
+COMMAND_PATTERNS = [re.compile(re.escape(command), flags=re.IGNORECASE)
+                    for command in COMMANDS]
+
+# how many per-room brains are kept open by default
+DEFAULT_OPEN_BRAINS = 16
+
+# how many lines of a training file to learn per bulk insert
+TRAIN_BATCH_LINES = 1000
+
+# how many word pairs' followers to keep in memory by default
+DEFAULT_FOLLOWER_CACHE_SIZE = 10000
+
+# how many HTTP requests the asyncio bot makes at once
+ASYNC_HTTP_WORKERS = 8
+
+# how often read receipts are sent by default, in seconds
+DEFAULT_READ_RECEIPT_INTERVAL = 5
+
+# by default, at most this many replies wait to be sent, for at most this
+# many seconds
+DEFAULT_OUTBOX_SIZE = 1000
+DEFAULT_OUTBOX_MAX_AGE = 60
+
+# how often the bot saves its brain, in seconds
+SAVE_INTERVAL = 60 * 10
+
+# by default, the bot doesn't reply to events older than this, in seconds
+DEFAULT_REPLY_CUTOFF = 60 * 5
+
+# what the bot asks the server to sync: only messages and membership changes
+# in rooms' timelines, the members of only those who sent them, and none of
+# presence, typing notifications, receipts or account data. Invites come
+# regardless.
+SYNC_FILTER = {
+    'presence': {'not_types': ['*']},
+    'account_data': {'not_types': ['*']},
+    'room': {
+        'timeline': {'types': ['m.room.message', 'm.room.member'],
+                     'limit': 20},
+        'state': {'types': ['m.room.member'], 'lazy_load_members': True},
+        'ephemeral': {'not_types': ['*']},
+        'account_data': {'not_types': ['*']},
+    },
+}
+
+# by default, the markov backend commits what it has learned once this many
+# messages are waiting, or once the oldest has waited this many seconds
+DEFAULT_LEARN_BATCH_SIZE = 100
+DEFAULT_LEARN_BATCH_INTERVAL = 30
+
+# replies stop growing once they are this many words long
+MAX_REPLY_WORDS = 100
+
+# defaults for the pool of replies made ahead of time: how many seed words
+# to keep a reply for, how long a reply lasts in seconds, and how many
+# learned trigrams touching its words make it stale
+DEFAULT_REPLY_POOL_SIZE = 200
+DEFAULT_REPLY_POOL_TTL = 60 * 60
+DEFAULT_REPLY_POOL_TOUCHES = 20
+# how many unseeded replies the pool keeps
+REPLY_POOL_FALLBACKS = 20
+# how many replies the pool makes each time the bot is idle
+REPLY_POOL_BUDGET = 5
+
+# ways MarkovBackend can generate the words of a reply: one query per word
+# through the follower cache, or the whole chain in one recursive query
+REPLY_ENGINES = ('python', 'sql')
 
 
 def sigterm_handler(_signo, _stack_frame):
@@ -35,113 +110,626 @@ class ConfigParser(ConfigParser):
 
 class Backend(object):
     """Interface for chat backends."""
-    def __init__(self, brain_file):
+    def __init__(self, brain_file, config=None):
         pass
 
-    def train_file(self, filename):
-        """Trains the chat backend on the given file."""
+    def train_file(self, filename, workers=1):
+        """Trains the chat backend on the given file.
+
+        Backends that can may spread the work over several processes."""
         with codecs.open(filename, encoding='utf8') as train_file:
             for line in train_file:
                 self.learn(line)
 
-    def learn(self, line):
-        """Updates the chat backend based on the given line of input."""
+    def learn(self, line, room_id=None):
+        """Updates the chat backend based on the given line of input.
+
+        room_id is the room the line was said in, if any."""
         pass
 
+    def learn_many(self, lines, room_id=None):
+        """Learns each of lines, in order."""
+        for line in lines:
+            self.learn(line, room_id=room_id)
+
     def save(self):
         """Saves the backend to disk, if needed."""
         pass
 
-    def reply(self, message):
-        """Generates a reply to the given message."""
-        return "(dummy response)"
+    def close(self):
+        """Releases the backend's files. It must not be used afterwards."""
+        pass
 
+    def idle(self):
+        """Called when the bot has nothing else to do, for a short while."""
+        pass
 
-class MarkovBackend(Backend):
-    """Chat backend using markov chains."""
-    def __init__(self, brain_file):
-        self.brain = MarkovDatabaseBrain(brain_file)
+    def warm_up(self, num_pairs):
+        """Starts loading what the first replies will need in the background,
+        including the num_pairs most frequent word pairs."""
+        pass
 
-    def sanitize(self, word):
-        """Removes any awkward whitespace characters from the given word.
+    def maintain(self, **settings):
+        """Runs a bounded amount of brain maintenance, if the backend has
+        any; see maintenance.maintain for the settings.
 
-        Removes '\n', '\r', and '\\u2028' (unicode newline character)."""
-        return word.replace('\n', '').replace('\r', '').replace('\u2028', '')
+        Returns a report of what was done, or None."""
+        return None
 
-    def train_file(self, filename):
-        with codecs.open(filename, encoding='utf8') as train_file:
-            for line in train_file:
-                self.learn(line)
-        self.save()
+    def reply(self, message, room_id=None):
+        """Generates a reply to the given message.
 
-    def learn(self, line):
-        line = line.strip()
-        words = line.split(' ')
-        words = [self.sanitize(word) for word in words]
-        for i in range(len(words) - 2):
-            prefix = words[i], words[i + 1]
-            follow = words[i + 2]
-            self.brain.add(prefix, follow)
+        room_id is the room the reply will be sent to, if any."""
+        return "(dummy response)"
 
-    def save(self):
-        self.brain.save()
 
-    def get_random_next_link(self, word1, word2):
-        """Gives a word that could come after the two provided.
+class MarkovChainBackend(Backend):
+    """Seeding and reply generation shared by the markov chain backends.
 
-        Words that follow the two given words are weighted by how frequently
-        they appear after them.
-        """
-        possibilities = self.brain.get_followers((word1, word2))
-        if not possibilities:
-            return None
-
-        total = 0
-        for p in possibilities:
-            total += possibilities[p]
+    Subclasses set self.brain and self.weighted_random_seeds, and may pick
+    the word after a pair faster than get_random_next_link does here.
+    Everything else about learning, saving and maintenance is left to each
+    backend."""
+    def get_trigrams(self, line):
+        """Returns (word1, word2, follower, count) entries for a line."""
+        return training.line_trigrams(line)
 
-        num = random.randint(1, total)
-        total = 0
-        for p in possibilities:
-            total += possibilities[p]
-            if total >= num:
-                break
-        return p
+    def get_random_next_link(self, word1, word2):
+        """Gives a word that could come after the two provided, weighted by
+        how often it does. Returns None if no words follow them."""
+        followers = self.brain.get_followers((word1, word2))
+        if not followers:
+            return None
+        return random.choices(list(followers),
+                              weights=list(followers.values()))[0]
 
-    def reply(self, message):
+    def reply(self, message, room_id=None):
         if self.brain.is_empty():
             return ''
+        return ' '.join(self.generate_words(self.choose_seed(message)))
 
-        seed = None
-        # try to seed reply from the message
+    def seed_from_message(self, message):
+        """Picks a word pair containing a word of message, or None."""
         possible_seed_words = message.split()
-        while seed is None and possible_seed_words:
+        while possible_seed_words:
             message_word = random.choice(possible_seed_words)
-            seeds = list(self.brain.get_pairs_containing_word_ignoring_case(
-                    message_word))
+            seeds = self.brain.get_random_pairs_containing_word_ignoring_case(
+                message_word)
             if seeds:
-                seed = random.choice(seeds)
-            else:
-                possible_seed_words.remove(message_word)
+                return seeds[0]
+            possible_seed_words.remove(message_word)
+        return None
+
+    def choose_seed(self, message):
+        """Picks the words to start a reply to message with."""
+        # try to seed reply from the message
+        seed = self.seed_from_message(message)
 
         # we couldn't seed the reply from the input
         # fall back to random seed
         if seed is None:
-            seed = self.brain.get_three_random_words()
+            seed = self.random_seed()
+        return seed
+
+    def random_seed(self):
+        """Picks the words to start a reply with at random."""
+        return self.brain.get_three_random_words(
+            weighted=self.weighted_random_seeds)
 
+    def generate_words(self, seed):
+        """Extends the seed words into all the words of a reply."""
         words = list(seed)
-        while self.brain.contains_pair((words[-2], words[-1])) and \
-                len(words) < 100:
+        while len(words) < MAX_REPLY_WORDS:
             word = self.get_random_next_link(words[-2], words[-1])
+            if word is None:
+                break
             words.append(word)
+        return words
+
+
+class MarkovBackend(MarkovChainBackend):
+    """Chat backend using markov chains.
+
+    Learned messages are committed to the brain in batches. Until then they
+    are kept in a journal next to the brain, which is replayed on startup if
+    the bot died before committing them."""
+    def __init__(self, brain_file, config=None):
+        from database import MarkovDatabaseBrain
+        self.brain = MarkovDatabaseBrain(
+            brain_file, concurrent=bool(config and config.concurrent_brain))
+        cache_size = config.follower_cache_size if config \
+            else DEFAULT_FOLLOWER_CACHE_SIZE
+        self.follower_cache = FollowerCache(cache_size)
+        self.weighted_random_seeds = bool(
+            config and config.weighted_random_seeds)
+        self.reply_engine = config.reply_engine if config else 'python'
+        self.reply_pool = ReplyPool(
+            config.reply_pool_size, config.reply_pool_ttl,
+            config.reply_pool_touches, REPLY_POOL_FALLBACKS) \
+            if config and config.reply_pool else None
+        self.learn_batch_size = config.learn_batch_size if config \
+            else DEFAULT_LEARN_BATCH_SIZE
+        self.learn_batch_interval = config.learn_batch_interval if config \
+            else DEFAULT_LEARN_BATCH_INTERVAL
+        self.unsaved = 0
+        # a concurrent brain's lookups don't see unsaved trigrams, so pairs
+        # loaded into the follower cache before a save may be missing them
+        self.unsaved_pairs = set() if self.brain.readers is not None \
+            else None
+        self.last_save = time.time()
+        self.warming_up = None
+        self.journal = Journal(brain_file + '.journal')
+        replayed = list(self.journal.replay())
+        if replayed:
+            self.add_lines(replayed)
+            logging.info("replayed %d uncommitted messages" % len(replayed))
+            self.save()
+
+    def train_file(self, filename, workers=1):
+        if workers > 1:
+            training.train_parallel(self.brain, filename, workers)
+        else:
+            with codecs.open(filename, encoding='utf8') as train_file:
+                entries = []
+                for i, line in enumerate(train_file, 1):
+                    entries.extend(self.get_trigrams(line))
+                    if i % TRAIN_BATCH_LINES == 0:
+                        self.brain.add_many(entries)
+                        entries = []
+                self.brain.add_many(entries)
+        self.follower_cache.clear()
+        if self.reply_pool is not None:
+            self.reply_pool.clear()
+        self.save()
+
+    def add_lines(self, lines):
+        """Adds lines' trigrams to the brain, without committing them."""
+        trigrams = [trigram for line in lines
+                    for trigram in self.get_trigrams(line)]
+        self.brain.add_many(trigrams)
+        for word1, word2, follower, count in trigrams:
+            self.follower_cache.increment((word1, word2), follower, count)
+        if self.unsaved_pairs is not None:
+            self.unsaved_pairs.update(
+                (word1, word2) for word1, word2, _, _ in trigrams)
+        if self.reply_pool is not None:
+            for line in lines:
+                self.reply_pool.see(line.split())
+            self.reply_pool.touch(
+                (word1, word2) for word1, word2, _, _ in trigrams)
+        if self.warming_up is not None:
+            # the warm-up may have read these pairs before this line
+            self.warm_up_learned.update(
+                (word1, word2) for word1, word2, _, _ in trigrams)
+
+    def learn(self, line, room_id=None):
+        self.learn_many([line])
+
+    def learn_many(self, lines, room_id=None):
+        self.journal.extend(lines)
+        self.add_lines(lines)
+        self.unsaved += len(lines)
+        if self.unsaved >= self.learn_batch_size or \
+                time.time() - self.last_save >= self.learn_batch_interval:
+            self.save()
+
+    def save(self):
+        self.brain.save()
+        if self.unsaved_pairs:
+            # reload these from the brain now that it has them
+            self.follower_cache.discard(self.unsaved_pairs)
+            self.unsaved_pairs.clear()
+        # a crash between the commit and the truncation would learn the
+        # last batch twice on replay; small next to losing it
+        self.journal.truncate()
+        self.unsaved = 0
+        self.last_save = time.time()
+
+    def close(self):
+        self.brain.close()
+        self.journal.close()
+
+    def maintain(self, **settings):
+        self.save()
+        report = maintenance.maintain(
+            self.brain, prune_limit=maintenance.BACKGROUND_PRUNE_LIMIT,
+            vacuum_pages=maintenance.BACKGROUND_VACUUM_PAGES,
+            chunk_size=maintenance.BACKGROUND_CHUNK_SIZE, **settings)
+        self.follower_cache.clear()
+        if self.reply_pool is not None:
+            self.reply_pool.clear()
+        return report
+
+    def idle(self):
+        if self.warming_up is not None and not self.warming_up.is_alive():
+            self.finish_warm_up()
+        if self.reply_pool is not None and not self.brain.is_empty():
+            self.reply_pool.refill(self.pregenerate, REPLY_POOL_BUDGET)
+
+    def warm_up(self, num_pairs):
+        """Reads the most frequent pairs' followers, and in WAL mode the seed
+        indexes, in a background thread. idle() puts the followers into the
+        follower cache once they're read."""
+        if self.warming_up is not None or self.brain.is_empty():
+            return
+        # anything unsaved would be invisible to the warm-up's connection
+        self.save()
+        self.warm_up_learned = set()
+        self.warm_followers = None
+
+        def warm_up():
+            start = time.perf_counter()
+            self.warm_followers = self.brain.warm_up(
+                min(num_pairs, self.follower_cache.size))
+            logging.info("startup: warm-up took %.2fs"
+                         % (time.perf_counter() - start))
+        self.warming_up = threading.Thread(target=warm_up, daemon=True)
+        self.warming_up.start()
+
+    def finish_warm_up(self):
+        """Caches the followers read by the warm-up, except for pairs
+        learned since, whose followers the warm-up may have missed."""
+        self.warming_up.join()
+        for word_pair, followers in (self.warm_followers or {}).items():
+            if word_pair not in self.warm_up_learned and \
+                    word_pair not in self.follower_cache.entries:
+                self.follower_cache.put(word_pair, followers)
+        self.warming_up = None
+        self.warm_up_learned = None
+        self.warm_followers = None
+
+    def pregenerate(self, word):
+        """Returns the words of a reply seeded from word, or from a random
+        seed if word is None. Returns None if word can't seed a reply."""
+        if word is None:
+            return self.generate_words(self.random_seed())
+        seeds = self.brain.get_random_pairs_containing_word_ignoring_case(
+            word)
+        return self.generate_words(seeds[0]) if seeds else None
+
+    def get_random_next_link(self, word1, word2):
+        return self.follower_cache.choose(
+            (word1, word2), self.brain.get_followers)
+
+    def reply(self, message, room_id=None):
+        if self.reply_pool is None:
+            return super().reply(message, room_id)
+        if self.brain.is_empty():
+            return ''
+        words = self.reply_pool.take(message.split())
+        if words is None:
+            seed = self.seed_from_message(message)
+            if seed is None:
+                words = self.reply_pool.take_fallback()
+            if words is None:
+                words = self.generate_words(seed or self.random_seed())
         return ' '.join(words)
 
+    def generate_words(self, seed):
+        if self.reply_engine == 'sql':
+            return self.brain.generate_chain(seed, MAX_REPLY_WORDS)
+        return super().generate_words(seed)
+
+
+class CompiledMarkovBackend(MarkovChainBackend):
+    """Read-only markov chain backend using a compiled brain file.
+
+    See compiled_brain.py for how to make one from a SQLite brain."""
+    def __init__(self, brain_file, config=None):
+        from compiled_brain import CompiledBrain
+        self.brain = CompiledBrain(brain_file)
+        self.weighted_random_seeds = bool(
+            config and config.weighted_random_seeds)
+        if config and config.learning:
+            logging.warning("compiled brains are read-only; "
+                            "messages will not be learned")
+
+    def train_file(self, filename, workers=1):
+        raise ValueError("compiled brains are read-only")
+
+    def close(self):
+        self.brain.close()
+
+    def get_random_next_link(self, word1, word2):
+        word1_id = self.brain.word_id(word1)
+        word2_id = self.brain.word_id(word2)
+        pair = None
+        if word1_id is not None and word2_id is not None:
+            pair = self.brain.pair_index(word1_id, word2_id)
+        if pair is None:
+            return None
+        return self.brain.word(self.brain.choose_follower(pair))
+
+    def generate_words(self, seed):
+        # walk the chain by word id and only look up text at the end
+        ids = [self.brain.word_id(word) for word in seed]
+        while len(ids) < MAX_REPLY_WORDS:
+            pair = self.brain.pair_index(ids[-2], ids[-1])
+            if pair is None:
+                break
+            ids.append(self.brain.choose_follower(pair))
+        return [self.brain.word(word_id) for word_id in ids]
+
+
+class MemoryMarkovBackend(MarkovChainBackend):
+    """Markov chain backend that keeps its brain in memory.
+
+    The brain is snapshotted to brain_file + '.snapshot' whenever it is
+    saved. The first time, it is imported from brain_file if that is an
+    existing SQLite brain. Whatever was learned since the last snapshot is
+    lost if the bot dies."""
+    def __init__(self, brain_file, config=None):
+        import memory_brain
+        snapshot_path = brain_file + '.snapshot'
+        if os.path.exists(snapshot_path):
+            self.brain = memory_brain.read_snapshot(snapshot_path)
+        elif os.path.exists(brain_file):
+            logging.info("importing %s into memory" % brain_file)
+            self.brain = memory_brain.import_database(brain_file)
+        else:
+            self.brain = memory_brain.MemoryBrain()
+        self.snapshotter = memory_brain.Snapshotter(self.brain, snapshot_path)
+        # replies are made without I/O already, so there's nothing to pool
+        # or warm up
+        self.weighted_random_seeds = bool(
+            config and config.weighted_random_seeds)
+
+    def train_file(self, filename, workers=1):
+        if workers > 1:
+            training.train_parallel(self.brain, filename, workers)
+        else:
+            Backend.train_file(self, filename)
+        self.save()
+
+    def learn(self, line, room_id=None):
+        self.brain.add_many(self.get_trigrams(line))
+
+    def learn_many(self, lines, room_id=None):
+        self.brain.add_many([trigram for line in lines
+                             for trigram in self.get_trigrams(line)])
+
+    def save(self):
+        self.snapshotter.snapshot()
+
+    def close(self):
+        self.snapshotter.wait()
+
+    def get_random_next_link(self, word1, word2):
+        follower = self.brain.choose_follower(
+            (self.brain.word_id(word1), self.brain.word_id(word2)))
+        return None if follower is None else self.brain.words[follower]
+
+    def generate_words(self, seed):
+        # walk the chain by word id and only look up text at the end
+        ids = [self.brain.word_id(word) for word in seed]
+        while len(ids) < MAX_REPLY_WORDS:
+            follower = self.brain.choose_follower((ids[-2], ids[-1]))
+            if follower is None:
+                break
+            ids.append(follower)
+        return [self.brain.words[word_id] for word_id in ids]
+
+
+class RemoteBackend(MarkovChainBackend):
+    """Markov chain backend using a brain served by brain_server.py.
+
+    The server listens next to brain_file. Replies are made here, from
+    followers fetched from the server and kept in the follower cache, unless
+    the server can't hand out followers (for room brains) or the config asks
+    for the sql reply engine; then the server makes them. Lines are sent
+    to the server to learn without waiting for it."""
+    def __init__(self, brain_file, config=None):
+        from brain_server import BrainClient
+        self.client = BrainClient(brain_file + '.sock')
+        cache_size = config.follower_cache_size if config \
+            else DEFAULT_FOLLOWER_CACHE_SIZE
+        self.follower_cache = FollowerCache(cache_size)
+        self.local_replies = self.client.call('info')['followers'] and \
+            not (config and config.reply_engine == 'sql')
+
+    def train_file(self, filename, workers=1):
+        raise ValueError("train the brain server's brain instead")
+
+    def learn(self, line, room_id=None):
+        self.learn_many([line], room_id=room_id)
+
+    def learn_many(self, lines, room_id=None):
+        self.client.notify('learn', lines=lines, room_id=room_id)
+        for line in lines:
+            for word1, word2, follower, count in self.get_trigrams(line):
+                self.follower_cache.increment((word1, word2), follower, count)
+
+    def save(self):
+        self.client.notify('save')
+        # pick up what other bots have taught the brain since
+        self.follower_cache.clear()
+
+    def close(self):
+        self.client.close()
+
+    def get_followers(self, word_pair):
+        word1, word2 = word_pair
+        return self.client.call('followers', word1=word1, word2=word2)
+
+    def get_random_next_link(self, word1, word2):
+        return self.follower_cache.choose((word1, word2), self.get_followers)
+
+    def reply(self, message, room_id=None):
+        if not self.local_replies:
+            return self.client.call('reply', message=message,
+                                    room_id=room_id)
+        seed = self.client.call('seed', message=message)
+        if seed is None:
+            return ''
+        return ' '.join(self.generate_words(seed))
+
+
+class RoomMarkovBackend(Backend):
+    """Markov chain backend with a separate brain for each room.
+
+    Rooms can share a brain by being put in the same group in the config's
+    Room Brains section. The brains live in a directory next to brain_file,
+    and only the most recently used few are kept open. If fallback is on,
+    everything is also learned into a shared brain at brain_file, which
+    replies when a room's own brain has nothing to say about a message."""
+    def __init__(self, brain_file, config=None):
+        self.config = config
+        self.directory = brain_file + '.rooms'
+        os.makedirs(self.directory, exist_ok=True)
+        self.shared = MarkovBackend(brain_file, config) \
+            if config and config.room_brain_fallback else None
+        open_brains = config.open_brains if config else DEFAULT_OPEN_BRAINS
+        self.pool = BrainPool(open_brains, self.open_brain)
+
+    def brain_name(self, room_id):
+        """Returns the name of the brain the given room uses."""
+        groups = self.config.room_brain_groups if self.config else {}
+        return groups.get(room_id, room_id)
+
+    def open_brain(self, name):
+        path = os.path.join(
+            self.directory, urllib.parse.quote(name, safe='') + '.db')
+        return MarkovBackend(path, self.config)
+
+    def train_file(self, filename, workers=1):
+        if self.shared is None:
+            raise ValueError("only the shared brain can be trained; "
+                             "turn on room brain fallback")
+        self.shared.train_file(filename, workers)
+
+    def learn(self, line, room_id=None):
+        if self.shared is not None:
+            self.shared.learn(line)
+        if room_id is not None:
+            self.pool.get(self.brain_name(room_id)).learn(line)
+
+    def learn_many(self, lines, room_id=None):
+        if self.shared is not None:
+            self.shared.learn_many(lines)
+        if room_id is not None:
+            self.pool.get(self.brain_name(room_id)).learn_many(lines)
+
+    def save(self):
+        if self.shared is not None:
+            self.shared.save()
+        self.pool.save()
+
+    def close(self):
+        if self.shared is not None:
+            self.shared.close()
+        self.pool.close()
+
+    def idle(self):
+        if self.shared is not None:
+            self.shared.idle()
+        for backend in self.pool.brains.values():
+            backend.idle()
+
+    def warm_up(self, num_pairs):
+        # which rooms' brains will be wanted first isn't known yet
+        if self.shared is not None:
+            self.shared.warm_up(num_pairs)
+
+    def maintain(self, **settings):
+        backends = list(self.pool.brains.values())
+        if self.shared is not None:
+            backends.append(self.shared)
+        report = {'trigrams_removed': 0, 'bytes_reclaimed': 0}
+        for backend in backends:
+            for key, value in backend.maintain(**settings).items():
+                report[key] += value
+        return report
+
+    def reply(self, message, room_id=None):
+        backend = self.shared
+        seed = None
+        if room_id is not None:
+            room_backend = self.pool.get(self.brain_name(room_id))
+            if not room_backend.brain.is_empty():
+                seed = room_backend.seed_from_message(message)
+            if seed is not None or self.shared is None:
+                backend = room_backend
+        if backend is None:
+            return ''
+        if seed is None:
+            return backend.reply(message)
+        return ' '.join(backend.generate_words(seed))
+
 
 class Config(object):
     def __init__(self, cfgparser):
         self.backend = cfgparser.get('General', 'backend')
         self.display_name = cfgparser.get('General', 'display name')
         self.learning = cfgparser.getboolean('General', 'learning')
+        self.follower_cache_size = cfgparser.getint(
+            'General', 'follower cache size',
+            fallback=DEFAULT_FOLLOWER_CACHE_SIZE)
+        self.weighted_random_seeds = cfgparser.getboolean(
+            'General', 'weighted random seeds', fallback=False)
+        self.read_receipt_interval = cfgparser.getfloat(
+            'General', 'read receipt interval',
+            fallback=DEFAULT_READ_RECEIPT_INTERVAL)
+        # metrics are off unless given a port to serve them on, a log
+        # interval, or both
+        self.metrics_port = cfgparser.getint(
+            'General', 'metrics port', fallback=0)
+        self.metrics_log_interval = cfgparser.getfloat(
+            'General', 'metrics log interval', fallback=0)
+        self.outbox_size = cfgparser.getint(
+            'General', 'outbox size', fallback=DEFAULT_OUTBOX_SIZE)
+        self.outbox_max_age = cfgparser.getfloat(
+            'General', 'outbox max age', fallback=DEFAULT_OUTBOX_MAX_AGE)
+        self.concurrent_brain = cfgparser.getboolean(
+            'General', 'concurrent brain', fallback=False)
+        self.room_brains = cfgparser.getboolean(
+            'General', 'room brains', fallback=False)
+        self.open_brains = cfgparser.getint(
+            'General', 'open brains', fallback=DEFAULT_OPEN_BRAINS)
+        self.room_brain_fallback = cfgparser.getboolean(
+            'General', 'room brain fallback', fallback=True)
+        self.room_brain_groups = {}
+        if cfgparser.has_section('Room Brains'):
+            for room_id, group in cfgparser.items('Room Brains'):
+                room_id = room_id.replace('-colon-', ':')
+                self.room_brain_groups[room_id] = group
+        self.maintenance_interval = cfgparser.getfloat(
+            'General', 'maintenance interval', fallback=0)
+        self.prune_below = cfgparser.getint(
+            'General', 'prune below', fallback=0)
+        self.decay_factor = cfgparser.getfloat(
+            'General', 'decay factor', fallback=1)
+        self.max_followers = cfgparser.getint(
+            'General', 'max followers', fallback=0)
+        self.reply_pool = cfgparser.getboolean(
+            'General', 'reply pool', fallback=False)
+        self.reply_pool_size = cfgparser.getint(
+            'General', 'reply pool size', fallback=DEFAULT_REPLY_POOL_SIZE)
+        self.reply_pool_ttl = cfgparser.getfloat(
+            'General', 'reply pool ttl', fallback=DEFAULT_REPLY_POOL_TTL)
+        self.reply_pool_touches = cfgparser.getint(
+            'General', 'reply pool touches',
+            fallback=DEFAULT_REPLY_POOL_TOUCHES)
+        self.warm_up_pairs = cfgparser.getint(
+            'General', 'warm up pairs', fallback=0)
+        self.learn_batch_size = cfgparser.getint(
+            'General', 'learn batch size', fallback=DEFAULT_LEARN_BATCH_SIZE)
+        self.learn_batch_interval = cfgparser.getfloat(
+            'General', 'learn batch interval',
+            fallback=DEFAULT_LEARN_BATCH_INTERVAL)
+        self.reply_engine = cfgparser.get(
+            'General', 'reply engine', fallback='python')
+        if self.reply_engine not in REPLY_ENGINES:
+            raise ValueError("unknown reply engine: " + self.reply_engine)
+        self.event_queue_size = cfgparser.getint(
+            'General', 'event queue size',
+            fallback=scheduler.DEFAULT_MAX_SIZE)
+        self.event_queue_overflow = cfgparser.get(
+            'General', 'event queue overflow', fallback='block')
+        if self.event_queue_overflow not in scheduler.OVERFLOW_POLICIES:
+            raise ValueError("unknown event queue overflow policy: " +
+                             self.event_queue_overflow)
+        self.reply_cutoff = cfgparser.getfloat(
+            'General', 'reply cutoff', fallback=DEFAULT_REPLY_CUTOFF)
         self.username = cfgparser.get('Login', 'username')
         self.password = cfgparser.get('Login', 'password')
         self.server = cfgparser.get('Login', 'server')
@@ -168,6 +756,45 @@ class Config(object):
         cfgparser.set('General', 'backend', self.backend)
         cfgparser.set('General', 'display name', self.display_name)
         cfgparser.set('General', 'learning', str(self.learning))
+        cfgparser.set('General', 'follower cache size',
+                      str(self.follower_cache_size))
+        cfgparser.set('General', 'weighted random seeds',
+                      str(self.weighted_random_seeds))
+        cfgparser.set('General', 'reply engine', self.reply_engine)
+        cfgparser.set('General', 'event queue size',
+                      str(self.event_queue_size))
+        cfgparser.set('General', 'event queue overflow',
+                      self.event_queue_overflow)
+        cfgparser.set('General', 'reply cutoff', str(self.reply_cutoff))
+        cfgparser.set('General', 'read receipt interval',
+                      str(self.read_receipt_interval))
+        cfgparser.set('General', 'metrics port', str(self.metrics_port))
+        cfgparser.set('General', 'metrics log interval',
+                      str(self.metrics_log_interval))
+        cfgparser.set('General', 'outbox size', str(self.outbox_size))
+        cfgparser.set('General', 'outbox max age', str(self.outbox_max_age))
+        cfgparser.set('General', 'concurrent brain',
+                      str(self.concurrent_brain))
+        cfgparser.set('General', 'room brains', str(self.room_brains))
+        cfgparser.set('General', 'open brains', str(self.open_brains))
+        cfgparser.set('General', 'room brain fallback',
+                      str(self.room_brain_fallback))
+        cfgparser.set('General', 'maintenance interval',
+                      str(self.maintenance_interval))
+        cfgparser.set('General', 'prune below', str(self.prune_below))
+        cfgparser.set('General', 'decay factor', str(self.decay_factor))
+        cfgparser.set('General', 'max followers', str(self.max_followers))
+        cfgparser.set('General', 'reply pool', str(self.reply_pool))
+        cfgparser.set('General', 'reply pool size',
+                      str(self.reply_pool_size))
+        cfgparser.set('General', 'reply pool ttl', str(self.reply_pool_ttl))
+        cfgparser.set('General', 'reply pool touches',
+                      str(self.reply_pool_touches))
+        cfgparser.set('General', 'warm up pairs', str(self.warm_up_pairs))
+        cfgparser.set('General', 'learn batch size',
+                      str(self.learn_batch_size))
+        cfgparser.set('General', 'learn batch interval',
+                      str(self.learn_batch_interval))
         cfgparser.add_section('Login')
         cfgparser.set('Login', 'username', self.username)
         cfgparser.set('Login', 'password', self.password)
@@ -178,6 +805,10 @@ class Config(object):
             # character
             room_id = room_id.replace(':', '-colon-')
             cfgparser.set('Response Rates', room_id, str(rate))
+        cfgparser.add_section('Room Brains')
+        for room_id, group in self.room_brain_groups.items():
+            cfgparser.set('Room Brains', room_id.replace(':', '-colon-'),
+                          group)
         with open('config.cfg', 'wt') as configfile:
             cfgparser.write(configfile)
 
@@ -190,29 +821,256 @@ def get_default_configparser():
     config.set('General', 'backend', 'markov')
     config.set('General', 'display name', 'Markov')
     config.set('General', 'learning', 'on')
+    config.set('General', 'follower cache size',
+               str(DEFAULT_FOLLOWER_CACHE_SIZE))
+    config.set('General', 'weighted random seeds', 'off')
+    config.set('General', 'reply engine', 'python')
+    config.set('General', 'event queue size',
+               str(scheduler.DEFAULT_MAX_SIZE))
+    config.set('General', 'event queue overflow', 'block')
+    config.set('General', 'reply cutoff', str(DEFAULT_REPLY_CUTOFF))
+    config.set('General', 'read receipt interval',
+               str(DEFAULT_READ_RECEIPT_INTERVAL))
+    config.set('General', 'metrics port', '0')
+    config.set('General', 'metrics log interval', '0')
+    config.set('General', 'outbox size', str(DEFAULT_OUTBOX_SIZE))
+    config.set('General', 'outbox max age', str(DEFAULT_OUTBOX_MAX_AGE))
+    config.set('General', 'concurrent brain', 'off')
+    config.set('General', 'room brains', 'off')
+    config.set('General', 'open brains', str(DEFAULT_OPEN_BRAINS))
+    config.set('General', 'room brain fallback', 'on')
+    config.set('General', 'maintenance interval', '0')
+    config.set('General', 'prune below', '0')
+    config.set('General', 'decay factor', '1')
+    config.set('General', 'max followers', '0')
+    config.set('General', 'reply pool', 'off')
+    config.set('General', 'reply pool size', str(DEFAULT_REPLY_POOL_SIZE))
+    config.set('General', 'reply pool ttl', str(DEFAULT_REPLY_POOL_TTL))
+    config.set('General', 'reply pool touches',
+               str(DEFAULT_REPLY_POOL_TOUCHES))
+    config.set('General', 'warm up pairs', '0')
+    config.set('General', 'learn batch size', str(DEFAULT_LEARN_BATCH_SIZE))
+    config.set('General', 'learn batch interval',
+               str(DEFAULT_LEARN_BATCH_INTERVAL))
     config.add_section('Login')
     config.set('Login', 'username', 'username')
     config.set('Login', 'password', 'password')
     config.set('Login', 'server', 'http://matrix.org')
     config.add_section('Response Rates')
+    config.add_section('Room Brains')
     return config
 
 
+class BotIdentity(object):
+    """The bot's names, with the patterns used to find them in messages.
+
+    The display name lives in the config. Rooms where the bot goes by
+    another name, like a nickname for that room, also answer to it. The
+    patterns are recompiled only when a name changes, never per message."""
+    def __init__(self, config):
+        self.config = config
+        self.user_id = None
+        self.names = None
+        self.patterns = None
+        # room id -> the bot's name there, where it isn't the display name
+        self.room_names = {}
+        self.room_patterns = {}
+
+    def _compile(self, display_names):
+        display_names = '|'.join(re.escape(name) for name in display_names)
+        name_pattern = re.compile(
+            "({}|{})".format(display_names, re.escape(self.config.username)),
+            flags=re.IGNORECASE)
+        display_name_pattern = re.compile(
+            ' *(?:' + display_names + ') *', flags=re.IGNORECASE)
+        return name_pattern, display_name_pattern
+
+    def get_patterns(self, room_id=None):
+        names = (self.config.display_name, self.config.username)
+        if names != self.names:
+            self.names = names
+            self.patterns = self._compile([self.config.display_name])
+            self.room_patterns = {}
+        room_name = self.room_names.get(room_id)
+        if room_name is None:
+            return self.patterns
+        if room_id not in self.room_patterns:
+            self.room_patterns[room_id] = self._compile(
+                [self.config.display_name, room_name])
+        return self.room_patterns[room_id]
+
+    def is_name_in_message(self, message, room_id=None):
+        """Returns whether the message contains the bot's name.
+
+        Considers both display name and username, and the bot's name in the
+        room the message was sent to.
+        """
+        return self.get_patterns(room_id)[0].search(message)
+
+    def remove_display_name(self, message, room_id=None):
+        """Returns message with the bot's display name taken out."""
+        return self.get_patterns(room_id)[1].sub(' ', message)
+
+    def handle_member_event(self, event):
+        """Picks up the bot's name in a room from its member events.
+
+        A name other than the display name is only taken as the bot's name
+        in that room: it may be a nickname for the room, or the profile's
+        name may have changed, which only the server can tell. Returns
+        whether that is the case."""
+        if event.get('state_key') != self.user_id:
+            return False
+        room_id = event.get('room_id')
+        display_name = event['content'].get('displayname')
+        self.room_patterns.pop(room_id, None)
+        if event['content'].get('membership') != 'join' or \
+                not display_name or \
+                display_name == self.config.display_name:
+            self.room_names.pop(room_id, None)
+            return False
+        self.room_names[room_id] = display_name
+        return True
+
+
+class Startup(object):
+    """Times the phases of starting up, and how long until the first reply.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.replied = False
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        logging.info("startup: %s took %.2fs" % (name, seconds))
+        metrics.observe('chatbot_startup_seconds', seconds, phase=name)
+
+    def first_reply(self):
+        """Called as each reply is sent; logs the first."""
+        if self.replied:
+            return
+        self.replied = True
+        seconds = time.perf_counter() - self.start
+        logging.info("startup: first reply sent %.2fs after starting"
+                     % seconds)
+        metrics.observe('chatbot_startup_seconds', seconds,
+                        phase='first reply')
+
+
 class Bot(object):
-    """Handles everything that the bot does."""
-    def __init__(self, config, chat_backend):
+    """Handles everything that the bot does.
+
+    A bot can be run again after it is disconnected, once it has logged in
+    again; it keeps its queues and unsent replies in between."""
+    def __init__(self, config, chat_backend, startup=None,
+                 sync_token_path=None):
+        import outbox
+        from receipts import ReceiptSender
+        self.startup = startup or Startup()
+        self.sync_token_path = sync_token_path
         self.config = config
+        self.identity = BotIdentity(config)
+        self.receipts = ReceiptSender(
+            config.server, config.read_receipt_interval)
+        self.outbox = outbox.Outbox(
+            config.server, max_size=config.outbox_size,
+            max_age=config.outbox_max_age)
         self.client = None
         self.chat_backend = chat_backend
-        self.event_queue = queue.Queue()
-        self.invite_queue = queue.Queue()
+        self.scheduler = scheduler.EventScheduler(
+            config.event_queue_size, config.event_queue_overflow)
+        self.replies_too_old = 0
+        self.register_metrics()
+
+    def register_metrics(self):
+        """Reports the bot's queues and send counts as metrics."""
+        for priority in scheduler.PRIORITIES:
+            metrics.register(
+                'chatbot_event_queue_depth',
+                lambda priority=priority: self.scheduler.depth(priority),
+                priority=priority)
+        metrics.register('chatbot_events_shed_total',
+                         lambda: self.scheduler.shed, 'counter')
+        metrics.register('chatbot_outbox_depth', lambda: self.outbox.size)
+        metrics.register('chatbot_receipts_pending',
+                         lambda: len(self.receipts.pending))
+        metrics.register('chatbot_replies_sent_total',
+                         lambda: self.outbox.sent, 'counter')
+        metrics.register('chatbot_rate_limited_total',
+                         lambda: self.outbox.rate_limited, 'counter')
+        for reason, counter in [('full', 'dropped_full'),
+                                ('stale', 'dropped_stale'),
+                                ('failed', 'failed')]:
+            metrics.register(
+                'chatbot_replies_dropped_total',
+                lambda counter=counter: getattr(self.outbox, counter),
+                'counter', reason=reason)
+        metrics.register('chatbot_replies_dropped_total',
+                         lambda: self.replies_too_old, 'counter',
+                         reason='too old')
+        reply_pool = getattr(self.chat_backend, 'reply_pool', None)
+        if reply_pool is not None:
+            metrics.register('chatbot_reply_pool_total',
+                             lambda: reply_pool.hits, 'counter', result='hit')
+            metrics.register('chatbot_reply_pool_total',
+                             lambda: reply_pool.misses, 'counter',
+                             result='miss')
 
     def login(self):
         """Logs onto the server."""
+        from matrix_client.client import MatrixClient
         client = MatrixClient(self.config.server)
         client.login_with_password_no_sync(
             self.config.username, self.config.password)
         self.client = client
+        self.identity.user_id = client.user_id
+        self.receipts.token = client.api.token
+        self.outbox.token = client.api.token
+        self.setup_sync()
+
+    def setup_sync(self):
+        """Filters what the client syncs, and resumes from the saved token.
+        """
+        from matrix_client.api import MatrixRequestError
+        try:
+            response = self.client.api.create_filter(
+                self.client.user_id, SYNC_FILTER)
+            self.client.sync_filter = response['filter_id']
+        except MatrixRequestError:
+            # servers accept the filter inline too
+            logging.warning("couldn't register a sync filter; "
+                            "sending it with every sync")
+            self.client.sync_filter = json.dumps(SYNC_FILTER)
+        self.client.sync_token = self.load_sync_token()
+
+    def load_sync_tokens(self):
+        """Returns the saved sync tokens, by user id.
+
+        Bots sharing a brain through a brain server share the file too."""
+        if self.sync_token_path is None or \
+                not os.path.exists(self.sync_token_path):
+            return {}
+        with open(self.sync_token_path) as token_file:
+            return json.load(token_file)
+
+    def load_sync_token(self):
+        """Returns the sync token saved for this user, or None."""
+        return self.load_sync_tokens().get(self.client.user_id)
+
+    def save_sync_token(self):
+        """Saves how far the client has synced, so the next start can skip
+        everything before it."""
+        if self.sync_token_path is None or self.client is None or \
+                not self.client.sync_token:
+            return
+        tokens = self.load_sync_tokens()
+        tokens[self.client.user_id] = self.client.sync_token
+        temp_path = '%s.%d.tmp' % (self.sync_token_path, os.getpid())
+        with open(temp_path, 'w') as token_file:
+            json.dump(tokens, token_file)
+        os.replace(temp_path, self.sync_token_path)
 
     def get_room(self, event):
         """Returns the room the given event took place in."""
@@ -239,21 +1097,42 @@ class Bot(object):
                     event, "Response rate set to %f in this room." % rate)
 
     def reply(self, event, message):
-        """Replies to the given event with the provided message."""
-        room = self.get_room(event)
-        logging.info("Reply: %s" % message)
-        room.send_notice(message)
+        """Replies to the given event with the provided message.
 
-    def is_name_in_message(self, message):
+        The reply is queued and sent in the background, unless the event is
+        too old to reply to."""
+        if self.is_too_old(event):
+            self.replies_too_old += 1
+            return
+        logging.info("Reply: %s" % message)
+        self.outbox.send_notice(
+            event['room_id'], message,
+            on_sent=lambda: self.log_reply_latency(event))
+
+    def is_too_old(self, event):
+        """Returns whether event is older than the reply cutoff."""
+        return bool(self.config.reply_cutoff) and \
+            'origin_server_ts' in event and \
+            time.time() - event['origin_server_ts'] / 1000 > \
+            self.config.reply_cutoff
+
+    def log_reply_latency(self, event):
+        """Logs how long after the given event we finished replying to it."""
+        self.startup.first_reply()
+        if 'origin_server_ts' in event:
+            latency = time.time() - event['origin_server_ts'] / 1000
+            logging.debug("Reply latency: %.3fs" % latency)
+
+    def is_name_in_message(self, message, room_id=None):
         """Returns whether the message contains the bot's name.
 
-        Considers both display name and username.
+        Considers both display name and username, and the bot's name in the
+        room the message was sent to.
         """
-        regex = "({}|{})".format(
-            self.config.display_name, self.config.username)
-        return re.search(regex, message, flags=re.IGNORECASE)
+        return self.identity.is_name_in_message(message, room_id)
 
     def handle_invite(self, room_id, invite_state):
+        from matrix_client.api import MatrixRequestError
         # join rooms if invited
         try:
             self.client.join_room(room_id)
@@ -269,12 +1148,53 @@ class Bot(object):
             else:
                 raise(e)
 
-    def handle_event(self, event):
+    def classify(self, event):
+        """Returns the scheduler class of the given event.
+
+        Commands and mentions are urgent, as are non-message events, which
+        are quick to handle and may change the bot's name. Other messages are
+        learn-only, though they may still get a reply by chance."""
+        if event['type'] != 'm.room.message':
+            return scheduler.URGENT
+        message = str(event['content'].get('body', ''))
+        if self.is_name_in_message(message, event['room_id']) or any(
+                pattern.match(message) for pattern in COMMAND_PATTERNS):
+            return scheduler.URGENT
+        return scheduler.LEARN
+
+    def handle_next(self, timeout=None):
+        """Handles the most urgent waiting events, waiting up to timeout
+        seconds for some to arrive. Returns whether there were any."""
+        priority, items = self.scheduler.get(timeout)
+        if priority == scheduler.INVITE:
+            self.handle_invite(*items[0])
+        elif priority == scheduler.LEARN:
+            self.handle_events(items)
+        elif priority == scheduler.URGENT:
+            self.handle_event(items[0])
+        return bool(items)
+
+    def handle_events(self, events):
+        """Handles a batch of events, learning their messages in bulk."""
+        learned = []
+        for event in events:
+            self.handle_event(event, learned)
+        lines = {}
+        for room_id, line in learned:
+            lines.setdefault(room_id, []).append(line)
+        for room_id, room_lines in lines.items():
+            with metrics.timer('chatbot_backend_learn_seconds'):
+                self.chat_backend.learn_many(room_lines, room_id=room_id)
+
+    def handle_event(self, event, learned=None):
         """Handles the given event.
 
         Joins a room if invited, learns from messages, and possibly responds to
-        messages.
+        messages. If learned is a list, (room id, message) pairs are added to
+        it to be learned later, instead of being learned right away.
         """
+        start = time.perf_counter()
+        outcome = 'ignored'
         if event['type'] == 'm.room.message':
             # only care about text messages by other people
             if event['sender'] != self.client.user_id and \
@@ -284,56 +1204,141 @@ class Bot(object):
                 # case-insensitively
                 logging.info("Handling message: %s" % message)
                 command_found = False
-                for command in COMMANDS:
-                    match = re.search(command, message, flags=re.IGNORECASE)
+                for pattern in COMMAND_PATTERNS:
+                    match = pattern.search(message)
                     if match and (match.start() == 0 or
-                                  self.is_name_in_message(message)):
+                                  self.is_name_in_message(
+                                      message, event['room_id'])):
                         command_found = True
+                        outcome = 'command'
                         args = message[match.start():].split(' ')
                         self.handle_command(event, args[0], args[1:])
                         break
                 if not command_found:
                     room = self.get_room(event)
                     response_rate = self.config.get_response_rate(room.room_id)
-                    if self.is_name_in_message(message) or \
-                            random.random() < response_rate:
+                    wants_reply = self.is_name_in_message(
+                        message, event['room_id']) or \
+                        random.random() < response_rate
+                    if wants_reply and self.is_too_old(event):
+                        self.replies_too_old += 1
+                    elif wants_reply:
                         # remove name from message and respond to it
-                        message_no_name = re.sub(
-                            ' *' + re.escape(self.get_display_name()) + ' *',
-                            ' ', message, flags=re.IGNORECASE)
-                        response = self.chat_backend.reply(message_no_name)
+                        message_no_name = self.identity.remove_display_name(
+                            message, event['room_id'])
+                        with metrics.timer('chatbot_backend_reply_seconds'):
+                            response = self.chat_backend.reply(
+                                message_no_name, room_id=event['room_id'])
                         self.reply(event, response)
+                        outcome = 'reply'
+                    if self.config.learning and learned is not None:
+                        learned.append((event['room_id'], message))
+                    elif self.config.learning:
+                        with metrics.timer('chatbot_backend_learn_seconds'):
+                            self.chat_backend.learn(
+                                message, room_id=event['room_id'])
                     if self.config.learning:
-                        self.chat_backend.learn(message)
+                        if outcome != 'reply':
+                            outcome = 'learn'
+        elif event['type'] == 'm.room.member':
+            if self.identity.handle_member_event(event):
+                self.check_profile_name()
+            outcome = 'member'
         self.send_read_receipt(event)
+        metrics.observe('chatbot_handle_event_seconds',
+                        time.perf_counter() - start, outcome=outcome)
 
     def set_display_name(self, display_name):
         """Sets the bot's display name on the server."""
         self.client.api.set_display_name(self.client.user_id, display_name)
+        self.config.display_name = display_name
 
     def get_display_name(self):
         """Gets the bot's display name from the server."""
         return self.client.api.get_display_name(self.client.user_id)
 
-    def run(self):
-        """Indefinitely listens for messages and handles all that come."""
+    def check_profile_name(self):
+        """Picks up a display name set on the bot's profile elsewhere.
+
+        The names in member events may only be nicknames for one room, so
+        the profile itself is asked."""
+        from matrix_client.api import MatrixRequestError
+        try:
+            display_name = self.get_display_name()
+        except MatrixRequestError as e:
+            logging.warning("couldn't get our display name: %s" % e)
+            return
+        if display_name and display_name != self.config.display_name:
+            logging.info("display name changed to %s" % display_name)
+            self.config.display_name = display_name
+
+    def queue_event(self, event):
+        """Called from the listener thread with each new event.
+
+        Blocks while too many learn-only events are waiting, if the event
+        queue overflow policy is to block."""
+        self.scheduler.put(self.classify(event), event)
+
+    def queue_invite(self, room_id, invite_state):
+        """Called from the listener thread with each new invite."""
+        self.scheduler.put(scheduler.INVITE, (room_id, invite_state))
+
+    def start(self):
+        """Sets our display name and starts listening for invites and events.
+
+        Events from the initial sync are skipped."""
         current_display_name = self.get_display_name()
         if current_display_name != self.config.display_name:
             self.set_display_name(self.config.display_name)
 
-        last_save = time.time()
+        self.receipts.start()
+        self.outbox.start()
 
         # listen for invites, including initial sync invites
-        self.client.add_invite_listener(
-            lambda room_id, state: self.invite_queue.put((room_id, state)))
+        self.client.add_invite_listener(self.queue_invite)
 
-        # get rid of initial event sync
+        # get rid of initial event sync; with a saved token, this only
+        # fetches what happened since it was saved
         logging.info("initial event stream")
-        self.client.listen_for_events()
+        with self.startup.phase('initial sync'):
+            self.initial_sync()
 
         # listen to events and add them all to the event queue
         # for handling in this thread
-        self.client.add_listener(self.event_queue.put)
+        self.client.add_listener(self.queue_event)
+
+    def initial_sync(self):
+        from matrix_client.api import MatrixRequestError
+        try:
+            self.client.listen_for_events()
+        except MatrixRequestError:
+            if not self.client.sync_token:
+                raise
+            # the server may have forgotten the token
+            logging.warning("couldn't resume syncing from the saved token; "
+                            "syncing from scratch")
+            self.client.sync_token = None
+            self.client.listen_for_events()
+        self.save_sync_token()
+
+    def run_maintenance(self):
+        """Runs a round of brain maintenance with the configured settings.
+        """
+        report = self.chat_backend.maintain(
+            min_count=self.config.prune_below,
+            decay=self.config.decay_factor,
+            max_followers=self.config.max_followers)
+        if report is not None:
+            logging.info("maintenance removed %(trigrams_removed)d trigrams "
+                         "and reclaimed %(bytes_reclaimed)d bytes" % report)
+
+    def run(self):
+        """Indefinitely listens for messages and handles all that come."""
+        self.start()
+        last_save = time.time()
+        last_maintenance = time.time()
+
+        from requests.exceptions import Timeout
 
         def exception_handler(e):
             if isinstance(e, Timeout):
@@ -347,43 +1352,167 @@ class Bot(object):
 
         try:
             while True:
-                time.sleep(1)
-
-                # handle any queued events
-                while not self.event_queue.empty():
-                    event = self.event_queue.get_nowait()
-                    self.handle_event(event)
-
-                while not self.invite_queue.empty():
-                    room_id, invite_state = self.invite_queue.get_nowait()
-                    self.handle_invite(room_id, invite_state)
+                # handle queued events and invites, most urgent first
+                if not self.handle_next(timeout=1):
+                    self.chat_backend.idle()
 
                 # save every 10 minutes or so
-                if time.time() - last_save > 60 * 10:
+                if time.time() - last_save > SAVE_INTERVAL:
                     self.chat_backend.save()
+                    self.save_sync_token()
                     last_save = time.time()
+
+                if self.config.maintenance_interval and \
+                        time.time() - last_maintenance > \
+                        self.config.maintenance_interval:
+                    self.run_maintenance()
+                    last_maintenance = time.time()
         finally:
             logging.info("stopping listener thread")
             self.client.stop_listener_thread()
+            self.save_sync_token()
+            self.stop_senders()
+
+    def close(self):
+        """Frees what the bot keeps between runs."""
+        pass
+
+    def stop_senders(self):
+        """Stops sending queued replies and read receipts."""
+        self.outbox.stop()
+        self.receipts.stop()
 
     def send_read_receipt(self, event):
-        """Sends a read receipt for the given event."""
+        """Marks the given event read; the receipt is sent in the background.
+        """
         if "room_id" in event and "event_id" in event:
-            room_id = urllib.parse.quote(event['room_id'])
-            event_id = urllib.parse.quote(event['event_id'])
-            self.client.api._send("POST", "/rooms/" + room_id +
-                                  "/receipt/m.read/" + event_id,
-                                  api_path="/_matrix/client/r0")
+            self.receipts.mark_read(event['room_id'], event['event_id'])
+
+
+class AsyncBot(Bot):
+    """Bot that handles each event as soon as it arrives, using asyncio.
+
+    Syncing and joining rooms are blocking HTTP calls, so they run in
+    executor threads. Brain work runs in one dedicated thread, since
+    backends aren't thread-safe, taking events from the scheduler most
+    urgent first. Replies go through the outbox like in the
+    threaded bot, so a slow send never holds up handling."""
+    def __init__(self, config, chat_backend, startup=None,
+                 sync_token_path=None):
+        super().__init__(config, chat_backend, startup, sync_token_path)
+        self.loop = asyncio.new_event_loop()
+        self.brain_executor = ThreadPoolExecutor(max_workers=1)
+        self.http_executor = ThreadPoolExecutor(
+            max_workers=ASYNC_HTTP_WORKERS)
+        self.sync_executor = ThreadPoolExecutor(max_workers=1)
+
+    def queue_invite(self, room_id, invite_state):
+        # joining is HTTP work, so it needn't wait behind brain work
+        self.loop.call_soon_threadsafe(
+            self.dispatch_invite, room_id, invite_state)
+
+    def dispatch_invite(self, room_id, invite_state):
+        self.loop.create_task(self.run_in(
+            self.http_executor, self.handle_invite, room_id, invite_state))
+
+    async def run_in(self, executor, function, *args):
+        """Runs function in executor, logging anything it raises."""
+        try:
+            return await self.loop.run_in_executor(executor, function, *args)
+        except Exception:
+            logging.exception("error in %s" % function.__name__)
 
+    async def sync_forever(self):
+        """Syncs with the server forever, dispatching events as they come."""
+        bad_sync_timeout = 5
+        while True:
+            try:
+                await self.loop.run_in_executor(
+                    self.sync_executor, self.client.listen_for_events)
+                bad_sync_timeout = 5
+            except Exception:
+                logging.exception("sync failed; retrying in %d seconds"
+                                  % bad_sync_timeout)
+                await asyncio.sleep(bad_sync_timeout)
+                bad_sync_timeout = min(bad_sync_timeout * 2, 60 * 60)
+
+    async def handle_forever(self):
+        """Handles queued events as they come, most urgent first."""
+        while True:
+            await self.run_in(self.brain_executor, self.handle_next, 1)
+
+    async def save_forever(self):
+        """Saves the brain every SAVE_INTERVAL seconds."""
+        while True:
+            await asyncio.sleep(SAVE_INTERVAL)
+            await self.run_in(self.brain_executor, self.chat_backend.save)
+            self.save_sync_token()
+
+    async def idle_forever(self):
+        """Lets the backend use quiet moments, about once a second."""
+        while True:
+            await asyncio.sleep(1)
+            await self.run_in(self.brain_executor, self.chat_backend.idle)
+
+    async def maintain_forever(self):
+        """Runs brain maintenance every maintenance interval."""
+        while True:
+            await asyncio.sleep(self.config.maintenance_interval)
+            await self.run_in(self.brain_executor, self.run_maintenance)
 
-def train(backend, train_file):
+    def run(self):
+        self.start()
+        logging.info("handling events with asyncio")
+        asyncio.set_event_loop(self.loop)
+        self.loop.create_task(self.handle_forever())
+        self.loop.create_task(self.save_forever())
+        self.loop.create_task(self.idle_forever())
+        if self.config.maintenance_interval:
+            self.loop.create_task(self.maintain_forever())
+        try:
+            self.loop.run_until_complete(self.sync_forever())
+        finally:
+            self.stop()
+            self.save_sync_token()
+            self.stop_senders()
+
+    def stop(self):
+        """Cancels everything still pending, so the bot can run again."""
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            self.loop.run_until_complete(
+                asyncio.gather(*tasks, return_exceptions=True))
+
+    def close(self):
+        """Closes the event loop and the executors."""
+        self.loop.close()
+        for executor in (self.sync_executor, self.brain_executor,
+                         self.http_executor):
+            executor.shutdown(wait=False)
+
+
+def train(backend, train_file, workers=1):
     """Trains the given chat backend on the given train_file & saves it."""
     print("Training...")
-    backend.train_file(train_file)
+    backend.train_file(train_file, workers)
     print("Training complete!")
     backend.save()
 
 
+def make_backend(config, brain_path):
+    """Returns the chat backend the config asks for, using brain_path."""
+    backends = {'markov': MarkovBackend, 'compiled': CompiledMarkovBackend,
+                'memory': MemoryMarkovBackend, 'remote': RemoteBackend}
+    backend_class = backends[config.backend]
+    if config.room_brains and config.backend != 'remote':
+        if config.backend != 'markov':
+            raise ValueError("room brains need the markov backend")
+        backend_class = RoomMarkovBackend
+    return backend_class(brain_path, config)
+
+
 def main():
     argparser = argparse.ArgumentParser(
         description="A chatbot for Matrix (matrix.org)")
@@ -392,10 +1521,16 @@ def main():
                            action="store_true")
     argparser.add_argument("--train", metavar="train.txt", type=str,
                            help="Train the bot with a file of text.")
+    argparser.add_argument("--workers", metavar="N", type=int, default=1,
+                           help="Train with this many processes.")
     argparser.add_argument("--config", metavar="config.cfg", type=str,
                            help="Bot's config file (must be read-writable)")
     argparser.add_argument("--brain", metavar="brain.db", type=str,
                            help="Bot's brain file (must be read-writable)")
+    argparser.add_argument("--asyncio",
+                           help="Handle events with asyncio instead of "
+                           "polling for them every second.",
+                           action="store_true")
     args = vars(argparser.parse_args())
     debug = args['debug']
 
@@ -427,19 +1562,39 @@ def main():
         return
 
     config = Config(cfgparser)
+    startup = Startup()
+    if not train_path and \
+            (config.metrics_port or config.metrics_log_interval):
+        metrics.enable()
 
-    backends = {'markov': MarkovBackend}
-    backend = backends[config.backend](brain_path)
     logging.info("loading brain")
+    with startup.phase('loading brain'):
+        backend = make_backend(config, brain_path)
 
     if train_path:
-        train(backend, train_path)
-    else:
-        signal.signal(signal.SIGTERM, sigterm_handler)
+        train(backend, train_path, args['workers'])
+        return
+
+    from matrix_client.api import MatrixRequestError
+    from requests.exceptions import ConnectionError
+    signal.signal(signal.SIGTERM, sigterm_handler)
+    if config.metrics_port:
+        logging.info("serving metrics on port %d" % config.metrics_port)
+        metrics.REGISTRY.serve(config.metrics_port)
+    if config.metrics_log_interval:
+        metrics.REGISTRY.log_summaries(config.metrics_log_interval)
+    if config.warm_up_pairs:
+        backend.warm_up(config.warm_up_pairs)
+    bot_class = AsyncBot if args['asyncio'] else Bot
+    # the bot, like the backend, lives through reconnects
+    with startup.phase('creating bot'):
+        bot = bot_class(config, backend, startup,
+                        sync_token_path=brain_path + '.sync')
+    try:
         while True:
             try:
-                bot = Bot(config, backend)
-                bot.login()
+                with startup.phase('login'):
+                    bot.login()
                 bot.run()
             except (MatrixRequestError, ConnectionError):
                 traceback.print_exc()
@@ -450,6 +1605,8 @@ def main():
                 backend.save()
                 logging.info('Saving config...')
                 config.write()
+    finally:
+        bot.close()
 
 
 if __name__ == '__main__':
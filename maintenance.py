@@ -0,0 +1,85 @@
+"""Keeps a SQLite brain from growing forever.
+
+Trigrams seen only a few times (typos, pasted logs) are rarely used in
+replies but make the brain bigger and every scan slower. Maintenance can
+prune them, decay all counts so old chatter fades, cap how many followers a
+pair keeps, and give the freed space back to the OS."""
+import argparse
+import logging
+import os
+
+# how many trigrams the bot's background maintenance prunes per run, so a
+# run never holds up the bot for long
+BACKGROUND_PRUNE_LIMIT = 10000
+# how many free pages the background maintenance reclaims per run
+BACKGROUND_VACUUM_PAGES = 1000
+# how many trigrams the background maintenance goes through per run; each
+# run carries on where the last one stopped, so a decay factor is applied
+# once per pass over the whole brain
+BACKGROUND_CHUNK_SIZE = 50000
+
+
+def maintain(brain, min_count=0, decay=1, max_followers=0,
+             prune_limit=None, vacuum_pages=None, full_vacuum=False,
+             chunk_size=None):
+    """Runs each maintenance step that is switched on, in turn.
+
+    min_count prunes trigrams seen fewer times, decay multiplies counts,
+    and max_followers caps followers per pair; each is off at its default.
+    With chunk_size set, the steps only go through the next chunk of about
+    that many trigrams rather than the whole brain. Returns how many
+    trigrams were removed and how many bytes reclaimed."""
+    removed = 0
+    steps = decay != 1 or min_count > 1 or max_followers > 0
+    key_range = None
+    if steps and chunk_size:
+        key_range = brain.next_key_range(chunk_size)
+        # an empty brain has no chunks
+        steps = key_range is not None
+    if steps:
+        if decay != 1:
+            removed += brain.decay(decay, key_range)
+        if min_count > 1:
+            removed += brain.prune(min_count, prune_limit, key_range)
+        if max_followers > 0:
+            removed += brain.cap_followers(max_followers, key_range)
+        if key_range is None:
+            brain.resample()
+        else:
+            brain.end_chunk()
+    reclaimed = brain.vacuum(vacuum_pages, full=full_vacuum)
+    return {'trigrams_removed': removed, 'bytes_reclaimed': reclaimed}
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description="Prunes, decays and compacts a chatbot SQLite brain")
+    argparser.add_argument("brain", type=str, help="The SQLite brain")
+    argparser.add_argument("--min-count", type=int, default=0,
+                           help="Remove trigrams seen fewer times than this")
+    argparser.add_argument("--decay", type=float, default=1,
+                           help="Multiply every count by this, removing "
+                           "trigrams that drop to zero")
+    argparser.add_argument("--max-followers", type=int, default=0,
+                           help="Keep only this many of the most common "
+                           "followers of each word pair")
+    argparser.add_argument("--full-vacuum", action="store_true",
+                           help="Rewrite the whole file, which brains from "
+                           "older versions need before they can shrink")
+    args = vars(argparser.parse_args())
+
+    logging.basicConfig(level=logging.INFO)
+    assert os.path.exists(args['brain'])
+    # brains are handed in already open, except from the command line
+    import database
+    brain = database.MarkovDatabaseBrain(args['brain'])
+    report = maintain(
+        brain, min_count=args['min_count'], decay=args['decay'],
+        max_followers=args['max_followers'],
+        full_vacuum=args['full_vacuum'])
+    print("Removed %(trigrams_removed)d trigrams and reclaimed "
+          "%(bytes_reclaimed)d bytes" % report)
+
+
+if __name__ == '__main__':
+    main()
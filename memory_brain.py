@@ -0,0 +1,320 @@
+"""A markov brain kept entirely in memory, persisted through snapshots.
+
+Words are interned to integer ids, and each word pair's followers are two
+parallel arrays of ids and counts. Snapshots are pickled in the caller's
+thread, which is quick, then written out in the background and atomically
+moved into place, so a crash never leaves a half-written snapshot."""
+import argparse
+import os
+import pickle
+import random
+import threading
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+
+import training
+from reservoir import Reservoir, SAMPLE_SIZE
+
+SNAPSHOT_VERSION = 1
+# pairs with more followers than this find them through a dict; scanning a
+# few ids is quicker than hashing, and saves a dict on the many small pairs
+SLOT_MAP_MIN = 8
+
+
+class Followers(object):
+    """The words that follow one word pair, with their counts.
+
+    Cumulative counts are kept alongside, so picking a follower weighted by
+    count is a single bisect. Adding to a count near the end updates them in
+    place; anywhere else it drops them, to be rebuilt by the next pick."""
+    __slots__ = ('index', 'ids', 'counts', 'total', 'cumulative', 'slots')
+
+    def __init__(self, index, ids=None, counts=None):
+        self.index = index
+        self.ids = array('I') if ids is None else ids
+        self.counts = array('I') if counts is None else counts
+        self.total = sum(self.counts)
+        self.cumulative = None
+        # follower id -> slot, once there are enough followers to need it
+        self.slots = None
+        if len(self.ids) > SLOT_MAP_MIN:
+            self.slots = {id: i for i, id in enumerate(self.ids)}
+
+    def slot(self, follower_id):
+        """Returns the slot of follower_id, or None if it isn't one."""
+        if self.slots is not None:
+            return self.slots.get(follower_id)
+        try:
+            return self.ids.index(follower_id)
+        except ValueError:
+            return None
+
+    def append(self, follower_id, count):
+        """Adds a new follower, returning its slot."""
+        slot = len(self.ids)
+        self.ids.append(follower_id)
+        self.counts.append(count)
+        self.total += count
+        if self.cumulative is not None:
+            self.cumulative.append(self.total)
+        if self.slots is not None:
+            self.slots[follower_id] = slot
+        elif slot >= SLOT_MAP_MIN:
+            self.slots = {id: i for i, id in enumerate(self.ids)}
+        return slot
+
+    def increment(self, slot, count):
+        self.counts[slot] += count
+        self.total += count
+        if self.cumulative is None:
+            return
+        if len(self.cumulative) - slot > SLOT_MAP_MIN:
+            self.cumulative = None
+            return
+        for i in range(slot, len(self.cumulative)):
+            self.cumulative[i] += count
+
+    def choose(self):
+        """Returns a follower id weighted by count."""
+        if self.cumulative is None:
+            self.cumulative = array('Q', accumulate(self.counts))
+        num = random.randint(1, self.total)
+        return self.ids[bisect_left(self.cumulative, num)]
+
+
+class MemoryBrain(object):
+    """Offers the same lookups as MarkovDatabaseBrain, with no I/O."""
+    def __init__(self):
+        self.words = []
+        self.word_ids = {}
+        # (word1 id, word2 id) -> Followers, in the order pairs were added
+        self.pairs = {}
+        self.pair_keys = []
+        # lowercased word -> keys of the pairs containing it
+        self.lower_pairs = {}
+        # the pair index and follower slot of every trigram, for picking
+        # trigrams at random
+        self.trigram_pairs = array('I')
+        self.trigram_slots = array('I')
+        self.sampler = Reservoir(SAMPLE_SIZE)
+        # reservoir slot -> (pair index, follower slot)
+        self.samples = {}
+
+    def word_id(self, word):
+        """Returns the id of word, or None if the brain doesn't know it."""
+        return self.word_ids.get(word)
+
+    def _intern(self, word):
+        word_id = self.word_ids.get(word)
+        if word_id is None:
+            word_id = self.word_ids[word] = len(self.words)
+            self.words.append(word)
+        return word_id
+
+    def _add_pair(self, key, ids=None, counts=None):
+        followers = self.pairs[key] = Followers(
+            len(self.pair_keys), ids, counts)
+        self.pair_keys.append(key)
+        for lower in {self.words[key[0]].lower(),
+                      self.words[key[1]].lower()}:
+            self.lower_pairs.setdefault(lower, []).append(key)
+        return followers
+
+    def add(self, word_pair, follower, count=1):
+        word1, word2 = word_pair
+        key = (self._intern(word1), self._intern(word2))
+        follower_id = self._intern(follower)
+        followers = self.pairs.get(key) or self._add_pair(key)
+        slot = followers.slot(follower_id)
+        if slot is None:
+            slot = followers.append(follower_id, count)
+            self.trigram_pairs.append(followers.index)
+            self.trigram_slots.append(slot)
+        else:
+            followers.increment(slot, count)
+        for sample in self.sampler.offer(count):
+            self.samples[sample] = (followers.index, slot)
+
+    def add_many(self, entries):
+        for word1, word2, follower, count in entries:
+            self.add((word1, word2), follower, count)
+
+    def choose_follower(self, key):
+        """Returns the id of a follower of the pair of word ids key, weighted
+        by count, or None if it has none."""
+        followers = self.pairs.get(key)
+        if followers is None:
+            return None
+        return followers.choose()
+
+    def get_followers(self, word_pair):
+        key = tuple(self.word_ids.get(word) for word in word_pair)
+        followers = self.pairs.get(key)
+        if followers is None:
+            return {}
+        return {self.words[follower_id]: count for follower_id, count
+                in zip(followers.ids, followers.counts)}
+
+    def contains_pair(self, word_pair):
+        return tuple(self.word_ids.get(word) for word in word_pair) \
+            in self.pairs
+
+    def _pair_words(self, key):
+        return (self.words[key[0]], self.words[key[1]])
+
+    def get_pairs_containing_word_ignoring_case(self, word):
+        return (self._pair_words(key)
+                for key in self.lower_pairs.get(word.lower(), ()))
+
+    def get_random_pairs_containing_word_ignoring_case(self, word, k=1):
+        keys = self.lower_pairs.get(word.lower(), ())
+        return [self._pair_words(key)
+                for key in random.sample(keys, min(k, len(keys)))]
+
+    def _trigram(self, pair_index, slot):
+        key = self.pair_keys[pair_index]
+        return self._pair_words(key) + \
+            (self.words[self.pairs[key].ids[slot]],)
+
+    def get_three_random_words(self, weighted=False):
+        assert not self.is_empty()
+
+        if weighted:
+            sample = random.randrange(
+                min(self.sampler.seen, self.sampler.size))
+            return self._trigram(*self.samples[sample])
+        i = random.randrange(len(self.trigram_pairs))
+        return self._trigram(self.trigram_pairs[i], self.trigram_slots[i])
+
+    def iter_trigrams(self, ordered=False):
+        trigrams = ((self._pair_words(key) + (self.words[follower_id], count))
+                    for key, followers in self.pairs.items()
+                    for follower_id, count
+                    in zip(followers.ids, followers.counts))
+        return iter(sorted(trigrams)) if ordered else trigrams
+
+    def iter_words(self):
+        return iter(sorted(self.words))
+
+    def is_empty(self):
+        return not self.trigram_pairs
+
+    def save(self):
+        """Memory brains are saved by snapshotting them; see dumps."""
+        pass
+
+    def close(self):
+        pass
+
+    def dumps(self):
+        """Returns a snapshot of the brain as bytes."""
+        return pickle.dumps({
+            'version': SNAPSHOT_VERSION,
+            'words': self.words,
+            'pairs': [(key, followers.ids, followers.counts)
+                      for key, followers in self.pairs.items()],
+            'sampler': (self.sampler.seen, self.sampler.weight,
+                        self.sampler.next_index),
+            'samples': self.samples,
+        }, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def loads(cls, data):
+        """Returns the brain a snapshot made by dumps was taken of."""
+        state = pickle.loads(data)
+        if state['version'] != SNAPSHOT_VERSION:
+            raise ValueError("unknown snapshot version %r" % state['version'])
+        brain = cls()
+        brain.words = state['words']
+        brain.word_ids = {word: i for i, word in enumerate(brain.words)}
+        for key, ids, counts in state['pairs']:
+            followers = brain._add_pair(key, ids, counts)
+            brain.trigram_pairs.extend([followers.index] * len(ids))
+            brain.trigram_slots.extend(range(len(ids)))
+        brain.sampler = Reservoir(SAMPLE_SIZE, *state['sampler'])
+        brain.samples = state['samples']
+        return brain
+
+
+def write_snapshot(data, path):
+    """Atomically replaces the file at path with data."""
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as snapshot:
+        snapshot.write(data)
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    os.replace(temp_path, path)
+
+
+def read_snapshot(path):
+    with open(path, 'rb') as snapshot:
+        return MemoryBrain.loads(snapshot.read())
+
+
+def import_database(database_path):
+    """Returns a MemoryBrain holding everything in a SQLite brain.
+
+    The SQLite brain is only read, never changed."""
+    # SQLAlchemy is slow to import, and only needed to convert
+    import database
+    brain = MemoryBrain()
+    dbbrain = database.ReadOnlyBrain(database_path)
+    try:
+        brain.add_many(dbbrain.iter_trigrams())
+    finally:
+        dbbrain.close()
+    return brain
+
+
+def export_database(brain, database_path):
+    """Copies everything in a MemoryBrain into a SQLite brain."""
+    import database
+    dbbrain = database.MarkovDatabaseBrain(database_path)
+    training.bulk_load(dbbrain, brain.iter_trigrams())
+    dbbrain.close()
+
+
+class Snapshotter(object):
+    """Writes snapshots of a brain to path from a background thread."""
+    def __init__(self, brain, path):
+        self.brain = brain
+        self.path = path
+        self.thread = None
+
+    def snapshot(self):
+        """Starts writing a snapshot, once the previous one is written."""
+        self.wait()
+        self.thread = threading.Thread(
+            target=write_snapshot, args=(self.brain.dumps(), self.path))
+        self.thread.start()
+
+    def wait(self):
+        """Waits for the snapshot being written, if any."""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description="Converts between SQLite brains and snapshots for the "
+        "'memory' backend")
+    argparser.add_argument("direction", choices=['import', 'export'],
+                           help="import a SQLite brain into a snapshot, or "
+                           "export a snapshot to a SQLite brain")
+    argparser.add_argument("source", type=str, help="The brain to read")
+    argparser.add_argument("destination", type=str,
+                           help="Where to put the converted brain")
+    args = vars(argparser.parse_args())
+
+    assert not os.path.exists(args['destination'])
+    if args['direction'] == 'import':
+        brain = import_database(args['source'])
+        write_snapshot(brain.dumps(), args['destination'])
+    else:
+        export_database(read_snapshot(args['source']), args['destination'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+"""Timings and counts from the running bot.
+
+Metrics are off until enable() is called; until then timers are a shared
+no-op, so instrumented code pays for little more than a function call. Once
+enabled, they can be served over HTTP in Prometheus' text format and logged
+as periodic summaries."""
+import http.server
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+
+HELP = {
+    'chatbot_handle_event_seconds':
+        "Time to handle an event, by what the bot did with it",
+    'chatbot_backend_reply_seconds': "Time for the backend to make a reply",
+    'chatbot_backend_learn_seconds': "Time for the backend to learn a line",
+    'chatbot_brain_query_seconds': "Time for one brain lookup, by query",
+    'chatbot_brain_commit_seconds': "Time to commit the brain",
+    'chatbot_startup_seconds':
+        "Time taken by each phase of starting up, and until the first reply",
+    'chatbot_http_request_seconds':
+        "Time for one outgoing HTTP request, by endpoint",
+    'chatbot_event_queue_depth': "Events waiting to be handled, by class",
+    'chatbot_events_shed_total':
+        "Learn-only events dropped because too many were waiting",
+    'chatbot_outbox_depth': "Replies waiting to be sent",
+    'chatbot_receipts_pending': "Rooms waiting for a read receipt",
+    'chatbot_replies_sent_total': "Replies sent",
+    'chatbot_replies_dropped_total': "Replies dropped, by reason",
+    'chatbot_rate_limited_total': "Sends the server rate limited",
+    'chatbot_reply_pool_total':
+        "Replies looked up in the reply pool, by whether one was found",
+}
+
+
+class Histogram(object):
+    __slots__ = ('counts', 'count', 'sum', 'window_count', 'window_sum',
+                 'window_max')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        # since the last log summary
+        self.window_count = 0
+        self.window_sum = 0.0
+        self.window_max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.window_count += 1
+        self.window_sum += seconds
+        self.window_max = max(self.window_max, seconds)
+
+
+class Timer(object):
+    """Observes how long its with block took."""
+    __slots__ = ('registry', 'key', 'start')
+
+    def __init__(self, registry, key):
+        self.registry = registry
+        self.key = key
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.registry._observe(self.key, time.perf_counter() - self.start)
+
+
+class NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+def _format_labels(labels, extra=()):
+    labels = labels + extra
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace(
+        '\\', '\\\\').replace('"', '\\"')) for name, value in labels)
+
+
+class Metrics(object):
+    """Latency histograms, plus gauges and counters read on demand."""
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.histograms = {}
+        # name -> (type, function returning the value)
+        self.callbacks = {}
+
+    def timer(self, name, **labels):
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, (name, tuple(sorted(labels.items()))))
+
+    def observe(self, name, seconds, **labels):
+        if self.enabled:
+            self._observe((name, tuple(sorted(labels.items()))), seconds)
+
+    def _observe(self, key, seconds):
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def register(self, name, function, metric_type='gauge', **labels):
+        """Reports function() as the value of a gauge or counter."""
+        self.callbacks[(name, tuple(sorted(labels.items())))] = \
+            (metric_type, function)
+
+    def render(self):
+        """Returns every metric in Prometheus' text exposition format."""
+        lines = []
+        described = set()
+
+        def describe(name, metric_type):
+            if name not in described:
+                described.add(name)
+                lines.append('# HELP %s %s' % (name, HELP.get(name, name)))
+                lines.append('# TYPE %s %s' % (name, metric_type))
+        for (name, labels), (metric_type, function) in sorted(
+                self.callbacks.items()):
+            describe(name, metric_type)
+            lines.append('%s%s %s' % (name, _format_labels(labels),
+                                      function()))
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            for (name, labels), histogram in histograms:
+                describe(name, 'histogram')
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',),
+                                        histogram.counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (
+                        name, _format_labels(labels, (('le', bound),)),
+                        cumulative))
+                lines.append('%s_sum%s %r' % (
+                    name, _format_labels(labels), histogram.sum))
+                lines.append('%s_count%s %d' % (
+                    name, _format_labels(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Returns a line per timing since the last summary, and resets."""
+        lines = []
+        with self.lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if not histogram.window_count:
+                    continue
+                lines.append('%s%s: %d, mean %.1fms, max %.1fms' % (
+                    name, _format_labels(labels), histogram.window_count,
+                    histogram.window_sum / histogram.window_count * 1000,
+                    histogram.window_max * 1000))
+                histogram.window_count = 0
+                histogram.window_sum = 0.0
+                histogram.window_max = 0.0
+        for (name, labels), (_, function) in sorted(self.callbacks.items()):
+            lines.append('%s%s: %s' % (name, _format_labels(labels),
+                                       function()))
+        return lines
+
+    def log_summaries(self, interval):
+        """Logs a summary every interval seconds, from a daemon thread."""
+        def run():
+            while True:
+                time.sleep(interval)
+                for line in self.summary():
+                    logging.info("metrics: %s" % line)
+        threading.Thread(target=run, daemon=True).start()
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serves /metrics on the given local port from a daemon thread."""
+        registry = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+        server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+REGISTRY = Metrics()
+
+
+def enable():
+    REGISTRY.enabled = True
+
+
+def timer(name, **labels):
+    """Returns a context manager timing its block into the named histogram.
+    """
+    return REGISTRY.timer(name, **labels)
+
+
+def observe(name, seconds, **labels):
+    REGISTRY.observe(name, seconds, **labels)
+
+
+def register(name, function, metric_type='gauge', **labels):
+    REGISTRY.register(name, function, metric_type, **labels)
@@ -2,9 +2,11 @@
 project to SQLite."""
 import argparse
 import codecs
+import itertools
 import os
 
 import database
+import training
 
 
 def load_brain(brain_file, dbbrain):
@@ -16,20 +18,22 @@ def load_brain(brain_file, dbbrain):
     # e.g. "the fox jumped 2 ran 3 ate 1 ..."
     with codecs.open(brain_file, encoding='utf8',
                      mode='r') as brainfile:
-        for line in brainfile:
-            load_brain_line(line, dbbrain)
+        training.bulk_load(dbbrain, itertools.chain.from_iterable(
+            parse_brain_line(line) for line in brainfile))
 
-    dbbrain.save()
 
-
-def load_brain_line(line, dbbrain):
+def parse_brain_line(line):
+    """Returns (word1, word2, follower, count) entries for a brain line."""
     words = line.rstrip().split(' ')
     followers = {}
     for i in range(2, len(words), 2):
         followers[words[i]] = int(words[i + 1])
-    word_pair = tuple(words[0:2])
-    for (follower, count) in followers.items():
-        dbbrain.add(word_pair, follower, count=count, check_existing=False)
+    return [(words[0], words[1], follower, count)
+            for (follower, count) in followers.items()]
+
+
+def load_brain_line(line, dbbrain):
+    dbbrain.add_many(parse_brain_line(line))
 
 
 def main():
@@ -0,0 +1,75 @@
+"""Migrates a SQLite brain from the original one-table schema to the
+vocabulary schema, which stores each word once and refers to it by id."""
+import argparse
+import itertools
+import os
+import sqlite3
+import urllib.request
+
+import database
+
+# how many trigrams to copy per transaction
+MIGRATE_BATCH_SIZE = 10000
+
+
+def iter_legacy_trigrams(path):
+    """Yields every (word1, word2, follower, count) of the legacy brain at
+    path.
+
+    The brain is read through a plain read-only connection, so nothing (like
+    the indexes MarkovDatabaseBrain adds on open) is ever written to it."""
+    uri = 'file:%s?mode=ro' % urllib.request.pathname2url(
+        os.path.abspath(path))
+    connection = sqlite3.connect(uri, uri=True)
+    try:
+        tables = {name for name, in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'")}
+        if 'markov' not in tables:
+            raise ValueError(path + " is not a brain in the original schema")
+        cursor = connection.execute(
+            database.QUERIES[database.LEGACY_SCHEMA]['all'])
+        while True:
+            rows = cursor.fetchmany(MIGRATE_BATCH_SIZE)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        connection.close()
+
+
+def migrate(old_path, new_brain, batch_size=MIGRATE_BATCH_SIZE):
+    """Copies every trigram of the legacy brain at old_path into new_brain.
+
+    Trigrams are streamed in batches, each committed on its own, so memory
+    use does not depend on the size of the brain."""
+    trigrams = iter_legacy_trigrams(old_path)
+    copied = 0
+    while True:
+        batch = list(itertools.islice(trigrams, batch_size))
+        if not batch:
+            break
+        new_brain.add_many(batch)
+        new_brain.save()
+        copied += len(batch)
+        print("Copied %d trigrams" % copied)
+    return copied
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description="Migration script to convert a chatbot SQLite brain "
+        "to the vocabulary schema")
+    argparser.add_argument("old_brain", type=str,
+                           help="The existing SQLite brain")
+    argparser.add_argument("new_brain", type=str,
+                           help="Where to put the converted brain")
+    args = vars(argparser.parse_args())
+
+    assert not os.path.exists(args['new_brain'])
+    new_brain = database.MarkovDatabaseBrain(
+        args['new_brain'], schema_version=database.VOCABULARY_SCHEMA)
+    migrate(args['old_brain'], new_brain)
+
+
+if __name__ == '__main__':
+    main()
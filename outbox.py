@@ -0,0 +1,211 @@
+"""Queued, rate-limit aware sending of the bot's messages."""
+from collections import deque
+import itertools
+import logging
+import threading
+import time
+import urllib.parse
+
+import requests
+
+import metrics
+
+DEFAULT_MAX_SIZE = 1000
+DEFAULT_MAX_AGE = 60
+DEFAULT_WORKERS = 4
+# failed sends are retried after 1, 2, 4... seconds, this many times
+MAX_RETRIES = 5
+BASE_BACKOFF = 1
+# seconds to wait for the server to answer a send before retrying it
+REQUEST_TIMEOUT = 30
+
+
+class RateLimited(Exception):
+    """The server asked us to wait retry_after seconds before sending.
+
+    retry_after is None if the server didn't say how long to wait."""
+    def __init__(self, retry_after):
+        super().__init__("rate limited")
+        self.retry_after = retry_after
+
+
+class OutgoingMessage(object):
+    __slots__ = ('room_id', 'body', 'txn_id', 'queued_at', 'attempts',
+                 'on_sent')
+
+    def __init__(self, room_id, body, txn_id, on_sent):
+        self.room_id = room_id
+        self.body = body
+        self.txn_id = txn_id
+        self.queued_at = time.time()
+        self.attempts = 0
+        self.on_sent = on_sent
+
+
+class RoomQueue(object):
+    __slots__ = ('messages', 'busy', 'not_before')
+
+    def __init__(self):
+        self.messages = deque()
+        self.busy = False
+        self.not_before = 0
+
+
+class Outbox(object):
+    """Sends the bot's messages from a pool of background threads.
+
+    Messages to the same room are sent one at a time, in order; different
+    rooms don't wait on each other. When the server rate limits a room, that
+    room waits as long as the server asks. Other failures are retried with
+    exponential backoff. Messages still unsent after max_age seconds are
+    dropped, as are new messages while max_size are already waiting.
+    """
+    def __init__(self, server, max_size=DEFAULT_MAX_SIZE,
+                 max_age=DEFAULT_MAX_AGE, workers=DEFAULT_WORKERS):
+        self.server = server
+        self.max_size = max_size
+        self.max_age = max_age
+        self.workers = workers
+        self.timeout = REQUEST_TIMEOUT
+        self.token = None
+        self.session = requests.Session()
+        self.rooms = {}
+        self.size = 0
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.threads = []
+        self.txn_ids = itertools.count()
+        self.txn_prefix = str(int(time.time() * 1000))
+        # counters
+        self.sent = 0
+        self.retried = 0
+        self.rate_limited = 0
+        self.dropped_full = 0
+        self.dropped_stale = 0
+        self.failed = 0
+
+    def send_notice(self, room_id, body, on_sent=None):
+        """Queues a notice for a room. Never blocks on I/O.
+
+        on_sent is called with no arguments once the notice is delivered.
+        Returns False if the queue is full and the notice was dropped."""
+        with self.condition:
+            if self.size >= self.max_size:
+                self.dropped_full += 1
+                logging.warning("outbox full; dropping message")
+                return False
+            txn_id = "%s.%d" % (self.txn_prefix, next(self.txn_ids))
+            room = self.rooms.get(room_id)
+            if room is None:
+                room = self.rooms[room_id] = RoomQueue()
+            room.messages.append(
+                OutgoingMessage(room_id, body, txn_id, on_sent))
+            self.size += 1
+            self.condition.notify()
+        return True
+
+    def send(self, message):
+        """Sends one message to the server."""
+        url = "{}/_matrix/client/r0/rooms/{}/send/m.room.message/{}".format(
+            self.server, urllib.parse.quote(message.room_id),
+            urllib.parse.quote(message.txn_id))
+        with metrics.timer('chatbot_http_request_seconds', endpoint='send'):
+            response = self.session.put(
+                url, json={'msgtype': 'm.notice', 'body': message.body},
+                headers={'Authorization': 'Bearer %s' % self.token},
+                timeout=self.timeout)
+        if response.status_code == 429:
+            try:
+                raise RateLimited(response.json()['retry_after_ms'] / 1000)
+            except (ValueError, KeyError, TypeError):
+                raise RateLimited(None)
+        response.raise_for_status()
+
+    def _next_message(self):
+        """Waits for a room that may send, and takes its first message.
+
+        Must be called with the condition held. Returns None when stopping."""
+        while not self.stopping:
+            now = time.time()
+            wake_at = None
+            for room_id, room in list(self.rooms.items()):
+                if room.busy:
+                    continue
+                while room.messages and \
+                        now - room.messages[0].queued_at > self.max_age:
+                    room.messages.popleft()
+                    self.size -= 1
+                    self.dropped_stale += 1
+                    logging.info("dropping stale message to %s" % room_id)
+                if not room.messages:
+                    del self.rooms[room_id]
+                elif room.not_before > now:
+                    if wake_at is None or room.not_before < wake_at:
+                        wake_at = room.not_before
+                else:
+                    room.busy = True
+                    self.size -= 1
+                    return room.messages.popleft()
+            self.condition.wait(None if wake_at is None else wake_at - now)
+        return None
+
+    def _finish(self, message, outcome, delay=None):
+        """Frees the message's room, putting message back if delay is set.
+
+        outcome names the counter to increment."""
+        with self.condition:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            room = self.rooms[message.room_id]
+            room.busy = False
+            if delay is not None:
+                room.messages.appendleft(message)
+                room.not_before = time.time() + delay
+                self.size += 1
+            elif not room.messages:
+                del self.rooms[message.room_id]
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                message = self._next_message()
+            if message is None:
+                return
+            try:
+                # a timed out send may still have arrived; resending it with
+                # the same transaction id lets the server deduplicate it
+                self.send(message)
+            except (RateLimited, requests.RequestException) as e:
+                message.attempts += 1
+                backoff = BASE_BACKOFF * 2 ** (message.attempts - 1)
+                if isinstance(e, RateLimited):
+                    if e.retry_after is not None:
+                        backoff = e.retry_after
+                    self._finish(message, 'rate_limited', delay=backoff)
+                elif message.attempts > MAX_RETRIES:
+                    logging.warning("giving up on message to %s: %s"
+                                    % (message.room_id, e))
+                    self._finish(message, 'failed')
+                else:
+                    self._finish(message, 'retried', delay=backoff)
+                continue
+            self._finish(message, 'sent')
+            if message.on_sent is not None:
+                message.on_sent()
+
+    def start(self):
+        """Starts the sending threads."""
+        self.stopping = False
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self.run, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """Stops the sending threads, leaving unsent messages unsent."""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
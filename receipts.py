@@ -0,0 +1,119 @@
+"""Coalesced, background sending of read receipts."""
+from collections import OrderedDict
+import logging
+import threading
+import urllib.parse
+
+import requests
+
+import metrics
+
+# at most this many rooms' receipts wait to be sent at once
+DEFAULT_MAX_PENDING = 1000
+# seconds to wait for the server to answer a receipt
+REQUEST_TIMEOUT = 10
+
+
+class ReceiptSender(object):
+    """Sends read receipts from a background thread.
+
+    Only the newest event of each room is marked read: receipts for older
+    events in the same room are replaced before they are sent, since marking
+    an event read implies everything before it was read too. Pending
+    receipts are flushed every interval seconds, or sooner if too many rooms
+    are waiting.
+    """
+    def __init__(self, server, interval, max_pending=DEFAULT_MAX_PENDING):
+        self.server = server
+        self.interval = interval
+        self.max_pending = max_pending
+        self.timeout = REQUEST_TIMEOUT
+        self.token = None
+        self.session = requests.Session()
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.thread = None
+        # counters
+        self.sent = 0
+        self.suppressed = 0
+        self.dropped = 0
+        self.retried = 0
+        self.failed = 0
+
+    def mark_read(self, room_id, event_id):
+        """Queues a read receipt for the given event. Never blocks on I/O."""
+        with self.lock:
+            if self.pending.pop(room_id, None) is not None:
+                self.suppressed += 1
+            self.pending[room_id] = event_id
+            if len(self.pending) > self.max_pending:
+                # the sender can't keep up; forget the stalest room
+                self.pending.popitem(last=False)
+                self.dropped += 1
+            if len(self.pending) >= self.max_pending:
+                self.wakeup.set()
+
+    def send(self, room_id, event_id):
+        """Sends one read receipt to the server."""
+        url = "{}/_matrix/client/r0/rooms/{}/receipt/m.read/{}".format(
+            self.server, urllib.parse.quote(room_id),
+            urllib.parse.quote(event_id))
+        with metrics.timer('chatbot_http_request_seconds',
+                           endpoint='receipt'):
+            response = self.session.post(
+                url, json={},
+                headers={'Authorization': 'Bearer %s' % self.token},
+                timeout=self.timeout)
+        response.raise_for_status()
+
+    def flush(self):
+        """Sends every pending read receipt.
+
+        Receipts that time out or can't connect are queued again for the
+        next flush, unless a newer receipt for the room arrived meanwhile."""
+        with self.lock:
+            pending = self.pending
+            self.pending = OrderedDict()
+        for room_id, event_id in pending.items():
+            try:
+                self.send(room_id, event_id)
+                self.sent += 1
+            except (requests.Timeout, requests.ConnectionError) as e:
+                logging.info("retrying read receipt later: %s" % e)
+                with self.lock:
+                    if room_id not in self.pending and \
+                            len(self.pending) < self.max_pending:
+                        self.pending[room_id] = event_id
+                        self.pending.move_to_end(room_id, last=False)
+                    self.retried += 1
+            except requests.RequestException as e:
+                logging.warning("failed to send read receipt: %s" % e)
+                self.failed += 1
+        if pending:
+            logging.debug(
+                "read receipts: %d sent, %d suppressed, %d dropped, "
+                "%d retried, %d failed" % (self.sent, self.suppressed,
+                                           self.dropped, self.retried,
+                                           self.failed))
+
+    def run(self):
+        while not self.stopping:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def start(self):
+        """Starts sending receipts in a background thread."""
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stops the background thread after one last flush."""
+        if self.thread:
+            self.stopping = True
+            self.wakeup.set()
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,54 @@
+"""Reservoir sampling, kept apart from database so that brains which sample
+without SQLite don't have to import SQLAlchemy."""
+import math
+import random
+
+# how many trigram occurrences are kept for weighted random seeds
+SAMPLE_SIZE = 4096
+
+
+class Reservoir(object):
+    """Reservoir sampling (Algorithm L) over a stream of counted items.
+
+    An item offered with count c stands for c occurrences, so the sample is
+    weighted by count. Gaps between replacements are drawn directly, making
+    an offer O(1) however large its count is."""
+    def __init__(self, size, seen=0, weight=None, next_index=None):
+        self.size = size
+        self.seen = seen
+        self.weight = weight
+        self.next_index = next_index
+
+    def _uniform(self):
+        """Returns a random float in the open interval (0, 1)."""
+        u = 0.0
+        while u == 0.0:
+            u = random.random()
+        return u
+
+    def _advance(self):
+        self.weight *= math.exp(math.log(self._uniform()) / self.size)
+        skip = 0
+        if self.weight < 1.0:
+            skip = int(math.log(self._uniform()) / math.log1p(-self.weight))
+        self.next_index += skip + 1
+
+    def offer(self, count):
+        """Feeds count occurrences of an item.
+
+        Returns the reservoir slots the item should be stored in."""
+        slots = []
+        start = self.seen
+        self.seen += count
+        while start < min(self.size, self.seen):
+            slots.append(start)
+            start += 1
+        if self.seen >= self.size and self.weight is None:
+            # the reservoir just filled up; start skipping
+            self.weight = 1.0
+            self.next_index = self.size - 1
+            self._advance()
+        while self.next_index is not None and self.next_index < self.seen:
+            slots.append(random.randrange(self.size))
+            self._advance()
+        return slots
@@ -0,0 +1,76 @@
+"""Orders the events waiting to be handled by how much they matter."""
+from collections import deque
+import threading
+
+# event classes, most urgent first: events that may get a reply (commands,
+# mentions, membership changes), invites, and messages that are only learned
+URGENT = 'urgent'
+INVITE = 'invite'
+LEARN = 'learn'
+PRIORITIES = (URGENT, INVITE, LEARN)
+
+# what to do with learn-only events once max_size are waiting
+OVERFLOW_POLICIES = ('block', 'shed')
+
+DEFAULT_MAX_SIZE = 10000
+# most learn-only events handed out at once
+LEARN_BATCH_SIZE = 100
+
+
+class EventScheduler(object):
+    """Hands out waiting events most urgent class first, in arrival order
+    within a class.
+
+    Learn-only events are handed out in batches, so a backlog of them can be
+    learned in bulk. At most max_size of them wait; past that, put() either
+    blocks until there is room, holding up the thread receiving events, or
+    sheds the oldest waiting learn-only event. Other events are never held
+    up or shed."""
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, overflow='block',
+                 batch_size=LEARN_BATCH_SIZE):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("unknown overflow policy: " + overflow)
+        self.max_size = max_size
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.queues = {priority: deque() for priority in PRIORITIES}
+        self.condition = threading.Condition()
+        self.shed = 0
+
+    def depth(self, priority):
+        """Returns how many events of the given class are waiting."""
+        return len(self.queues[priority])
+
+    def put(self, priority, item):
+        with self.condition:
+            queue = self.queues[priority]
+            if priority == LEARN and self.max_size > 0:
+                if self.overflow == 'shed':
+                    if len(queue) >= self.max_size:
+                        queue.popleft()
+                        self.shed += 1
+                else:
+                    while len(queue) >= self.max_size:
+                        self.condition.wait()
+            queue.append(item)
+            self.condition.notify_all()
+
+    def get(self, timeout=None):
+        """Returns (class, items) for the most urgent waiting events.
+
+        items is a single event, except for learn-only events, which come in
+        batches. Returns (None, []) if nothing arrives within timeout."""
+        with self.condition:
+            self.condition.wait_for(
+                lambda: any(self.queues.values()), timeout)
+            for priority in PRIORITIES:
+                queue = self.queues[priority]
+                if not queue:
+                    continue
+                count = self.batch_size if priority == LEARN else 1
+                items = [queue.popleft()
+                         for _ in range(min(count, len(queue)))]
+                # wake anything waiting for room
+                self.condition.notify_all()
+                return priority, items
+            return None, []
@@ -1,23 +1,57 @@
+import asyncio
+import benchmark
+import brain_server
+import http.server
+import io
+import json
+import loadtest
 import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
 import unittest
+import urllib.parse
+import urllib.request
 import tempfile
+from array import array
+from collections import Counter
+from itertools import accumulate
 
+import cache
+import compiled_brain
+import database
 import main
+import memory_brain
+import metrics
+import migrate_schema
+import outbox
+import receipts
+import scheduler
+import training
 
 
 class TestMarkov(unittest.TestCase):
+    schema_version = database.VOCABULARY_SCHEMA
 
     def setUp(self):
         temp = tempfile.NamedTemporaryFile(delete=False)
         self.tempfile_path = temp.name
         temp.close()
+        # the backend opens the brain in whatever schema it was created with
+        database.MarkovDatabaseBrain(
+            self.tempfile_path, schema_version=self.schema_version)
         self.markov = main.MarkovBackend(self.tempfile_path)
         self.markov.learn("1 2 3 4 5 6 7 8 9 10")
         self.markov.learn("ALL CAPS IS GREAT")
 
     def tearDown(self):
+        self.markov.journal.close()
         del self.markov
         os.remove(self.tempfile_path)
+        if os.path.exists(self.tempfile_path + '.journal'):
+            os.remove(self.tempfile_path + '.journal')
 
     def test_reply_seeding(self):
         # basic seeding
@@ -39,6 +73,267 @@ class TestMarkov(unittest.TestCase):
             self.markov.brain.get_followers(('second', 'are')),
             {'approximately': 1})
 
+    def test_journal_replay(self):
+        # the bot dies before committing what it learned
+        self.markov.brain.session.rollback()
+        self.markov.journal.close()
+        self.markov = main.MarkovBackend(self.tempfile_path)
+        self.assertEqual(self.markov.brain.get_followers(('ALL', 'CAPS')),
+                         {'IS': 1})
+        self.assertEqual(os.path.getsize(self.tempfile_path + '.journal'), 0)
+
+        # learned lines are committed in batches
+        self.markov.learn_batch_size = 2
+        self.markov.learn("a new line")
+        self.assertEqual(self.markov.unsaved, 1)
+        self.markov.learn("another new line")
+        self.assertEqual(self.markov.unsaved, 0)
+        self.assertEqual(os.path.getsize(self.tempfile_path + '.journal'), 0)
+
+    def test_warm_up(self):
+        self.markov.learn("ALL CAPS IS GREAT")
+        self.markov.learn("ALL CAPS ARE")
+        self.markov.save()
+        warm = self.markov.brain.warm_up(1)
+        self.assertEqual(warm, {('ALL', 'CAPS'): {'IS': 2, 'ARE': 1}})
+        # the pairs come from the seed reservoir, not a scan of the brain
+        brain = self.markov.brain
+        brain.session.execute(database.text("DELETE FROM seed_samples"))
+        brain.session.commit()
+        self.assertEqual(brain.warm_up(10), {})
+        brain._fill_samplers()
+        brain.session.commit()
+
+        self.markov.follower_cache.clear()
+        self.markov.warm_up(10)
+        # pairs learned during the warm-up aren't cached from it
+        self.markov.learn("CAPS IS BAD")
+        self.markov.warming_up.join()
+        self.markov.idle()
+        self.assertIsNone(self.markov.warming_up)
+        cached = self.markov.follower_cache.entries
+        self.assertIn(('ALL', 'CAPS'), cached)
+        self.assertIn(('1', '2'), cached)
+        self.assertNotIn(('CAPS', 'IS'), cached)
+
+    def test_maintenance(self):
+        self.markov.learn("ALL CAPS IS GREAT")
+        self.markov.learn("ALL CAPS IS BAD")
+        report = self.markov.maintain(max_followers=1)
+        self.assertEqual(report['trigrams_removed'], 1)
+        self.assertEqual(self.markov.brain.get_followers(('CAPS', 'IS')),
+                         {'GREAT': 2})
+
+        report = self.markov.maintain(min_count=2)
+        self.assertEqual(report['trigrams_removed'], 8)
+        self.markov.maintain(decay=0.5)
+        # the reservoirs are rebuilt by maintenance rather than by a reply
+        self.assertFalse(self.markov.brain.samples_stale)
+        self.assertNotIn(None, self.markov.brain.samplers.values())
+        # 1.5 rounds either way
+        self.assertIn(self.markov.brain.get_followers(('ALL', 'CAPS')),
+                      [{'IS': 1}, {'IS': 2}])
+        self.assertIn(self.markov.brain.get_three_random_words(weighted=True),
+                      [('ALL', 'CAPS', 'IS'), ('CAPS', 'IS', 'GREAT')])
+        self.assertGreaterEqual(report['bytes_reclaimed'], 0)
+
+        self.markov.maintain(decay=0)
+        self.assertTrue(self.markov.brain.is_empty())
+        self.assertEqual(self.markov.reply("ALL"), '')
+
+    def test_decay_keeps_expected_counts(self):
+        brain = self.markov.brain
+        brain.add_many([('a', 'b', str(i), 1) for i in range(1000)])
+        brain.decay(0.5)
+        # about half of the trigrams seen once survive, rather than none
+        self.assertTrue(400 < len(brain.get_followers(('a', 'b'))) < 600)
+
+    def test_maintenance_in_chunks(self):
+        brain = self.markov.brain
+        brain.add_many([(str(i), 'x', 'y', 2) for i in range(100)])
+        self.markov.save()
+        before = {trigram[:3]: trigram[3] for trigram in brain.iter_trigrams()}
+        # the decay of one chunk leaves the rest alone
+        first_chunk = brain.next_key_range(30)
+        brain.decay(0, first_chunk)
+        after = {trigram[:3]: trigram[3] for trigram in brain.iter_trigrams()}
+        changed = [trigram for trigram, count in before.items()
+                   if after.get(trigram) != count]
+        self.assertTrue(30 <= len(changed) <= 40)
+        # the reservoirs are only rebuilt once the pass is over
+        brain.end_chunk()
+        self.assertTrue(brain.samples_stale)
+
+        # the chunks cover the brain in order, then start again
+        chunks = [first_chunk, brain.next_key_range(30)]
+        while chunks[-1][0] > chunks[-2][1] and len(chunks) < 100:
+            brain.end_chunk()
+            chunks.append(brain.next_key_range(30))
+        self.assertFalse(brain.samples_stale)
+        wrapped = chunks.pop()
+        # the first chunk's trigrams were all removed
+        self.assertEqual(wrapped[0], chunks[1][0])
+        self.assertGreaterEqual(len(chunks), len(after) // 30)
+
+        # a new backend carries on where the last one stopped
+        self.markov.close()
+        self.markov = main.MarkovBackend(self.tempfile_path)
+        self.assertGreater(self.markov.brain.next_key_range(30)[0],
+                           wrapped[1])
+
+    def test_add_many(self):
+        brain = self.markov.brain
+        brain.add_many([('a', 'b', 'c', 1), ('a', 'b', 'c', 2),
+                        ('a', 'b', 'd', 1), ('1', '2', '3', 4)])
+        self.assertEqual(brain.get_followers(('a', 'b')), {'c': 3, 'd': 1})
+        self.assertEqual(brain.get_followers(('1', '2')), {'3': 5})
+
+        # the per-row fallback should end up with the same counts
+        brain.add_many([('a', 'b', 'c', 1)], upsert=False)
+        self.assertEqual(brain.get_followers(('a', 'b')), {'c': 4, 'd': 1})
+        if brain.schema_version == database.VOCABULARY_SCHEMA:
+            # the uniform reservoir counts each distinct trigram once
+            self.assertEqual(brain.samplers[database.UNIFORM].seen,
+                             len(list(brain.iter_trigrams())))
+
+    def test_pairs_containing_word(self):
+        brain = self.markov.brain
+        brain.add_many([('all', 'good', 'things', 1),
+                        ('all', 'good', 'people', 1)])
+        pairs = list(brain.get_pairs_containing_word_ignoring_case('aLL'))
+        self.assertEqual(sorted(pairs), [('ALL', 'CAPS'), ('all', 'good')])
+
+        sample = brain.get_random_pairs_containing_word_ignoring_case(
+            'all', k=1)
+        self.assertEqual(len(sample), 1)
+        self.assertIn(sample[0], pairs)
+        sample = brain.get_random_pairs_containing_word_ignoring_case(
+            'all', k=5)
+        self.assertEqual(sorted(sample), sorted(pairs))
+        self.assertEqual(
+            brain.get_random_pairs_containing_word_ignoring_case('nope'), [])
+
+    def test_random_pairs_of_common_word(self):
+        brain = self.markov.brain
+        pairs = {('x', 'y%d' % i) for i in range(100)} | \
+            {('z%d' % i, 'X') for i in range(10)}
+        brain.add_many([pair + ('end', 1) for pair in pairs])
+        brain.save()
+        seen = Counter()
+        for _ in range(3000):
+            seen.update(
+                brain.get_random_pairs_containing_word_ignoring_case('x'))
+        # a window of the matches is read, but every one of them comes up
+        self.assertEqual(set(seen), pairs)
+
+    def test_random_words(self):
+        brain = self.markov.brain
+        trigrams = {trigram[:3] for trigram in brain.iter_trigrams()}
+        for _ in range(20):
+            self.assertIn(brain.get_three_random_words(), trigrams)
+            self.assertIn(brain.get_three_random_words(weighted=True),
+                          trigrams)
+
+        # reopening rebuilds the weighted sample from saved state
+        self.markov.save()
+        brain = database.MarkovDatabaseBrain(self.tempfile_path)
+        self.assertFalse(brain.is_empty())
+        self.assertIn(brain.get_three_random_words(weighted=True), trigrams)
+
+    def test_random_words_are_spread(self):
+        brain = self.markov.brain
+        brain.add_many([('the', 'cat', str(i), 1) for i in range(50)] +
+                       [('cat', str(i), 'sat', 1) for i in range(50)] +
+                       [('zebra', 'eats', 'grass', 1),
+                        ('eats', 'grass', 'now', 1)])
+        self.markov.save()
+        trigrams = {trigram[:3] for trigram in brain.iter_trigrams()}
+        seen = Counter(brain.get_three_random_words() for _ in range(3000))
+        self.assertEqual(set(seen), trigrams)
+        # about 27 each
+        self.assertLess(max(seen.values()), 80)
+
+        if brain.schema_version == database.VOCABULARY_SCHEMA:
+            # brains from before the uniform reservoir build it on first use
+            brain.session.execute(
+                database.text("DELETE FROM uniform_sampler"))
+            brain.session.commit()
+            brain = database.MarkovDatabaseBrain(self.tempfile_path)
+            self.assertIsNone(brain.samplers[database.UNIFORM])
+            seen = Counter(brain.get_three_random_words()
+                           for _ in range(3000))
+            self.assertEqual(set(seen), trigrams)
+            brain.close()
+
+    def test_reservoir_is_weighted(self):
+        counts = Counter()
+        for _ in range(200):
+            reservoir = database.Reservoir(20)
+            slots = [None] * 20
+            items = [('a', 100), ('b', 300)] + [(i, 1) for i in range(100)]
+            for item, count in items:
+                for slot in reservoir.offer(count):
+                    slots[slot] = item
+            counts.update(slots)
+        self.assertAlmostEqual(counts['b'] / sum(counts.values()), 0.6,
+                               delta=0.05)
+
+    def test_follower_cache(self):
+        follower_cache = self.markov.follower_cache
+        self.markov.reply("1")
+        misses = follower_cache.misses
+        self.markov.reply("1")
+        self.assertEqual(follower_cache.misses, misses)
+        self.assertGreater(follower_cache.hits, 0)
+
+        # learning updates cached pairs in place
+        self.markov.learn("1 2 three")
+        self.markov.learn("1 2 three")
+        self.assertEqual(follower_cache.get(('1', '2'), None),
+                         (['3', 'three'], array('Q', [1, 3])))
+
+    def test_reply_engines(self):
+        self.markov.learn("round and round and round")
+        for engine in main.REPLY_ENGINES:
+            self.markov.reply_engine = engine
+            # seeded replies run until the chain ends
+            reply_words = self.markov.reply("5").split()
+            self.assertIn("5", reply_words[:2])
+            self.assertEqual(reply_words[-2:], ["9", "10"])
+            self.assertEqual(self.markov.reply("is"), "CAPS IS GREAT")
+
+            # cycles stop at the length limit
+            reply_words = self.markov.reply("round").split()
+            self.assertEqual(len(reply_words), main.MAX_REPLY_WORDS)
+            self.assertEqual(set(reply_words), {"round", "and"})
+
+    def test_compiled_brain(self):
+        self.markov.learn("Round and round and round and round")
+        temp = tempfile.NamedTemporaryFile(delete=False)
+        temp.close()
+        try:
+            compiled_brain.compile_brain(self.markov.brain, temp.name)
+            compiled = main.CompiledMarkovBackend(temp.name)
+            self.assertEqual(list(compiled.brain.iter_trigrams()),
+                             list(self.markov.brain.iter_trigrams(True)))
+            self.assertEqual(compiled.brain.get_followers(('and', 'round')),
+                             {'and': 2})
+            for brain in (compiled.brain, self.markov.brain):
+                self.assertEqual(
+                    sorted(brain.get_pairs_containing_word_ignoring_case(
+                        'round')),
+                    [('Round', 'and'), ('and', 'round'), ('round', 'and')])
+
+            reply_words = compiled.reply("5").split()
+            self.assertIn("5", reply_words[:2])
+            self.assertEqual(reply_words[-2:], ["9", "10"])
+            self.assertEqual(compiled.reply("all"), "ALL CAPS IS GREAT")
+            self.assertEqual(len(compiled.reply("and").split()),
+                             main.MAX_REPLY_WORDS)
+            self.assertEqual(len(compiled.brain.get_three_random_words()), 3)
+        finally:
+            os.remove(temp.name)
+
     def test_is_name_in_message(self):
         configparser = main.get_default_configparser()
         configparser.set('General', 'display name', 'DisplayName')
@@ -54,5 +349,892 @@ class TestMarkov(unittest.TestCase):
         self.assertFalse(bot.is_name_in_message(''))
 
 
+class TestConcurrentBrain(unittest.TestCase):
+
+    def setUp(self):
+        temp = tempfile.NamedTemporaryFile(delete=False)
+        self.tempfile_path = temp.name
+        temp.close()
+        self.brain = database.MarkovDatabaseBrain(
+            self.tempfile_path, concurrent=True)
+
+    def tearDown(self):
+        self.brain.close()
+        for suffix in '', '-wal', '-shm':
+            if os.path.exists(self.tempfile_path + suffix):
+                os.remove(self.tempfile_path + suffix)
+
+    def test_reads_see_saved_writes(self):
+        with self.brain.readers.connect() as connection:
+            self.assertEqual(
+                connection.execute('PRAGMA journal_mode').scalar(), 'wal')
+
+        self.brain.add_many([('a', 'b', 'c', 1), ('a', 'b', 'd', 2)])
+        # readers can't see the write until it's committed
+        self.assertTrue(self.brain.is_empty())
+        self.assertEqual(self.brain.get_followers(('a', 'b')), {})
+        self.brain.save()
+        self.assertFalse(self.brain.is_empty())
+        self.assertEqual(self.brain.get_followers(('a', 'b')),
+                         {'c': 1, 'd': 2})
+        self.assertEqual(self.brain.get_three_random_words(weighted=True)[:2],
+                         ('a', 'b'))
+        self.assertEqual(list(self.brain.iter_words()), ['a', 'b', 'c', 'd'])
+
+    def test_random_trigrams_come_from_saved_samples(self):
+        self.brain.add_many([('a', 'b', 'c', 1)])
+        self.brain.save()
+        # the reservoirs take these in before readers can see them
+        self.brain.add_many([('x', 'y', str(i), 5) for i in range(50)])
+        self.brain._write(lambda: None, wait=True)
+        for weighted in True, False:
+            for _ in range(20):
+                self.assertEqual(
+                    self.brain.get_three_random_words(weighted=weighted),
+                    ('a', 'b', 'c'))
+        self.brain.save()
+        # once saved, the new trigrams are drawn too
+        seen = set()
+        for _ in range(2000):
+            seen.add(self.brain.get_three_random_words()[0])
+            if seen == {'a', 'x'}:
+                break
+        self.assertEqual(seen, {'a', 'x'})
+
+    def test_follower_cache_sees_saved_writes(self):
+        configparser = main.get_default_configparser()
+        configparser.set('General', 'concurrent brain', 'on')
+        configparser.set('General', 'learn batch size', '100')
+        markov = main.MarkovBackend(self.tempfile_path,
+                                    main.Config(configparser))
+        try:
+            markov.learn('a b c')
+            # cached before the save, so without the learned follower
+            self.assertIsNone(markov.get_random_next_link('a', 'b'))
+            markov.save()
+            self.assertEqual(markov.get_random_next_link('a', 'b'), 'c')
+        finally:
+            markov.close()
+            os.remove(self.tempfile_path + '.journal')
+
+
+class TestTraining(unittest.TestCase):
+
+    def test_parallel_training_matches_sequential(self):
+        lines = ['the cat sat on the mat', 'the cat ate the rat',
+                 'on the mat the cat sat down', 'x y']
+        with tempfile.TemporaryDirectory() as directory:
+            train_path = os.path.join(directory, 'train.txt')
+            with open(train_path, 'w') as train_file:
+                train_file.write('\n'.join(lines * 5) + '\n')
+            expected = Counter()
+            for line in lines * 5:
+                for word1, word2, follower, count in \
+                        training.line_trigrams(line):
+                    expected[(word1, word2, follower)] += count
+
+            # chunks own the lines that start in them, whatever the offsets
+            size = os.path.getsize(train_path)
+            counted = Counter()
+            total_lines = 0
+            for start, end in [(0, 7), (7, 30), (30, size)]:
+                chunk_lines, runs = training.count_chunk(
+                    train_path, start, end, directory, max_counted=3)
+                total_lines += chunk_lines
+                for word1, word2, follower, count in \
+                        training.merge_runs(runs):
+                    counted[(word1, word2, follower)] += count
+            self.assertEqual(total_lines, 20)
+            self.assertEqual(counted, expected)
+
+            brain = database.MarkovDatabaseBrain(
+                os.path.join(directory, 'brain.db'))
+            training.train_parallel(brain, train_path, 2, max_counted=3,
+                                    progress=lambda message: None)
+            self.assertEqual(
+                {trigram[:3]: trigram[3]
+                 for trigram in brain.iter_trigrams()}, dict(expected))
+
+
+class TestMemoryBrain(unittest.TestCase):
+
+    def test_snapshots(self):
+        with tempfile.TemporaryDirectory() as directory:
+            brain_path = os.path.join(directory, 'brain.db')
+            dbbrain = database.MarkovDatabaseBrain(brain_path)
+            dbbrain.add_many([('ALL', 'CAPS', 'IS', 1),
+                              ('CAPS', 'IS', 'GREAT', 2)])
+            dbbrain.save()
+            dbbrain.close()
+            with open(brain_path, 'rb') as brain_file:
+                before = brain_file.read()
+
+            # the first run imports the SQLite brain, without changing it
+            backend = main.MemoryMarkovBackend(brain_path)
+            with open(brain_path, 'rb') as brain_file:
+                self.assertEqual(brain_file.read(), before)
+            self.assertEqual(backend.reply('is'), 'CAPS IS GREAT')
+            self.assertEqual(backend.brain.get_followers(('CAPS', 'IS')),
+                             {'GREAT': 2})
+            backend.learn('all caps is fun')
+            self.assertEqual(
+                sorted(backend.brain.get_pairs_containing_word_ignoring_case(
+                    'caps')),
+                [('ALL', 'CAPS'), ('CAPS', 'IS'), ('all', 'caps'),
+                 ('caps', 'is')])
+            self.assertIn(backend.brain.get_three_random_words(weighted=True),
+                          [('ALL', 'CAPS', 'IS'), ('CAPS', 'IS', 'GREAT'),
+                           ('all', 'caps', 'is'), ('caps', 'is', 'fun')])
+            backend.save()
+            backend.close()
+
+            # later runs load the snapshot
+            os.remove(brain_path)
+            backend = main.MemoryMarkovBackend(brain_path)
+            self.assertEqual(backend.brain.get_followers(('caps', 'is')),
+                             {'fun': 1})
+            self.assertEqual(sorted(backend.brain.iter_trigrams()), [
+                ('ALL', 'CAPS', 'IS', 1), ('CAPS', 'IS', 'GREAT', 2),
+                ('all', 'caps', 'is', 1), ('caps', 'is', 'fun', 1)])
+            self.assertEqual(backend.brain.sampler.seen, 5)
+
+            memory_brain.export_database(backend.brain, brain_path)
+            dbbrain = database.MarkovDatabaseBrain(brain_path)
+            self.assertEqual(len(list(dbbrain.iter_trigrams())), 4)
+            dbbrain.close()
+
+    def test_many_followers(self):
+        brain = memory_brain.MemoryBrain()
+        followers = {str(i): i + 1 for i in range(20)}
+        for follower, count in followers.items():
+            brain.add(('a', 'b'), follower)
+            brain.add(('a', 'b'), follower, count - 1)
+        self.assertEqual(brain.get_followers(('a', 'b')), followers)
+        key = (brain.word_id('a'), brain.word_id('b'))
+        chosen = Counter(brain.words[brain.choose_follower(key)]
+                         for _ in range(2000))
+        self.assertGreater(chosen['19'], chosen['0'])
+        self.assertEqual(set(chosen) - set(followers), set())
+        # counts added after a pick change the next ones
+        brain.add(('a', 'b'), '19', 1000)
+        brain.add(('a', 'b'), '0', 100000)
+        chosen = Counter(brain.words[brain.choose_follower(key)]
+                         for _ in range(200))
+        self.assertGreater(chosen['0'], 150)
+        brain.add(('a', 'b'), '18', 5)
+        brain.choose_follower(key)
+        pair = brain.pairs[key]
+        self.assertEqual(list(pair.cumulative), list(accumulate(pair.counts)))
+
+        # a snapshot's pairs come back with their followers findable
+        loaded = memory_brain.MemoryBrain.loads(brain.dumps())
+        brain.add(('a', 'b'), '3', 10)
+        loaded.add(('a', 'b'), '3', 10)
+        self.assertEqual(loaded.get_followers(('a', 'b')),
+                         brain.get_followers(('a', 'b')))
+
+
+class TestBackendInterface(unittest.TestCase):
+    """Every backend takes every call the bot and the brain server make."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.brain_path = os.path.join(self.directory.name, 'brain.db')
+        brain = database.MarkovDatabaseBrain(self.brain_path)
+        brain.add_many([('ALL', 'CAPS', 'IS', 1), ('CAPS', 'IS', 'GREAT', 2)])
+        brain.save()
+        brain.close()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def exercise(self, backend):
+        room_id = '!a:example.org'
+        backend.learn("ALL CAPS IS BAD", room_id=room_id)
+        backend.learn_many(["ALL CAPS IS FUN"], room_id=room_id)
+        backend.warm_up(10)
+        backend.idle()
+        self.assertIn(backend.reply("caps", room_id=room_id).split()[-1],
+                      ["IS", "GREAT", "BAD", "FUN"])
+        report = backend.maintain(min_count=2, decay=0.5, max_followers=1)
+        if report is not None:
+            self.assertEqual(set(report),
+                             {'trigrams_removed', 'bytes_reclaimed'})
+        self.assertIsInstance(backend.reply("caps"), str)
+        backend.save()
+        backend.close()
+
+    def test_markov(self):
+        self.exercise(main.MarkovBackend(self.brain_path))
+
+    def test_default_next_link(self):
+        backend = main.MarkovChainBackend(self.brain_path)
+        backend.brain = database.MarkovDatabaseBrain(self.brain_path)
+        self.assertEqual(backend.get_random_next_link('ALL', 'CAPS'), 'IS')
+        self.assertIsNone(backend.get_random_next_link('CAPS', 'ALL'))
+        backend.brain.close()
+
+    def test_compiled(self):
+        compiled_path = os.path.join(self.directory.name, 'brain.mkv')
+        with open(self.brain_path, 'rb') as brain_file:
+            before = brain_file.read()
+        brain = database.ReadOnlyBrain(self.brain_path)
+        compiled_brain.compile_brain(brain, compiled_path)
+        brain.close()
+        with open(self.brain_path, 'rb') as brain_file:
+            self.assertEqual(brain_file.read(), before)
+        self.assertEqual(sorted(os.listdir(self.directory.name)),
+                         ['brain.db', 'brain.mkv'])
+        self.exercise(main.CompiledMarkovBackend(compiled_path))
+
+    def test_memory(self):
+        self.exercise(main.MemoryMarkovBackend(self.brain_path))
+
+    def test_room_brains(self):
+        self.exercise(main.RoomMarkovBackend(self.brain_path))
+
+    def test_remote(self):
+        backend = main.MarkovBackend(self.brain_path)
+        server = brain_server.BrainServer(backend, self.brain_path + '.sock')
+        server.bind()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            self.exercise(main.RemoteBackend(self.brain_path))
+        finally:
+            server.stop()
+            thread.join()
+            backend.close()
+
+
+class TestRoomBrains(unittest.TestCase):
+
+    def test_rooms_learn_separately(self):
+        configparser = main.get_default_configparser()
+        configparser.set('General', 'open brains', '1')
+        configparser.set('Room Brains', '!b-colon-example.org', 'group')
+        configparser.set('Room Brains', '!c-colon-example.org', 'group')
+        config = main.Config(configparser)
+        with tempfile.TemporaryDirectory() as directory:
+            backend = main.RoomMarkovBackend(
+                os.path.join(directory, 'brain.db'), config)
+            backend.learn('apples are red', room_id='!a:example.org')
+            backend.learn('bananas are yellow', room_id='!b:example.org')
+            backend.learn('cherries are dark', room_id='!c:example.org')
+            # only one room's brain is open at once
+            self.assertEqual(list(backend.pool.brains), ['group'])
+            self.assertEqual(backend.pool.evicted, 1)
+
+            self.assertEqual(backend.reply('apples', '!a:example.org'),
+                             'apples are red')
+            self.assertEqual(backend.reply('cherries', '!b:example.org'),
+                             'cherries are dark')
+            # the shared brain answers what the room's brain can't
+            self.assertEqual(backend.reply('bananas', '!a:example.org'),
+                             'bananas are yellow')
+            self.assertEqual(backend.reply('bananas', '!new:example.org'),
+                             'bananas are yellow')
+            backend.close()
+            self.assertEqual(
+                sorted(name for name in os.listdir(
+                    os.path.join(directory, 'brain.db.rooms'))
+                    if name.endswith('.db')),
+                ['%21a%3Aexample.org.db', '%21new%3Aexample.org.db',
+                 'group.db'])
+
+
+class TestFollowerCache(unittest.TestCase):
+
+    def test_eviction(self):
+        follower_cache = cache.FollowerCache(2)
+        for word in 'abc':
+            follower_cache.get((word, word), lambda pair: {'x': 1})
+        self.assertEqual(list(follower_cache.entries), [('b', 'b'), ('c', 'c')])
+        follower_cache.increment(('a', 'a'), 'x')
+        self.assertNotIn(('a', 'a'), follower_cache.entries)
+
+    def test_choose(self):
+        follower_cache = cache.FollowerCache(10)
+        followers = {'x': 1, 'y': 3}
+        picks = Counter(
+            follower_cache.choose(('a', 'b'), lambda pair: followers)
+            for _ in range(2000))
+        self.assertAlmostEqual(picks['y'] / 2000, 0.75, delta=0.05)
+        self.assertIsNone(follower_cache.choose(('c', 'd'), lambda pair: {}))
+
+    def test_reply_pool(self):
+        reply_pool = cache.ReplyPool(2, 60, 2, 1)
+        reply_pool.see(['a', 'a', 'B', 'c'])
+        reply_pool.refill(lambda word: [word or 'x', 'y', 'z'], 10)
+        self.assertEqual(set(reply_pool.replies), {'a', 'b'})
+        self.assertEqual(reply_pool.take_fallback(), ['x', 'y', 'z'])
+        self.assertIsNone(reply_pool.take_fallback())
+
+        # replies go stale once enough trigrams use their pairs
+        reply_pool.touch([('a', 'y'), ('a', 'y')])
+        self.assertIsNone(reply_pool.take(['a']))
+        self.assertEqual(reply_pool.take(['q', 'b']), ['b', 'y', 'z'])
+        # each reply is only used once
+        self.assertIsNone(reply_pool.take(['b']))
+        self.assertEqual((reply_pool.hits, reply_pool.misses), (1, 2))
+        self.assertEqual(reply_pool.by_pair, {})
+
+    def test_pooled_replies(self):
+        with tempfile.TemporaryDirectory() as directory:
+            config = main.Config(main.get_default_configparser())
+            config.reply_pool = True
+            markov = main.MarkovBackend(
+                os.path.join(directory, 'brain.db'), config)
+            markov.learn("ALL CAPS IS GREAT")
+            markov.idle()
+            self.assertIn('all', markov.reply_pool.replies)
+            self.assertEqual(markov.reply("all"), "ALL CAPS IS GREAT")
+            self.assertEqual(markov.reply_pool.hits, 1)
+            # falls back to generating the reply
+            self.assertEqual(markov.reply("all"), "ALL CAPS IS GREAT")
+            markov.close()
+
+
+class FakeRoom(object):
+
+    def __init__(self, room_id):
+        self.room_id = room_id
+
+
+class FakeApi(object):
+
+    def __init__(self):
+        self.requests = []
+        self.display_name = 'DisplayName'
+
+    def _send(self, method, path, **kwargs):
+        self.requests.append((method, path))
+
+    def get_display_name(self, user_id):
+        self.requests.append(('GET', '/profile/%s/displayname' % user_id))
+        return self.display_name
+
+    def create_filter(self, user_id, filter_params):
+        self.requests.append(('POST', '/user/%s/filter' % user_id))
+        return {'filter_id': '7'}
+
+
+class FakeClient(object):
+
+    def __init__(self, room_ids):
+        self.user_id = '@bot:example.org'
+        self.rooms = {room_id: FakeRoom(room_id) for room_id in room_ids}
+        self.api = FakeApi()
+        self.sync_token = None
+        self.sync_filter = None
+
+
+class FakeOutbox(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def send_notice(self, room_id, body, on_sent=None):
+        self.sent.append((room_id, body))
+        return True
+
+
+def message_event(room_id, body, event_id='$event'):
+    return {'type': 'm.room.message', 'sender': '@someone:example.org',
+            'room_id': room_id, 'event_id': event_id,
+            'content': {'msgtype': 'm.text', 'body': body}}
+
+
+class EchoBackend(main.Backend):
+
+    def __init__(self, brain_file, config=None):
+        self.learned = []
+
+    def reply(self, message, room_id=None):
+        return message
+
+    def learn(self, line, room_id=None):
+        self.learned.append([line])
+
+    def learn_many(self, lines, room_id=None):
+        self.learned.append(lines)
+
+
+class TestBot(unittest.TestCase):
+
+    def test_sync_token_is_resumed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            token_path = os.path.join(directory, 'brain.db.sync')
+            config = main.Config(main.get_default_configparser())
+            bot = main.Bot(config, main.Backend(""),
+                           sync_token_path=token_path)
+            bot.client = FakeClient([])
+            bot.setup_sync()
+            self.assertEqual(bot.client.sync_filter, '7')
+            self.assertIsNone(bot.client.sync_token)
+            bot.client.sync_token = 's72594_4483_1934'
+            bot.save_sync_token()
+
+            bot.client = FakeClient([])
+            bot.setup_sync()
+            self.assertEqual(bot.client.sync_token, 's72594_4483_1934')
+            # tokens are only resumed by the user they were saved for
+            bot.client = FakeClient([])
+            bot.client.user_id = '@other:example.org'
+            bot.setup_sync()
+            self.assertIsNone(bot.client.sync_token)
+
+    def test_lazy_imports(self):
+        # network and database libraries are only imported once needed
+        script = ("import sys, main, memory_brain, compiled_brain; "
+                  "print(sorted({'matrix_client', "
+                  "'requests', 'sqlalchemy'} & set(sys.modules)))")
+        output = subprocess.check_output(
+            [sys.executable, '-c', script],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(output.strip(), b'[]')
+
+    def test_backlog(self):
+        configparser = main.get_default_configparser()
+        configparser.set('General', 'display name', 'DisplayName')
+        configparser.set('General', 'default response rate', '0')
+        backend = EchoBackend("")
+        bot = main.Bot(main.Config(configparser), backend)
+        bot.client = FakeClient(['!a:example.org'])
+        bot.outbox = FakeOutbox()
+        for i in range(3):
+            bot.queue_event(message_event('!a:example.org', 'chat %d' % i))
+        old_mention = message_event('!a:example.org', 'DisplayName: old')
+        old_mention['origin_server_ts'] = (time.time() - 3600) * 1000
+        bot.queue_event(old_mention)
+        bot.queue_event(message_event('!a:example.org', 'DisplayName: new'))
+        while bot.handle_next(0):
+            pass
+        # mentions are handled first, but old ones aren't replied to
+        self.assertEqual(bot.outbox.sent, [('!a:example.org', ' : new')])
+        self.assertEqual(bot.replies_too_old, 1)
+        # the other messages are learned in one go
+        self.assertEqual(backend.learned, [
+            ['DisplayName: old'], ['DisplayName: new'],
+            ['chat 0', 'chat 1', 'chat 2']])
+
+    def test_identity_follows_member_events(self):
+        configparser = main.get_default_configparser()
+        configparser.set('General', 'display name', 'DisplayName')
+        configparser.set('General', 'default response rate', '0')
+        bot = main.Bot(main.Config(configparser), EchoBackend(""))
+        bot.client = FakeClient(['!a:example.org'])
+        bot.outbox = FakeOutbox()
+        bot.identity.user_id = bot.client.user_id
+
+        def member_event(room_id, display_name):
+            return {
+                'type': 'm.room.member', 'room_id': room_id,
+                'state_key': bot.client.user_id,
+                'sender': bot.client.user_id,
+                'content': {'membership': 'join',
+                            'displayname': display_name}}
+
+        # a nickname for one room is only answered to there
+        bot.handle_event(member_event('!a:example.org', 'Nick'))
+        self.assertEqual(bot.config.display_name, 'DisplayName')
+        self.assertTrue(bot.is_name_in_message('hi nick', '!a:example.org'))
+        self.assertTrue(
+            bot.is_name_in_message('hi DisplayName', '!a:example.org'))
+        self.assertFalse(bot.is_name_in_message('hi nick', '!b:example.org'))
+        bot.handle_event(message_event('!a:example.org', 'hi nick there'))
+        self.assertEqual(bot.outbox.sent, [('!a:example.org', 'hi there')])
+
+        # a new profile name replaces the display name
+        bot.client.api.display_name = 'New.Name'
+        bot.handle_event(member_event('!b:example.org', 'New.Name'))
+        self.assertEqual(bot.config.display_name, 'New.Name')
+        self.assertFalse(bot.is_name_in_message('hi DisplayName'))
+        self.assertFalse(bot.is_name_in_message('hi NewXName'))
+        self.assertTrue(bot.is_name_in_message('hi new.name'))
+        self.assertTrue(bot.is_name_in_message('hi nick', '!a:example.org'))
+
+        # the room's nickname is dropped once it goes by the profile name
+        bot.handle_event(member_event('!a:example.org', 'New.Name'))
+        self.assertFalse(bot.is_name_in_message('hi nick', '!a:example.org'))
+
+
+class TestReceiptSender(unittest.TestCase):
+
+    def test_coalescing(self):
+        sent = []
+        sender = receipts.ReceiptSender(
+            'http://localhost', 60, max_pending=2)
+        sender.send = lambda room_id, event_id: sent.append(
+            (room_id, event_id))
+        sender.mark_read('!a', '$1')
+        sender.mark_read('!a', '$2')
+        sender.mark_read('!b', '$3')
+        sender.flush()
+        self.assertEqual(sent, [('!a', '$2'), ('!b', '$3')])
+        self.assertEqual((sender.sent, sender.suppressed), (2, 1))
+
+        # the pending map is bounded
+        for room_id in '!c', '!d', '!e':
+            sender.mark_read(room_id, '$4')
+        self.assertEqual(list(sender.pending), ['!d', '!e'])
+        self.assertEqual(sender.dropped, 1)
+        self.assertTrue(sender.wakeup.is_set())
+
+    def test_timed_out_receipts_are_retried(self):
+        sent = []
+
+        def send(room_id, event_id):
+            if not sent:
+                sent.append(None)
+                raise receipts.requests.Timeout("no answer")
+            sent.append((room_id, event_id))
+        sender = receipts.ReceiptSender('http://localhost', 60)
+        sender.send = send
+        sender.mark_read('!a', '$1')
+        sender.mark_read('!b', '$2')
+        sender.flush()
+        self.assertEqual(list(sender.pending.items()), [('!a', '$1')])
+        # a newer receipt replaces the one being retried
+        sender.mark_read('!a', '$3')
+        sender.flush()
+        self.assertEqual(sent[1:], [('!b', '$2'), ('!a', '$3')])
+        self.assertEqual((sender.retried, sender.failed), (1, 0))
+
+
+class StubHomeserver(http.server.BaseHTTPRequestHandler):
+    """Rate limits the first send to each room, then accepts everything.
+
+    The first send to a room in stalled_rooms gets no timely answer."""
+
+    def do_PUT(self):
+        server = self.server
+        body = json.loads(self.rfile.read(
+            int(self.headers['Content-Length'])).decode('utf-8'))
+        room_id = urllib.parse.unquote(self.path.split('/')[5])
+        with server.lock:
+            stalled = room_id in server.stalled_rooms
+            server.stalled_rooms.discard(room_id)
+        if stalled:
+            # answer too late for the client to wait
+            time.sleep(0.5)
+            return
+        with server.lock:
+            limited = room_id not in server.limited_rooms
+            server.limited_rooms.add(room_id)
+            if not limited:
+                server.received.append((room_id, body['body']))
+        if limited:
+            self.send_response(429)
+            response = {'errcode': 'M_LIMIT_EXCEEDED',
+                        'retry_after_ms': 50}
+        else:
+            self.send_response(200)
+            response = {'event_id': '$sent'}
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(response).encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+class TestOutbox(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), StubHomeserver)
+        self.server.lock = threading.Lock()
+        self.server.limited_rooms = set()
+        self.server.stalled_rooms = set()
+        self.server.received = []
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.outbox = outbox.Outbox(
+            'http://127.0.0.1:%d' % self.server.server_address[1])
+
+    def tearDown(self):
+        self.outbox.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_rate_limits_are_respected_in_order(self):
+        delivered = []
+        for i in range(3):
+            for room_id in '!a', '!b':
+                self.outbox.send_notice(
+                    room_id, str(i),
+                    on_sent=lambda: delivered.append(None))
+        self.outbox.start()
+        deadline = time.time() + 5
+        while len(delivered) < 6 and time.time() < deadline:
+            time.sleep(0.01)
+        for room_id in '!a', '!b':
+            self.assertEqual(
+                [body for room, body in self.server.received
+                 if room == room_id], ['0', '1', '2'])
+        self.assertEqual((self.outbox.sent, self.outbox.rate_limited), (6, 2))
+        self.assertEqual(self.outbox.size, 0)
+
+    def test_timed_out_sends_are_retried(self):
+        self.server.stalled_rooms.add('!a')
+        self.server.limited_rooms.add('!a')
+        self.outbox.timeout = 0.1
+        self.outbox.send_notice('!a', 'hello')
+        self.outbox.start()
+        deadline = time.time() + 5
+        while self.outbox.sent < 1 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.server.received, [('!a', 'hello')])
+        self.assertEqual((self.outbox.sent, self.outbox.retried), (1, 1))
+
+    def test_stale_and_overflowing_messages_are_dropped(self):
+        self.outbox.max_size = 2
+        self.assertTrue(self.outbox.send_notice('!a', 'old'))
+        self.assertTrue(self.outbox.send_notice('!a', 'old'))
+        self.assertFalse(self.outbox.send_notice('!a', 'too many'))
+        for message in self.outbox.rooms['!a'].messages:
+            message.queued_at -= self.outbox.max_age + 1
+        self.outbox.max_size = 3
+        self.outbox.send_notice('!a', 'new')
+        self.outbox.start()
+        deadline = time.time() + 5
+        while self.outbox.sent < 1 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.server.received, [('!a', 'new')])
+        self.assertEqual(
+            (self.outbox.dropped_full, self.outbox.dropped_stale), (1, 2))
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_prometheus_endpoint(self):
+        registry = metrics.Metrics()
+        self.assertIs(registry.timer('chatbot_brain_commit_seconds'),
+                      metrics.NULL_TIMER)
+        registry.enabled = True
+        with registry.timer('chatbot_brain_query_seconds', query='any'):
+            pass
+        registry.observe('chatbot_handle_event_seconds', 0.02,
+                         outcome='reply')
+        registry.register('chatbot_outbox_depth', lambda: 3)
+
+        server = registry.serve(0)
+        try:
+            response = urllib.request.urlopen(
+                'http://127.0.0.1:%d/metrics' % server.server_address[1])
+            body = response.read().decode('utf-8')
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn('# TYPE chatbot_handle_event_seconds histogram\n', body)
+        self.assertIn('chatbot_handle_event_seconds_bucket'
+                      '{outcome="reply",le="0.025"} 1\n', body)
+        self.assertIn('chatbot_handle_event_seconds_bucket'
+                      '{outcome="reply",le="0.01"} 0\n', body)
+        self.assertIn('chatbot_brain_query_seconds_count{query="any"} 1\n',
+                      body)
+        self.assertIn('chatbot_outbox_depth 3\n', body)
+
+        summary = registry.summary()
+        self.assertIn('chatbot_outbox_depth: 3', summary)
+        self.assertEqual(len(summary), 3)
+        # timings are only summarized once
+        self.assertEqual(registry.summary(), ['chatbot_outbox_depth: 3'])
+
+
+class TestBrainServer(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.brain_path = os.path.join(self.directory.name, 'brain.db')
+        self.backend = main.MarkovBackend(self.brain_path)
+        self.server = brain_server.BrainServer(
+            self.backend, self.brain_path + '.sock')
+        self.server.bind()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.thread.join()
+        self.backend.close()
+        self.directory.cleanup()
+
+    def test_remote_backend(self):
+        remote = main.RemoteBackend(self.brain_path)
+        self.assertTrue(remote.local_replies)
+        self.assertEqual(remote.reply("anything"), '')
+        remote.learn_many(["ALL CAPS IS GREAT", "ALL CAPS IS BAD"])
+        self.assertEqual(remote.get_followers(('ALL', 'CAPS')), {'IS': 2})
+        self.assertIn(remote.reply("all"),
+                      ["ALL CAPS IS GREAT", "ALL CAPS IS BAD"])
+
+        # a second bot shares the brain
+        other = main.RemoteBackend(self.brain_path)
+        other.learn("ALL CAPS IS GREAT")
+        # requests are only ordered within a connection
+        other.client.call('info')
+        self.assertEqual(remote.get_followers(('CAPS', 'IS')),
+                         {'GREAT': 2, 'BAD': 1})
+        with self.assertRaises(brain_server.BrainServerError):
+            other.client.call('no such method')
+        remote.close()
+        other.close()
+
+    def test_learning_is_batched(self):
+        learned = []
+        self.backend.learn_many = lambda lines, room_id=None: \
+            learned.append((room_id, lines))
+        response = io.BytesIO()
+        self.server.handle_batch([
+            (None, {'method': 'learn', 'args': {'lines': ['a b c']}}),
+            (None, {'method': 'learn', 'args': {'lines': ['d e f']}}),
+            (response, {'method': 'info', 'args': {}, 'id': 1}),
+            (None, {'method': 'learn', 'args': {'lines': ['g h i']}}),
+        ])
+        self.assertEqual(learned, [(None, ['a b c', 'd e f']),
+                                   (None, ['g h i'])])
+        self.assertEqual(json.loads(response.getvalue()),
+                         {'id': 1, 'result': {'followers': True}})
+
+
+class TestEventScheduler(unittest.TestCase):
+
+    def test_priorities_and_batches(self):
+        events = scheduler.EventScheduler(batch_size=2)
+        for i in range(3):
+            events.put(scheduler.LEARN, i)
+        events.put(scheduler.INVITE, 'invite')
+        events.put(scheduler.URGENT, 'mention')
+        self.assertEqual(events.depth(scheduler.LEARN), 3)
+        self.assertEqual(events.get(0), (scheduler.URGENT, ['mention']))
+        self.assertEqual(events.get(0), (scheduler.INVITE, ['invite']))
+        self.assertEqual(events.get(0), (scheduler.LEARN, [0, 1]))
+        self.assertEqual(events.get(0), (scheduler.LEARN, [2]))
+        self.assertEqual(events.get(0), (None, []))
+
+    def test_overflow(self):
+        events = scheduler.EventScheduler(max_size=2, overflow='shed')
+        for i in range(3):
+            events.put(scheduler.LEARN, i)
+        events.put(scheduler.URGENT, 'mention')
+        self.assertEqual(events.shed, 1)
+        self.assertEqual(events.depth(scheduler.URGENT), 1)
+
+        events = scheduler.EventScheduler(max_size=2)
+        events.put(scheduler.LEARN, 0)
+        events.put(scheduler.LEARN, 1)
+        putter = threading.Thread(
+            target=events.put, args=(scheduler.LEARN, 2))
+        putter.start()
+        putter.join(0.1)
+        # held up until there's room
+        self.assertTrue(putter.is_alive())
+        self.assertEqual(events.get(0), (scheduler.LEARN, [0, 1]))
+        putter.join(5)
+        self.assertEqual(events.get(0), (scheduler.LEARN, [2]))
+
+
+class TestAsyncBot(unittest.TestCase):
+
+    def test_events_are_handled_and_replied_to(self):
+        configparser = main.get_default_configparser()
+        configparser.set('General', 'display name', 'DisplayName')
+        configparser.set('General', 'default response rate', '0')
+        bot = main.AsyncBot(main.Config(configparser), main.Backend(""))
+        bot.client = FakeClient(['!a:example.org', '!b:example.org'])
+        bot.outbox = FakeOutbox()
+
+        bot.queue_event(message_event('!a:example.org', 'hi DisplayName'))
+        bot.queue_event(message_event('!b:example.org', '!rate'))
+        bot.queue_event(message_event('!b:example.org', 'not for the bot'))
+        bot.loop.create_task(bot.handle_forever())
+
+        async def wait_for_replies():
+            while len(bot.outbox.sent) < 2 or len(bot.receipts.pending) < 2:
+                await asyncio.sleep(0.01)
+        bot.loop.run_until_complete(
+            asyncio.wait_for(wait_for_replies(), 5))
+        bot.stop()
+        bot.close()
+        self.assertEqual(sorted(bot.outbox.sent), [
+            ('!a:example.org', '(dummy response)'),
+            ('!b:example.org', 'Response rate set to 0.000000 in this room.'),
+        ])
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_small_benchmark(self):
+        with tempfile.TemporaryDirectory() as directory:
+            result = benchmark.run_benchmark(500, replies=5,
+                                             directory=directory)
+            self.assertEqual(os.listdir(directory), [])
+        self.assertEqual(result['lines'], 50)
+        self.assertGreater(result['brain_bytes'], 0)
+        self.assertLessEqual(result['reply_seeded']['p50_ms'],
+                             result['reply_seeded']['max_ms'])
+
+
+class TestLoadTest(unittest.TestCase):
+
+    def test_small_load_test(self):
+        with tempfile.TemporaryDirectory() as directory:
+            result = loadtest.run_load_test(
+                rate=20, duration=1, rooms=2, mention_ratio=0.5,
+                brain_trigrams=500, directory=directory)
+        self.assertEqual(result['events_posted'], 20)
+        self.assertEqual(result['events_handled'], 20)
+        self.assertGreater(result['mentions'], 0)
+        self.assertEqual(result['requests']['send'], result['mentions'])
+        self.assertEqual(result['unexpected_replies'], 0)
+        self.assertLessEqual(result['mention_reply_latency']['p50_ms'],
+                             result['mention_reply_latency']['max_ms'])
+        self.assertNotIn('login', result['requests'])
+        self.assertTrue(result['rss_bytes'])
+
+
+class TestMarkovLegacySchema(TestMarkov):
+    schema_version = database.LEGACY_SCHEMA
+
+    def test_migrate_schema(self):
+        temp = tempfile.NamedTemporaryFile(delete=False)
+        temp.close()
+        try:
+            new_brain = database.MarkovDatabaseBrain(temp.name)
+            self.markov.save()
+            migrate_schema.migrate(self.tempfile_path, new_brain,
+                                   batch_size=3)
+            self.assertEqual(new_brain.schema_version,
+                             database.VOCABULARY_SCHEMA)
+            self.assertEqual(sorted(new_brain.iter_trigrams()),
+                             sorted(self.markov.brain.iter_trigrams()))
+        finally:
+            os.remove(temp.name)
+
+    def test_migrate_schema_leaves_old_brain_alone(self):
+        with tempfile.TemporaryDirectory() as directory:
+            old_path = os.path.join(directory, 'old.db')
+            connection = sqlite3.connect(old_path)
+            connection.execute("CREATE TABLE markov (id INTEGER PRIMARY KEY, "
+                               "word1 TEXT, word2 TEXT, follower TEXT, "
+                               "count INTEGER NOT NULL)")
+            connection.execute("INSERT INTO markov (word1, word2, follower, "
+                               "count) VALUES ('a', 'b', 'c', 2)")
+            connection.commit()
+            connection.close()
+            with open(old_path, 'rb') as old_file:
+                before = old_file.read()
+            new_brain = database.MarkovDatabaseBrain(
+                os.path.join(directory, 'new.db'))
+            migrate_schema.migrate(old_path, new_brain)
+            self.assertEqual(list(new_brain.iter_trigrams()),
+                             [('a', 'b', 'c', 2)])
+            with open(old_path, 'rb') as old_file:
+                self.assertEqual(old_file.read(), before)
+            new_brain.close()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,150 @@
+"""Trains a brain on a large text file using several processes.
+
+The file is split into chunks of whole lines. Worker processes count each
+chunk's trigrams in memory, writing them out as sorted runs on disk whenever
+the count grows too big. The runs are then merged, summing the counts of
+each trigram, and bulk loaded into the brain in one pass."""
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import tempfile
+from collections import Counter
+
+# most trigrams a worker counts in memory before spilling them to disk
+MAX_COUNTED_TRIGRAMS = 1000000
+# chunks per worker, so that workers finishing early can take more
+CHUNKS_PER_WORKER = 4
+MIN_CHUNK_BYTES = 1024 * 1024
+# how many trigrams to add to the brain at once
+LOAD_BATCH_SIZE = 10000
+
+
+def sanitize(word):
+    """Removes any awkward whitespace characters from the given word.
+
+    Removes '\n', '\r', and '\\u2028' (unicode newline character)."""
+    return word.replace('\n', '').replace('\r', '').replace('\u2028', '')
+
+
+def line_trigrams(line):
+    """Returns (word1, word2, follower, count) entries for a line."""
+    line = line.strip()
+    words = line.split(' ')
+    words = [sanitize(word) for word in words]
+    return [(words[i], words[i + 1], words[i + 2], 1)
+            for i in range(len(words) - 2)]
+
+
+def split_file(path, num_chunks):
+    """Returns (start, end) byte ranges that split a file into num_chunks.
+
+    A chunk owns every line starting inside its range."""
+    size = os.path.getsize(path)
+    chunk_size = max(MIN_CHUNK_BYTES, -(-size // max(num_chunks, 1)))
+    return [(start, min(start + chunk_size, size))
+            for start in range(0, size, chunk_size)]
+
+
+def _write_run(counts, run_directory):
+    """Writes counts out sorted by trigram, one JSON entry per line."""
+    run_file = tempfile.NamedTemporaryFile(
+        'w', encoding='utf-8', dir=run_directory, suffix='.run',
+        delete=False)
+    with run_file:
+        for trigram, count in sorted(counts.items()):
+            run_file.write(json.dumps(trigram + (count,)) + '\n')
+    return run_file.name
+
+
+def read_run(path):
+    """Yields the ((word1, word2, follower), count) entries of a run."""
+    with open(path, encoding='utf-8') as run_file:
+        for line in run_file:
+            word1, word2, follower, count = json.loads(line)
+            yield ((word1, word2, follower), count)
+
+
+def count_chunk(path, start, end, run_directory,
+                max_counted=MAX_COUNTED_TRIGRAMS):
+    """Counts the trigrams of the lines starting in [start, end).
+
+    Returns how many lines were read, and the paths of the sorted runs
+    holding the counts."""
+    runs = []
+    counts = Counter()
+    lines = 0
+    with open(path, 'rb') as train_file:
+        if start:
+            # the line we landed in belongs to the previous chunk
+            train_file.seek(start - 1)
+            train_file.readline()
+        while train_file.tell() < end:
+            line = train_file.readline()
+            if not line:
+                break
+            lines += 1
+            for word1, word2, follower, count in line_trigrams(
+                    line.decode('utf-8', errors='replace')):
+                counts[(word1, word2, follower)] += count
+            if len(counts) >= max_counted:
+                runs.append(_write_run(counts, run_directory))
+                counts = Counter()
+    if counts:
+        runs.append(_write_run(counts, run_directory))
+    return lines, runs
+
+
+def _count_chunk(args):
+    return count_chunk(*args)
+
+
+def merge_runs(runs):
+    """Yields (word1, word2, follower, count) entries from sorted runs.
+
+    Each trigram appears once, with its counts from every run summed."""
+    merged = heapq.merge(*[read_run(run) for run in runs])
+    for trigram, entries in itertools.groupby(merged, lambda e: e[0]):
+        yield trigram + (sum(count for _, count in entries),)
+
+
+def bulk_load(brain, entries, batch_size=LOAD_BATCH_SIZE, progress=None):
+    """Adds (word1, word2, follower, count) entries to brain in batches.
+
+    Everything is committed at the end. progress is called with the number
+    of entries loaded so far after each batch. Returns that number."""
+    entries = iter(entries)
+    loaded = 0
+    while True:
+        batch = list(itertools.islice(entries, batch_size))
+        if not batch:
+            break
+        brain.add_many(batch)
+        loaded += len(batch)
+        if progress:
+            progress(loaded)
+    brain.save()
+    return loaded
+
+
+def train_parallel(brain, path, workers, max_counted=MAX_COUNTED_TRIGRAMS,
+                   progress=print):
+    """Trains brain on the text file at path using workers processes."""
+    chunks = split_file(path, workers * CHUNKS_PER_WORKER)
+    with tempfile.TemporaryDirectory(
+            dir=os.path.dirname(os.path.abspath(path))) as run_directory:
+        runs = []
+        lines = 0
+        with multiprocessing.Pool(workers) as pool:
+            counted = pool.imap_unordered(_count_chunk, [
+                (path, start, end, run_directory, max_counted)
+                for start, end in chunks])
+            for i, (chunk_lines, chunk_runs) in enumerate(counted, 1):
+                lines += chunk_lines
+                runs.extend(chunk_runs)
+                progress("Counted %d/%d chunks (%d lines)"
+                         % (i, len(chunks), lines))
+        return bulk_load(
+            brain, merge_runs(runs),
+            progress=lambda loaded: progress("Loaded %d trigrams" % loaded))